@@ -0,0 +1,247 @@
+'''
+In-process stand-ins for rethinkdb and hdfs, for benchmarking the sync
+controllers without a cluster.
+
+FakeRethinker understands the subset of reql that trough.sync builds out of
+plain python values (get, get_all, between, insert, delete, update, filter
+on a dict, ...) and counts every query it runs. It keeps secondary indexes
+up to date on write so that index lookups cost about what they would on a
+real server, rather than a table scan. Predicates written as reql lambdas
+(e.g. heartbeat freshness checks) can't be evaluated in python, so filter()
+treats anything that isn't a plain bool as true: every service is healthy.
+Workers advertise per-segment services, SERVICE_REGISTRY_MODEL 'segment'.
+'''
+import bisect
+import collections
+import doublethink
+import hashlib
+import time
+
+# secondary indexes that trough creates, per table
+INDEXES = {
+    'assignment': ['segment', 'draining'],
+    'lock': ['node'],
+    'services': ['segment', 'role'],
+}
+
+class FakeTable:
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.indexes = {field: collections.defaultdict(set) for field in INDEXES.get(name, [])}
+        self._sorted_ids = None
+
+    def sorted_ids(self):
+        if self._sorted_ids is None:
+            self._sorted_ids = sorted(self.docs)
+        return self._sorted_ids
+
+    def put(self, doc):
+        old = self.docs.get(doc['id'])
+        if old is not None:
+            self._unindex(old)
+        else:
+            self._sorted_ids = None
+        doc = dict(doc)
+        self.docs[doc['id']] = doc
+        for field, index in self.indexes.items():
+            if field in doc:
+                index[doc[field]].add(doc['id'])
+        return old
+
+    def remove(self, id):
+        doc = self.docs.pop(id, None)
+        if doc is not None:
+            self._unindex(doc)
+            self._sorted_ids = None
+        return doc
+
+    def _unindex(self, doc):
+        for field, index in self.indexes.items():
+            if field in doc:
+                index[doc[field]].discard(doc['id'])
+
+class FakeQuery:
+    def __init__(self, rethinker, table, kind, select):
+        self.rethinker = rethinker
+        self.table = table
+        self.kind = kind
+        # returns a list of docs (or a value, for terminal queries)
+        self._select = select
+        self._write = None
+
+    def _derive(self, kind, select):
+        return FakeQuery(self.rethinker, self.table, '%s.%s' % (self.kind, kind), select)
+
+    def get(self, id):
+        return self._derive('get', lambda: self.table.docs.get(id))
+
+    def get_all(self, *keys, index='id'):
+        def select():
+            if index == 'id':
+                return [self.table.docs[key] for key in keys if key in self.table.docs]
+            ids = set()
+            for key in keys:
+                ids.update(self.table.indexes[index].get(key, ()))
+            return [self.table.docs[id] for id in ids]
+        return self._derive('get_all', select)
+
+    def between(self, lower, upper, right_bound='open', index='id'):
+        assert index == 'id'
+        def select():
+            ids = self.table.sorted_ids()
+            start = bisect.bisect_left(ids, lower)
+            if right_bound == 'closed':
+                end = bisect.bisect_right(ids, upper)
+            else:
+                end = bisect.bisect_left(ids, upper)
+            return [self.table.docs[id] for id in ids[start:end]]
+        return self._derive('between', select)
+
+    def filter(self, predicate):
+        def matches(doc):
+            if isinstance(predicate, dict):
+                return all(doc.get(k) == v for k, v in predicate.items())
+            result = predicate(doc)
+            return result if isinstance(result, bool) else True
+        return self._derive('filter', lambda: [doc for doc in self._select() if matches(doc)])
+
+    def union(self, other):
+        # `other` is reql built from r.table() (segment membership, see
+        # trough.membership), which can't be evaluated here, so only the
+        # per-segment services are simulated
+        if isinstance(other, FakeQuery):
+            return self._derive('union', lambda: self._select() + other._select())
+        return self._derive('union', self._select)
+
+    def has_fields(self, field):
+        return self._derive('has_fields', lambda: [doc for doc in self._select() if field in doc])
+
+    def order_by(self, field):
+        return self._derive('order_by', lambda: sorted(self._select(), key=lambda doc: doc.get(field)))
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._derive('nth', lambda: self._select()[key])
+        return self._derive('get_field', lambda: [doc[key] for doc in self._select() if key in doc])
+    get_field = __getitem__
+
+    def count(self):
+        return self._derive('count', lambda: len(self._select()))
+
+    def is_empty(self):
+        return self._derive('is_empty', lambda: not self._select())
+
+    def insert(self, docs, conflict='error'):
+        if isinstance(docs, dict):
+            docs = [docs]
+        def write():
+            result = {'inserted': 0, 'replaced': 0, 'unchanged': 0, 'errors': 0}
+            for doc in docs:
+                old = self.table.docs.get(doc['id'])
+                if old is not None and conflict == 'error':
+                    result['errors'] += 1
+                    continue
+                if old is not None and conflict == 'update':
+                    doc = dict(old, **doc)
+                self.table.put(doc)
+                result['inserted' if old is None else 'replaced'] += 1
+            return result
+        query = self._derive('insert', None)
+        query._write = write
+        return query
+
+    def delete(self):
+        def write():
+            docs = self._select()
+            if isinstance(docs, dict):
+                docs = [docs]
+            for doc in docs or []:
+                self.table.remove(doc['id'])
+            return {'deleted': len(docs or [])}
+        query = self._derive('delete', None)
+        query._write = write
+        return query
+
+    def update(self, changes):
+        def write():
+            docs = self._select()
+            if isinstance(docs, dict):
+                docs = [docs]
+            for doc in docs or []:
+                self.table.put(dict(doc, **changes))
+            return {'replaced': len(docs or []), 'unchanged': 0, 'skipped': 0, 'errors': 0}
+        query = self._derive('update', None)
+        query._write = write
+        return query
+
+    def run(self):
+        self.rethinker.ops[(self.table.name, self.kind)] += 1
+        if self._write:
+            return self._write()
+        return self._select()
+
+class FakeRethinker:
+    def __init__(self):
+        self.dbname = 'trough_configuration'
+        self.tables = {}
+        self.ops = collections.Counter()
+
+    def table(self, name, read_mode=None):
+        if name not in self.tables:
+            self.tables[name] = FakeTable(name)
+        table = self.tables[name]
+        return FakeQuery(self, table, 'table', lambda: list(table.docs.values()))
+
+class FakeServiceRegistry:
+    '''Stand-in for doublethink.ServiceRegistry, backed by a FakeRethinker.'''
+    def __init__(self, rethinker):
+        self.rethinker = rethinker
+
+    def heartbeat(self, status_info):
+        status_info = dict(status_info)
+        status_info['last_heartbeat'] = doublethink.utcnow()
+        self.rethinker.table('services').insert(status_info, conflict='replace').run()
+        return status_info
+
+    def unique_service(self, role, candidate=None):
+        # whoever asks first is master, forever
+        services = self.rethinker.table('services')
+        current = services.get(role).run()
+        if current is None and candidate is not None:
+            current = dict(candidate, role=role, last_heartbeat=doublethink.utcnow())
+            services.insert(current).run()
+        return current
+
+    def available_services(self, role=None):
+        if role:
+            return self.rethinker.table('services').get_all(role, index='role').run()
+        return self.rethinker.table('services').run()
+
+    def unregister(self, id):
+        self.rethinker.table('services').get(id).delete().run()
+
+class FakeHDFS:
+    '''
+    A flat hdfs directory of segments, { segment_id: (size, last_mod) }, with
+    a count of listing calls. Listed like the segment catalog lists them,
+    with a (made up) checksum.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.listings = 0
+
+    def add(self, segment_id, size, last_mod=None):
+        self.files[segment_id] = (size, int(last_mod or time.time()))
+
+    def listing(self):
+        self.listings += 1
+        for segment_id, (size, last_mod) in self.files.items():
+            yield {
+                'name': '%s/%s.sqlite' % (self.path, segment_id),
+                'kind': 'file',
+                'size': size,
+                'last_mod': last_mod,
+                'checksum': hashlib.sha256(('%s:%s' % (segment_id, last_mod)).encode('utf-8')).hexdigest(),
+            }
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''
+Compares the time it takes to place segments on hash rings one segment at a
+time, the way assign_segments used to, against the batch placement engine
+in trough.placement.
+
+    python3 benchmarks/placement.py --segments 1000000 --rings 2 --nodes 50
+'''
+import argparse
+import random
+import sys
+import time
+from uhashring import HashRing
+from trough import placement
+
+def make_hash_rings(ring_count, node_count):
+    hash_rings = []
+    for i in range(ring_count):
+        ring = HashRing()
+        ring.id = i
+        hash_rings.append(ring)
+    for j in range(node_count):
+        hash_rings[j % ring_count].add_node(
+                'node%04d.example.com' % j,
+                {'weight': random.randint(1, 1000) * 1024**3})
+    return hash_rings
+
+def place_one_at_a_time(hash_rings, segment_ids, copies):
+    placements = []
+    for segment_id in segment_ids:
+        random.seed(segment_id)
+        assigned_rings = random.sample(hash_rings, copies)
+        placements.append(
+                [(ring, ring.get_node(segment_id)) for ring in assigned_rings])
+    return placements
+
+def main(argv=None):
+    argv = argv or sys.argv
+    arg_parser = argparse.ArgumentParser(
+            prog=argv[0], description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--segments', type=int, default=1000000)
+    arg_parser.add_argument('--rings', type=int, default=2)
+    arg_parser.add_argument('--nodes', type=int, default=50)
+    arg_parser.add_argument(
+            '--copies', type=int, default=None,
+            help='rings to place each segment on (default: all of them)')
+    arg_parser.add_argument(
+            '--skip-reference', action='store_true',
+            help="don't time the one-at-a-time reference implementation")
+    args = arg_parser.parse_args(args=argv[1:])
+
+    hash_rings = make_hash_rings(args.rings, args.nodes)
+    segment_ids = [str(i) for i in range(args.segments)]
+    copies = args.copies or args.rings
+    print('%s segments, %s copies on %s rings, %s nodes, numpy %s' % (
+        args.segments, copies, args.rings, args.nodes,
+        'available' if placement.numpy is not None else 'not available'))
+
+    start = time.time()
+    engine = placement.PlacementEngine(hash_rings)
+    batch = engine.place(segment_ids, [copies] * args.segments)
+    batch_elapsed = time.time() - start
+    print('batch placement:        %8.2f sec' % batch_elapsed)
+
+    if not args.skip_reference:
+        start = time.time()
+        reference = place_one_at_a_time(hash_rings, segment_ids, copies)
+        reference_elapsed = time.time() - start
+        print('one segment at a time:  %8.2f sec (%.1fx slower)' % (
+            reference_elapsed, reference_elapsed / batch_elapsed))
+        identical = all(
+                sorted((r.id, n) for r, n in a) == sorted((r.id, n) for r, n in b)
+                for a, b in zip(batch, reference))
+        print('identical placements:   %s' % identical)
+        if not identical:
+            return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+'''
+Runs MasterSyncController.assign_segments and LocalSyncController.sync
+against a generated corpus, using in-process stand-ins for rethinkdb and
+hdfs (see fakes.py), and reports wall time, rethinkdb queries, hdfs listings
+and peak memory for each phase.
+
+Phases:
+  master-initial   first assignment pass, nothing assigned yet
+  master-steady    pass with nothing changed
+  master-churn     pass after adding, resizing and removing some segments
+  master-add-nodes pass after adding nodes (hash rings change)
+  master-rm-node   pass after a node goes away
+  local-initial    sync on one node with none of its segments on disk
+  local-steady     sync on the same node with nothing changed
+
+    python3 benchmarks/sync_benchmark.py --segments 100000 --nodes 50
+    python3 benchmarks/sync_benchmark.py --segments 5000000 --nodes 500 --no-tracemalloc
+'''
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+from trough import sync
+from trough.settings import settings
+
+class BenchHostRegistry(sync.HostRegistry):
+    # the real queries filter on heartbeat freshness with reql lambdas
+    def get_hosts(self, exclude_cold=True):
+        hosts = self.services.available_services('trough-nodes')
+        if exclude_cold:
+            hosts = [host for host in hosts if not host.get('cold_storage')]
+        return sorted(hosts, key=lambda host: host['id'])
+    def get_cold_hosts(self):
+        return [host for host in self.services.available_services('trough-nodes') if host.get('cold_storage')]
+
+class BenchMasterSyncController(sync.MasterSyncController):
+    def __init__(self, hdfs, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hdfs = hdfs
+    def get_segment_file_list(self):
+        return self.hdfs.listing()
+    def assigned_bytes_by_node(self):
+        assigned = {}
+        for asmt in self.rethinker.table('assignment').has_fields('node').run():
+            assigned[asmt['node']] = assigned.get(asmt['node'], 0) + asmt.get('bytes', 0)
+        return assigned
+
+class BenchLocalSyncController(sync.LocalSyncController):
+    def __init__(self, hdfs, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hdfs = hdfs
+    def get_segment_file_list(self):
+        return self.hdfs.listing()
+    def copy_segment_from_hdfs(self, segment, checksum=None):
+        with open(segment.local_path(), 'wb'):
+            pass
+        return True
+    def readable_copy_counts(self, segment_ids):
+        segment_ids = set(segment_ids)
+        counts = {}
+        for svc in self.services.available_services('trough-read'):
+            if svc.get('segment') in segment_ids and svc['node'] != self.hostname:
+                counts[svc['segment']] = counts.get(svc['segment'], 0) + 1
+        return counts
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.rethinker = fakes.FakeRethinker()
+        self.services = fakes.FakeServiceRegistry(self.rethinker)
+        self.registry = BenchHostRegistry(self.rethinker, self.services)
+        self.hdfs = fakes.FakeHDFS(settings['HDFS_PATH'])
+        self.next_segment_id = 0
+        self.results = []
+
+    def segment_size(self):
+        # most segments are small, a few are huge
+        return int(self.random.lognormvariate(14, 2))
+
+    def add_segments(self, n):
+        for i in range(n):
+            self.hdfs.add(str(self.next_segment_id), self.segment_size())
+            self.next_segment_id += 1
+
+    def add_nodes(self, n):
+        existing = len(self.services.available_services('trough-nodes'))
+        for i in range(existing, existing + n):
+            self.registry.heartbeat(
+                    pool='trough-nodes', node='node%04d.example.com' % i,
+                    ttl=600, available_bytes=self.random.choice((2, 4, 8)) * 1024**4)
+
+    def phase(self, name, fn):
+        ops_before = self.rethinker.ops.copy()
+        listings_before = self.hdfs.listings
+        if self.args.tracemalloc:
+            tracemalloc.start()
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        peak = None
+        if self.args.tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        ops = self.rethinker.ops - ops_before
+        self.results.append((name, elapsed, ops, self.hdfs.listings - listings_before, peak))
+        self.print_result(self.results[-1])
+
+    def print_result(self, result):
+        name, elapsed, ops, listings, peak = result
+        top = ', '.join('%s %s: %s' % (table, kind, n) for (table, kind), n in ops.most_common(3))
+        print('%-17s %9.2f s %9s queries %4s listings %10s   %s' % (
+            name, elapsed, sum(ops.values()), listings,
+            '%.1f MiB' % (peak / 1024**2) if peak is not None else '-', top))
+        sys.stdout.flush()
+
+    def run(self):
+        args = self.args
+        print('%s segments, %s nodes' % (args.segments, args.nodes))
+        print('%-17s %11s %17s %13s %10s   %s' % (
+            'phase', 'wall time', 'rethinkdb', 'hdfs', 'peak mem', 'top queries'))
+        self.add_segments(args.segments)
+        self.add_nodes(args.nodes)
+        master = BenchMasterSyncController(
+                self.hdfs, rethinker=self.rethinker, services=self.services,
+                registry=self.registry)
+        master.hostname = 'master.example.com'
+
+        self.phase('master-initial', master.assign_segments)
+        self.phase('master-steady', master.assign_segments)
+
+        churn = max(1, int(args.segments * args.churn))
+        def churn_corpus():
+            self.add_segments(churn)
+            ids = self.random.sample(sorted(self.hdfs.files), 2 * churn)
+            for segment_id in ids[:churn]:
+                self.hdfs.add(segment_id, self.segment_size())
+            for segment_id in ids[churn:]:
+                del self.hdfs.files[segment_id]
+        churn_corpus()
+        self.phase('master-churn', master.assign_segments)
+
+        self.add_nodes(max(1, args.nodes // 10))
+        self.phase('master-add-nodes', master.assign_segments)
+
+        gone = self.registry.get_hosts()[0]
+        self.services.unregister(gone['id'])
+        self.phase('master-rm-node', master.assign_segments)
+
+        node = self.registry.get_hosts()[0]['node']
+        with tempfile.TemporaryDirectory() as local_data, \
+                mock.patch.dict(settings, {
+                    'LOCAL_DATA': local_data, 'HOSTNAME': node,
+                    'SYNC_WAIT_FOR_DOWNLOADS': True}):
+            local = BenchLocalSyncController(
+                    self.hdfs, rethinker=self.rethinker,
+                    services=self.services, registry=self.registry)
+            local.local_data = local_data
+            self.phase('local-initial', local.sync)
+            self.phase('local-steady', local.sync)
+            self.phase('local-heartbeat-new', local.periodic_heartbeat)
+            self.phase('local-heartbeat', local.periodic_heartbeat)
+
+def main(argv=None):
+    argv = argv or sys.argv
+    arg_parser = argparse.ArgumentParser(
+            prog=argv[0], description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--segments', type=int, default=10000)
+    arg_parser.add_argument('--nodes', type=int, default=10)
+    arg_parser.add_argument(
+            '--churn', type=float, default=0.01,
+            help='fraction of segments added, resized and removed in the churn phase (default: 0.01)')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument(
+            '--no-tracemalloc', dest='tracemalloc', action='store_false',
+            help="don't measure memory (tracemalloc slows things down quite a bit)")
+    arg_parser.add_argument('-v', '--verbose', action='store_true')
+    args = arg_parser.parse_args(args=argv[1:])
+
+    logging.root.handlers = []
+    logging.basicConfig(
+            stream=sys.stderr,
+            level=logging.INFO if args.verbose else logging.WARNING,
+            format='%(asctime)s %(levelname)s %(message)s')
+    Benchmark(args).run()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+'''
+Moves the segments in LOCAL_DATA into the directory layout set by
+LOCAL_DATA_LAYOUT_DEPTH, after changing it, while trough keeps running on
+the node. Workers look for a segment in the new layout first and then in
+the top directory, so segments can be moved one at a time.
+
+Segments with a write lock on this node are left where they are, because
+sqlite keeps the journal of a database next to the path it was opened by,
+and are moved by a later run once they have been promoted. Run it again
+until it reports nothing left to move.
+'''
+import argparse
+import logging
+import os
+import sys
+import doublethink
+import trough
+from trough import local_index
+from trough.settings import settings
+
+def migrate(local_data, depth, locked, dry_run=False):
+    '''
+    Returns:
+        tuple (number of segments moved, number left where they are)
+    '''
+    moved = 0
+    skipped = 0
+    for segment_id, entry in local_index.scan(local_data):
+        dest = local_index.segment_path(local_data, segment_id, depth)
+        if entry.path == dest:
+            continue
+        if segment_id in locked or os.path.exists(entry.path + '-journal') \
+                or os.path.exists(entry.path + '-wal'):
+            logging.info('segment %s is being written to, leaving it at %s', segment_id, entry.path)
+            skipped += 1
+            continue
+        if dry_run:
+            logging.info('would move %s to %s', entry.path, dest)
+            moved += 1
+            continue
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            src_stat = os.stat(entry.path)
+        except FileNotFoundError:
+            continue
+        if os.path.exists(dest):
+            # a copy landed in both places, e.g. local sync wrote a new copy
+            # to the old path just as we moved the old copy; keep the newer
+            # one, unless it's an empty file left by a reader connecting to
+            # the old path just after it was moved
+            if src_stat.st_mtime > os.stat(dest).st_mtime and src_stat.st_size > 0:
+                logging.info('replacing %s with newer %s', dest, entry.path)
+                os.rename(entry.path, dest)
+            else:
+                logging.info('removing %s, %s is newer', entry.path, dest)
+                os.remove(entry.path)
+        else:
+            logging.info('moving %s to %s', entry.path, dest)
+            os.rename(entry.path, dest)
+        moved += 1
+    return moved, skipped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help="log what would be moved, but don't move anything")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.root.handlers = []
+    logging.basicConfig(
+            stream=sys.stdout,
+            level=logging.DEBUG if args.verbose else logging.INFO, format=(
+                '%(asctime)s %(levelname)s %(name)s.%(funcName)s'
+                '(%(filename)s:%(lineno)d) %(message)s'))
+
+    rethinker = doublethink.Rethinker(db="trough_configuration", servers=settings['RETHINKDB_HOSTS'])
+    locked = {lock.segment for lock in trough.sync.Lock.host_locks(rethinker, settings['HOSTNAME'])}
+    moved, skipped = migrate(
+            settings['LOCAL_DATA'], settings['LOCAL_DATA_LAYOUT_DEPTH'],
+            locked, dry_run=args.dry_run)
+    logging.info(
+            '%s %s segments into layout with depth %s, %s left to move later',
+            'would move' if args.dry_run else 'moved', moved,
+            settings['LOCAL_DATA_LAYOUT_DEPTH'], skipped)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+'''
+Replays a segment listing and a list of hosts through the sync master's
+hash ring placement, offline, and reports how full each host would be and
+how many bytes would move.
+
+The segment listing has one segment per line, either "<path> <size>" or a
+json object with "name" and "size" (like an hdfs listing). The host list
+has one "<hostname> <capacity in bytes>" per line.
+
+Examples:
+
+    # how evenly would these hosts fill up?
+    placement_simulator.py segments.txt hosts.txt
+
+    # what would adding hosts move, and what would weight rebalancing do?
+    placement_simulator.py segments.txt new-hosts.txt \\
+            --current-hosts hosts.txt --rebalance-rounds 3
+'''
+import argparse
+import collections
+import json
+import logging
+import statistics
+import sys
+from trough import placement
+
+def read_segments(path):
+    segments = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                name, size = entry['name'], entry['size']
+            else:
+                name, size = line.rsplit(None, 1)
+            segment_id = name.split('/')[-1].replace('.sqlite.zst', '').replace('.sqlite', '')
+            segments.append((segment_id, int(size)))
+    return segments
+
+def read_hosts(path):
+    capacities = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                hostname, capacity = line.split()
+                capacities[hostname] = int(capacity)
+    return capacities
+
+class Simulation:
+    def __init__(self, segments, copies):
+        self.segments = segments
+        self.copies = copies
+        self.host_ring_mapping = {}
+
+    def place(self, capacities):
+        '''
+        Returns { (segment_id, ring_id): node } for the hosts in
+        `capacities`, updating the ring mapping the way the sync master
+        would.
+        '''
+        hash_rings = placement.build_hash_rings(
+                self.host_ring_mapping, capacities,
+                min(self.copies, len(capacities)))
+        engine = placement.PlacementEngine(hash_rings)
+        segment_ids = [segment_id for segment_id, size in self.segments]
+        placements = engine.place(
+                segment_ids, [len(hash_rings)] * len(segment_ids))
+        layout = {}
+        for segment_id, segment_placements in zip(segment_ids, placements):
+            for ring, node in segment_placements:
+                layout[(segment_id, ring.id)] = node
+        return layout
+
+    def assigned_bytes(self, layout):
+        sizes = dict(self.segments)
+        assigned = collections.Counter()
+        for (segment_id, ring_id), node in layout.items():
+            assigned[node] += sizes[segment_id]
+        return assigned
+
+    def movement(self, before, after):
+        sizes = dict(self.segments)
+        moved = [key for key, node in after.items() if before.get(key) != node]
+        return len(moved), sum(sizes[segment_id] for segment_id, ring_id in moved)
+
+def human(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(n) < 1024 or unit == 'TiB':
+            return '%.1f %s' % (n, unit)
+        n /= 1024
+
+def report(title, simulation, capacities, layout, out=sys.stdout):
+    assigned = simulation.assigned_bytes(layout)
+    print('== %s ==' % title, file=out)
+    print('%-40s %4s %12s %12s %12s %7s' % (
+        'host', 'ring', 'weight', 'capacity', 'assigned', 'full'), file=out)
+    utilizations = []
+    for hostname in sorted(capacities, key=lambda h: (simulation.host_ring_mapping[h]['ring'], h)):
+        host = simulation.host_ring_mapping[hostname]
+        utilization = assigned[hostname] / capacities[hostname] if capacities[hostname] else 0
+        utilizations.append(utilization)
+        print('%-40s %4s %12s %12s %12s %6.1f%%' % (
+            hostname, host['ring'], host['weight'],
+            human(capacities[hostname]), human(assigned[hostname]),
+            100 * utilization), file=out)
+    mean = statistics.mean(utilizations)
+    print('utilization: mean %.1f%% min %.1f%% max %.1f%% stdev %.1f%% skew (max/mean) %.2f' % (
+        100 * mean, 100 * min(utilizations), 100 * max(utilizations),
+        100 * statistics.pstdev(utilizations),
+        max(utilizations) / mean if mean else 0), file=out)
+    return assigned
+
+def print_movement(simulation, before, after, out=sys.stdout):
+    moved, moved_bytes = simulation.movement(before, after)
+    print('moved: %s segment copies, %s' % (moved, human(moved_bytes)), file=out)
+
+def main(argv=None):
+    argv = argv or sys.argv
+    arg_parser = argparse.ArgumentParser(
+            prog=argv[0], description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('segments', help='segment listing file')
+    arg_parser.add_argument('hosts', help='host list file')
+    arg_parser.add_argument(
+            '--current-hosts', help=(
+                'host list of the cluster as it is now; if supplied, report '
+                'what changing to HOSTS would move'))
+    arg_parser.add_argument(
+            '--copies', type=int, default=2,
+            help='copies of each segment (number of hash rings) (default: 2)')
+    arg_parser.add_argument(
+            '--rebalance-rounds', type=int, default=0,
+            help='rounds of weight rebalancing to simulate (default: 0)')
+    arg_parser.add_argument(
+            '--threshold', type=float, default=0.1,
+            help='weight rebalancing threshold (default: 0.1)')
+    arg_parser.add_argument('-v', '--verbose', action='store_true')
+    args = arg_parser.parse_args(args=argv[1:])
+
+    logging.basicConfig(
+            stream=sys.stderr,
+            level=logging.INFO if args.verbose else logging.WARNING,
+            format='%(asctime)s %(levelname)s %(message)s')
+
+    simulation = Simulation(read_segments(args.segments), args.copies)
+    print('%s segments, %s total' % (
+        len(simulation.segments),
+        human(sum(size for segment_id, size in simulation.segments))))
+
+    layout = {}
+    if args.current_hosts:
+        current_hosts = read_hosts(args.current_hosts)
+        layout = simulation.place(current_hosts)
+        report('current hosts', simulation, current_hosts, layout)
+
+    capacities = read_hosts(args.hosts)
+    new_layout = simulation.place(capacities)
+    assigned = report('hosts', simulation, capacities, new_layout)
+    if args.current_hosts:
+        print_movement(simulation, layout, new_layout)
+    layout = new_layout
+
+    for i in range(args.rebalance_rounds):
+        changed = placement.rebalance_weights(
+                simulation.host_ring_mapping, capacities, assigned,
+                args.threshold)
+        if not changed:
+            print('rebalancing round %s: no weights changed' % (i + 1))
+            break
+        new_layout = simulation.place(capacities)
+        assigned = report(
+                'after rebalancing round %s (%s weights changed)' % (
+                    i + 1, len(changed)),
+                simulation, capacities, new_layout)
+        print_movement(simulation, layout, new_layout)
+        layout = new_layout
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -40,4 +40,4 @@ if __name__ == '__main__':
         sleep_time = settings['SYNC_LOOP_TIMING'] - loop_duration.total_seconds()
         sleep_time = sleep_time if sleep_time > 0 else 0
         logging.info('Sleeping for %s seconds' % round(sleep_time))
-        time.sleep(sleep_time)
+        controller.sleep(sleep_time)
@@ -0,0 +1,105 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+import time
+import threading
+from concurrent import futures
+import trough.client
+
+class TestTroughClient(unittest.TestCase):
+    @mock.patch('trough.client.doublethink.ServiceRegistry')
+    def make_client(self, ServiceRegistry):
+        return trough.client.TroughClient(
+                'rethinkdb://localhost/trough_configuration')
+
+    def test_read_many(self):
+        cli = self.make_client()
+        def read(segment_id, sql_tmpl, values=()):
+            if segment_id == 'bad':
+                raise trough.client.TroughSegmentNotFound(segment_id)
+            # make the first segment finish last
+            time.sleep(0.2 if segment_id == 'slow' else 0)
+            return [{'segment': segment_id}]
+        cli.read = read
+        cli.read_urls = mock.Mock()
+
+        results = list(cli.read_many(
+            ['slow', 'bad', 'fast'], 'select 1', max_workers=3))
+        cli.read_urls.assert_called_once_with(['slow', 'bad', 'fast'])
+        assert [res.segment for res in results] == ['slow', 'bad', 'fast']
+        assert results[0].result == [{'segment': 'slow'}]
+        assert results[0].error is None
+        assert results[1].result is None
+        assert isinstance(results[1].error, trough.client.TroughSegmentNotFound)
+        assert results[2].result == [{'segment': 'fast'}]
+
+        results = list(cli.read_many(
+            ['slow', 'bad', 'fast'], 'select 1', max_workers=3,
+            ordered=False))
+        assert results[-1].segment == 'slow'
+        assert {res.segment for res in results} == {'slow', 'bad', 'fast'}
+
+    def test_read_many_skips_cached_urls(self):
+        cli = self.make_client()
+        cli.read = lambda segment_id, sql_tmpl, values=(): []
+        cli.read_urls = mock.Mock()
+        cli._read_url_cache['cached'] = 'http://example.com:6444/?segment=cached'
+        list(cli.read_many(['cached', 'uncached'], 'select 1'))
+        cli.read_urls.assert_called_once_with(['uncached'])
+
+    def test_promotion(self):
+        cli = self.make_client()
+        cli.promotion_interval = 0.1
+        cli._promotion_pool = futures.ThreadPoolExecutor(max_workers=2)
+        slow_started = threading.Event()
+        release_slow = threading.Event()
+        promoted = []
+        def promote(segment_id):
+            if segment_id == 'bad':
+                raise trough.client.TroughException('oh no')
+            if segment_id == 'slow':
+                slow_started.set()
+                release_slow.wait()
+            promoted.append(segment_id)
+        cli.promote = promote
+
+        cli._dirty_segments = {'slow': time.time(), 'bad': time.time()}
+        cli._start_promotions()
+        slow_started.wait()
+        # dirtied again mid-promotion
+        cli._dirty_segments['slow'] = time.time()
+        cli._dirty_segments['fast'] = time.time()
+        cli._start_promotions()
+        # 'fast' is not held up by 'slow', 'slow' is not promoted twice at once
+        for i in range(50):
+            if promoted == ['fast']:
+                break
+            time.sleep(0.01)
+        assert promoted == ['fast']
+        status = cli.promotion_status()
+        assert status['slow']['in_flight']
+        assert status['slow']['dirty_for'] is not None
+        assert status['bad']['failures'] == 1
+        assert not status['bad']['in_flight']
+        assert status['fast']['last_lag'] is not None
+        assert status['fast']['dirty_for'] is None
+
+        # 'bad' is backing off, 'slow' is still in flight
+        cli._start_promotions()
+        assert cli._promotions_in_flight.keys() == {'slow'}
+
+        release_slow.set()
+        for i in range(50):
+            if not cli._promotions_in_flight:
+                break
+            time.sleep(0.01)
+        # 'slow' was dirtied mid-promotion so it gets promoted once more
+        assert 'slow' in cli._dirty_segments
+        cli._start_promotions()
+        cli._promotion_pool.shutdown(wait=True)
+        assert promoted == ['fast', 'slow', 'slow']
+
+if __name__ == '__main__':
+    unittest.main()
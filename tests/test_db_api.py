@@ -0,0 +1,110 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+import io
+from trough import db_api
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, body, status=200, headers={}):
+        super().__init__(body)
+        self.status = status
+        self.headers = headers
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+class TestTroughCursor(unittest.TestCase):
+    def setUp(self):
+        self.conn = db_api.connect(database='test-segment', rethinkdb=['localhost'])
+        self.conn._router = mock.Mock()
+        self.conn._router.read_url.return_value = 'http://example.com:6444/?segment=test-segment'
+        self.conn._router.write_url.return_value = 'http://example.com:6222/?segment=test-segment'
+        self.http_conn = mock.Mock()
+        self.http_conn.sock = object()
+        self.http_conn._trough_netloc = 'example.com:6444'
+
+    def test_streaming_fetch(self):
+        body = b'[{"id":1,"test":"a"},\n{"id":2,"test":"b"},\n{"id":3,"test":null}]\n'
+        response = FakeResponse(body, headers={'X-Trough-Columns': '["id","test"]'})
+        self.conn._open = mock.Mock(return_value=(self.http_conn, response))
+        cursor = self.conn.cursor()
+        cursor.execute('select * from test where test != %s', ("it's",))
+        self.conn._open.assert_called_once_with(
+                'http://example.com:6444/?segment=test-segment',
+                b"select * from test where test != 'it''s'")
+        assert [d[0] for d in cursor.description] == ['id', 'test']
+        assert cursor.fetchone() == (1, 'a')
+        # rest of the response has not been parsed yet
+        assert response.tell() < len(body)
+        assert cursor.fetchmany(5) == [(2, 'b'), (3, None)]
+        assert cursor.fetchone() is None
+        # http connection is kept alive for reuse
+        assert self.conn._idle['example.com:6444'] == [self.http_conn]
+
+    def test_empty_result(self):
+        response = FakeResponse(b'[]\n', headers={'X-Trough-Columns': '["id","test"]'})
+        self.conn._open = mock.Mock(return_value=(self.http_conn, response))
+        cursor = self.conn.cursor()
+        cursor.execute('select * from test')
+        assert [d[0] for d in cursor.description] == ['id', 'test']
+        assert cursor.fetchall() == []
+
+    def test_columns_from_first_row(self):
+        response = FakeResponse(b'[{"b":1,"a":2}]\n')
+        self.conn._open = mock.Mock(return_value=(self.http_conn, response))
+        cursor = self.conn.cursor()
+        cursor.execute('select b, a from test')
+        assert [d[0] for d in cursor.description] == ['b', 'a']
+        assert list(cursor) == [(1, 2)]
+
+    def test_truncated_result(self):
+        response = FakeResponse(b'[{"id":1},\n{"id":2},\n')
+        self.conn._open = mock.Mock(return_value=(self.http_conn, response))
+        cursor = self.conn.cursor()
+        cursor.execute('select id from test')
+        with self.assertRaises(db_api.OperationalError):
+            cursor.fetchall()
+        self.http_conn.close.assert_called_once_with()
+
+    def test_executemany(self):
+        self.conn._request = mock.Mock(return_value=(200, b'OK\n'))
+        cursor = self.conn.cursor()
+        cursor.executemany(
+                'insert into test (id, test) values (%s, %s);',
+                [(1, 'a'), (2, None)])
+        self.conn._request.assert_called_once_with(
+                'http://example.com:6222/?segment=test-segment',
+                b"insert into test (id, test) values (1, 'a');\n"
+                b"insert into test (id, test) values (2, null);\n")
+
+        self.conn._request.reset_mock()
+        with mock.patch('trough.db_api.MAX_WRITE_BATCH_BYTES', 80):
+            cursor.executemany(
+                    'insert into test (id) values (%s)', [(1,), (2,), (3,)])
+        assert self.conn._request.call_count == 2
+
+        with self.assertRaises(db_api.ProgrammingError):
+            cursor.executemany('select * from test where id = %s', [(1,)])
+
+    def test_executescript(self):
+        self.conn._request = mock.Mock(return_value=(200, b'OK\n'))
+        cursor = self.conn.cursor()
+        with self.assertRaises(db_api.ProgrammingError):
+            cursor.executescript('select * from test; delete from test;')
+        with self.assertRaises(db_api.NotSupportedError):
+            cursor.executescript('select * from test; select 1;')
+        cursor.executescript('delete from test; insert into test (id) values (1);')
+        self.conn._request.assert_called_once_with(
+                'http://example.com:6222/?segment=test-segment',
+                b'delete from test; insert into test (id) values (1);')
+
+    def test_write_failure(self):
+        self.conn._request = mock.Mock(return_value=(500, b'500 Server Error: oops\n'))
+        cursor = self.conn.cursor()
+        with self.assertRaises(db_api.OperationalError):
+            cursor.execute('delete from test')
+        self.conn._router.invalidate.assert_called_once_with('test-segment')
+
+if __name__ == '__main__':
+    unittest.main()
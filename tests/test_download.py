@@ -0,0 +1,97 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+import threading
+import time
+from trough.download import Download, DownloadScheduler, TokenBucket
+
+class TestTokenBucket(unittest.TestCase):
+    def test_reserve(self):
+        with mock.patch('time.monotonic', return_value=100.0) as monotonic:
+            bucket = TokenBucket(rate=100, burst=200)
+            assert bucket.reserve(150) == 0
+            # 50 left, goes into debt
+            assert bucket.reserve(250) == 0
+            # ... which the next reservation waits out
+            assert bucket.reserve(10) == 2.0
+            monotonic.return_value = 103.0
+            # 300 tokens later: -210 + 300 = 90
+            assert bucket.reserve(10) == 0
+            assert bucket.tokens == 80
+
+class TestDownloadScheduler(unittest.TestCase):
+    def test_priority(self):
+        done = []
+        release = threading.Event()
+        def blocker():
+            release.wait()
+            return True
+        def fn(key):
+            return lambda: done.append(key) or True
+        scheduler = DownloadScheduler(threads=1)
+        # keep the worker busy while we queue things up
+        scheduler.schedule([Download('blocker', 0, (0,), blocker)])
+        time.sleep(0.1)
+        scheduler.schedule([
+            Download('blocker', 0, (0,), blocker),
+            Download('c', 10, (3,), fn('c')),
+            Download('a', 10, (1,), fn('a')),
+            Download('b', 10, (2,), fn('b')),
+            Download('dropped', 10, (0,), fn('dropped')),
+        ])
+        status = scheduler.status()
+        assert status['queued'] == 4
+        assert status['running'] == 1
+        assert status['bytes_remaining'] == 40
+        scheduler.schedule([
+            Download('blocker', 0, (0,), blocker),
+            Download('c', 10, (0,), fn('c')),
+            Download('a', 10, (1,), fn('a')),
+            Download('b', 10, (2,), fn('b')),
+        ])
+        release.set()
+        assert scheduler.join(timeout=5)
+        assert done == ['c', 'a', 'b']
+        assert scheduler.status()['queued'] == 0
+
+    def test_retry(self):
+        attempts = []
+        def flaky():
+            attempts.append(time.time())
+            if len(attempts) < 3:
+                raise Exception('hdfs is down')
+            return True
+        scheduler = DownloadScheduler(threads=1, retry_delay=0.1, max_retry_delay=0.15)
+        with mock.patch('trough.download.logging.error'):
+            scheduler.schedule([Download('flaky', 10, (0,), flaky)])
+            # join() doesn't wait for retries
+            assert scheduler.join(timeout=5)
+            assert len(attempts) == 1
+            assert scheduler.status()['retrying'] == 1
+            # a new schedule() keeps track of attempts so far
+            scheduler.schedule([Download('flaky', 10, (0,), flaky)])
+            time.sleep(0.5)
+        assert len(attempts) == 3
+        assert attempts[1] - attempts[0] >= 0.1
+        assert attempts[2] - attempts[1] >= 0.15
+        assert scheduler.status()['queued'] == 0
+
+    def test_rate_limit(self):
+        done = threading.Event()
+        scheduler = DownloadScheduler(
+                threads=1, max_bytes_per_sec=1000,
+                max_bytes_per_sec_per_datanode=100,
+                locate=lambda source: {'datanode1': 110})
+        scheduler.schedule([
+            Download('1', 1000, (0,), lambda: True, source='/1.sqlite'),
+            Download('2', 10, (1,), lambda: done.set() or True, source='/2.sqlite')])
+        start = time.time()
+        assert done.wait(5)
+        # second download waited for the first's datanode debt of 10 bytes at
+        # 100 bytes per sec
+        assert time.time() - start >= 0.1
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+import random
+import string
+import time
+import doublethink
+import rethinkdb as r
+from trough.lease import Lease
+from trough.settings import settings
+
+random_db = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
+
+class TestLease(unittest.TestCase):
+    def setUp(self):
+        self.rethinker = doublethink.Rethinker(db=random_db, servers=settings['RETHINKDB_HOSTS'])
+        Lease.table_ensure(self.rethinker)
+        self.rethinker.table(Lease.table).delete().run()
+        if 'fenced' not in self.rethinker.table_list().run():
+            self.rethinker.table_create('fenced').run()
+        self.rethinker.table('fenced').delete().run()
+    def test_renew(self):
+        first = Lease(self.rethinker, 'test-lease', node='first', ttl=0.5)
+        second = Lease(self.rethinker, 'test-lease', node='second', ttl=0.5)
+        self.assertTrue(first.renew())
+        self.assertEqual(first.token, 1)
+        self.assertTrue(first.held)
+        self.assertFalse(second.renew())
+        self.assertFalse(second.held)
+        # renewing keeps the same token
+        self.assertTrue(first.renew())
+        self.assertEqual(first.token, 1)
+        # lapsed, somebody else takes over with a new token
+        time.sleep(0.6)
+        self.assertFalse(first.held)
+        self.assertTrue(second.renew())
+        self.assertEqual(second.token, 2)
+        self.assertFalse(first.renew())
+        self.assertIsNone(first.token)
+    def test_release(self):
+        first = Lease(self.rethinker, 'test-lease', node='first', ttl=60)
+        second = Lease(self.rethinker, 'test-lease', node='second', ttl=60)
+        self.assertTrue(first.renew())
+        self.assertFalse(second.renew())
+        first.release()
+        self.assertFalse(first.held)
+        self.assertTrue(second.renew())
+        self.assertEqual(second.token, 2)
+    def test_fence(self):
+        first = Lease(self.rethinker, 'test-lease', node='first', ttl=0.2)
+        second = Lease(self.rethinker, 'test-lease', node='second', ttl=60)
+        first.renew()
+        first.fence(r.table('fenced').insert({'id': 'a'})).run()
+        time.sleep(0.3)
+        second.renew()
+        # first doesn't know it lost the lease yet
+        self.assertEqual(first.token, 1)
+        with self.assertRaises(r.ReqlRuntimeError):
+            first.fence(r.table('fenced').insert({'id': 'b'})).run()
+        second.fence(r.table('fenced').insert({'id': 'c'})).run()
+        self.assertEqual(sorted(self.rethinker.table('fenced')['id'].run()), ['a', 'c'])
+    def test_takeover(self):
+        first = Lease(self.rethinker, 'test-lease', node='first', ttl=1)
+        second = Lease(self.rethinker, 'test-lease', node='second', ttl=1)
+        first.start()
+        self.assertTrue(first.acquired.wait(5))
+        second.start()
+        # standby doesn't take over while the lease is being renewed
+        time.sleep(1.5)
+        self.assertTrue(first.held)
+        self.assertFalse(second.held)
+        # ... but does as soon as it is released
+        first.release()
+        self.assertTrue(second.acquired.wait(5))
+        self.assertEqual(second.token, 2)
+        second.release()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+import shutil
+import tempfile
+from trough import local_index
+from trough.local_index import LocalSegmentIndex
+
+class TestLayout(unittest.TestCase):
+    def test_segment_path(self):
+        self.assertEqual(local_index.segment_path('/data', 'abc'), '/data/abc.sqlite')
+        path = local_index.segment_path('/data', 'abc', 2)
+        parts = path.split('/')
+        self.assertEqual(parts[-1], 'abc.sqlite')
+        self.assertTrue(all(local_index.SUBDIR_RE.match(part) for part in parts[2:4]))
+        self.assertEqual(path, local_index.segment_path('/data', 'abc', 2))
+
+    def test_scan(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for segment_id, depth in (('a', 0), ('b', 1), ('c', 2)):
+                path = local_index.segment_path(directory, segment_id, depth)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb'):
+                    pass
+            os.makedirs(os.path.join(directory, 'lost+found'))
+            with open(os.path.join(directory, 'lost+found', 'd.sqlite'), 'wb'):
+                pass
+            found = {segment_id: entry.path for segment_id, entry in local_index.scan(directory)}
+            self.assertEqual(sorted(found), ['a', 'b', 'c'])
+            self.assertEqual(found['c'], local_index.segment_path(directory, 'c', 2))
+
+@unittest.skipUnless(LocalSegmentIndex.available(), 'inotify_simple module not available')
+class TestLocalSegmentIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = LocalSegmentIndex(self.directory)
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+    def write(self, filename, data=b'x'):
+        with open(os.path.join(self.directory, filename), 'wb') as f:
+            f.write(data)
+
+    def test_build(self):
+        self.write('a.sqlite', b'aaa')
+        self.write('b.sqlite')
+        self.write('b.sqlite-journal')
+        self.write('notes.txt')
+        segments = self.index.segments()
+        self.assertEqual(sorted(segments), ['a', 'b'])
+        self.assertEqual(segments['a'].size, 3)
+        st = os.stat(os.path.join(self.directory, 'a.sqlite'))
+        self.assertEqual(segments['a'].mtime, st.st_mtime)
+        self.assertEqual(segments['a'].inode, st.st_ino)
+
+    def test_follows_changes(self):
+        self.write('a.sqlite')
+        self.write('b.sqlite')
+        self.index.segments()
+        with mock.patch('os.scandir') as scandir:
+            # changes made behind our back
+            self.write('c.sqlite', b'ccc')
+            os.remove(os.path.join(self.directory, 'a.sqlite'))
+            os.utime(os.path.join(self.directory, 'b.sqlite'), times=(1000, 1000))
+            self.write('d.tmp')
+            os.rename(
+                    os.path.join(self.directory, 'd.tmp'),
+                    os.path.join(self.directory, 'd.sqlite'))
+            segments = self.index.segments()
+            self.assertFalse(scandir.called)
+        self.assertEqual(sorted(segments), ['b', 'c', 'd'])
+        self.assertEqual(segments['b'].mtime, 1000)
+        self.assertEqual(segments['c'].size, 3)
+
+    def test_layout(self):
+        self.index.depth = 1
+        self.write('a.sqlite')
+        self.index.segments()
+        # migrated to a new hash prefix directory behind our back
+        path = local_index.segment_path(self.directory, 'a', 1)
+        os.makedirs(os.path.dirname(path))
+        os.rename(os.path.join(self.directory, 'a.sqlite'), path)
+        segments = self.index.segments()
+        self.assertEqual(segments['a'].path, path)
+        # ... and a new segment in another new directory
+        os.makedirs(os.path.dirname(local_index.segment_path(self.directory, 'b', 1)), exist_ok=True)
+        with open(local_index.segment_path(self.directory, 'b', 1), 'wb'):
+            pass
+        self.assertEqual(self.index.segments()['b'].path, local_index.segment_path(self.directory, 'b', 1))
+        os.remove(path)
+        self.index.update('a')
+        self.assertNotIn('a', self.index.segments())
+
+    def test_update(self):
+        self.write('a.sqlite')
+        self.index.segments()
+        os.remove(os.path.join(self.directory, 'a.sqlite'))
+        self.index.update('a')
+        self.assertEqual(self.index._segments, {})
+        self.index.update('never-existed')
+        self.assertEqual(self.index.segments(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+import random
+import string
+import doublethink
+import rethinkdb as r
+from trough import membership
+from trough.membership import SegmentMembership, MembershipPublisher
+from trough.settings import settings
+
+random_db = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
+
+class TestSegmentMembership(unittest.TestCase):
+    def setUp(self):
+        self.rethinker = doublethink.Rethinker(db=random_db, servers=settings['RETHINKDB_HOSTS'])
+        self.services = doublethink.ServiceRegistry(self.rethinker)
+        SegmentMembership.table_ensure(self.rethinker)
+        if 'services' not in self.rethinker.table_list().run():
+            self.rethinker.table_create('services').run()
+            self.rethinker.table('services').index_create('segment').run()
+            self.rethinker.table('services').index_wait('segment').run()
+        self.rethinker.table(SegmentMembership.table).delete().run()
+        self.rethinker.table('services').delete().run()
+
+    def heartbeat_node(self, node, ttl=60):
+        self.services.heartbeat({
+            'id': membership.node_service_id(node), 'role': 'trough-nodes',
+            'node': node, 'ttl': ttl, 'load': 0.5})
+
+    def read_services(self, segment_ids):
+        return sorted(
+                (svc['segment'], svc['node'], svc['url'])
+                for svc in membership.read_services_query(self.rethinker, segment_ids).run())
+
+    def test_bucket(self):
+        self.assertEqual(membership.bucket('1234', 64), membership.bucket(1234, 64))
+        self.assertTrue(0 <= membership.bucket('1234', 64) < 64)
+
+    def test_publish(self):
+        self.heartbeat_node('node01')
+        publisher = MembershipPublisher(self.rethinker, 'node01', 6444, buckets=4)
+        self.assertEqual(publisher.publish(['a', 'b', 'c']), (4, 0))
+        self.assertEqual(self.read_services(['a', 'b', 'z']), [
+            ('a', 'node01', 'http://node01:6444/?segment=a'),
+            ('b', 'node01', 'http://node01:6444/?segment=b')])
+        # only the buckets that changed are updated
+        self.assertEqual(publisher.publish(['a', 'b', 'c']), (0, 0))
+        changed = {membership.bucket('c', 4), membership.bucket('d', 4)}
+        self.assertEqual(publisher.publish(['a', 'b', 'd']), (0, len(changed)))
+        self.assertEqual(SegmentMembership.nodes(self.rethinker, 'd'), {'node01'})
+        self.assertEqual(SegmentMembership.nodes(self.rethinker, 'c'), set())
+
+    def test_others_changes(self):
+        self.heartbeat_node('node01')
+        publisher = MembershipPublisher(self.rethinker, 'node01', 6444, buckets=1)
+        publisher.publish(['a', 'b'])
+        # provisioned and deleted behind the publisher's back
+        SegmentMembership.add(self.rethinker, 'node01', 'new', 6444, buckets=1)
+        self.assertTrue(SegmentMembership.remove(self.rethinker, 'node01', 'b', buckets=1))
+        self.assertFalse(SegmentMembership.remove(self.rethinker, 'node01', 'b', buckets=1))
+        self.assertEqual(publisher.publish(['a', 'c']), (1, 0))
+        self.assertEqual([svc[0] for svc in self.read_services(['a', 'b', 'c', 'new'])], ['a', 'c', 'new'])
+        # sync has caught up with the new segment by now
+        self.assertEqual(publisher.publish(['a', 'c', 'new']), (0, 0))
+
+    def test_write_skipped(self):
+        self.heartbeat_node('node01')
+        publisher = MembershipPublisher(self.rethinker, 'node01', 6444, buckets=1)
+        publisher.publish(['a', 'b'])
+        published = publisher._published[0]
+        # somebody else gets to the record between our read and our write
+        SegmentMembership.add(self.rethinker, 'node01', 'new', 6444, buckets=1)
+        publisher._write({0: (published[0], 'v2', {'a'}, {
+            'id': SegmentMembership.record_id('node01', 0),
+            'add': [], 'remove': ['b'], 'version': 'v2'})})
+        # what we remember is what was actually written
+        self.assertEqual(publisher._published[0], published)
+        self.assertEqual(SegmentMembership.nodes(self.rethinker, 'b'), {'node01'})
+
+    def test_node_health(self):
+        self.heartbeat_node('node01')
+        self.heartbeat_node('node02', ttl=-1)
+        SegmentMembership.add(self.rethinker, 'node01', 'a', 6444, buckets=4)
+        SegmentMembership.add(self.rethinker, 'node02', 'a', 6444, buckets=4)
+        SegmentMembership.add(self.rethinker, 'node03', 'a', 6444, buckets=4)
+        # per-segment services are still found too
+        self.services.heartbeat({
+            'id': 'trough-read:node04:a', 'role': 'trough-read', 'node': 'node04',
+            'segment': 'a', 'url': 'http://node04:6444/?segment=a', 'ttl': 60})
+        self.assertEqual([svc[1] for svc in self.read_services(['a'])], ['node01', 'node04'])
+        regex = [svc['node'] for svc in membership.all_read_services_query(self.rethinker, '^a$').run()]
+        self.assertEqual(sorted(regex), ['node01', 'node04'])
+        SegmentMembership.remove_everywhere(self.rethinker, 'a')
+        self.assertEqual(SegmentMembership.nodes(self.rethinker, 'a'), set())
+
+if __name__ == '__main__':
+    unittest.main()
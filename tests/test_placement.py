@@ -0,0 +1,107 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+import random
+from uhashring import HashRing
+from trough import placement
+
+def make_hash_rings(ring_count, nodes_per_ring):
+    hash_rings = []
+    for i in range(ring_count):
+        ring = HashRing()
+        ring.id = i
+        for j in range(nodes_per_ring):
+            ring.add_node('host-%s-%s' % (i, j), {'weight': 1024 * (j + 1)})
+        hash_rings.append(ring)
+    return hash_rings
+
+def reference_placement(hash_rings, segment_id, copies):
+    # the way MasterSyncController.assign_segments used to do it
+    random.seed(segment_id)
+    assigned_rings = random.sample(hash_rings, copies)
+    return [(ring, ring.get_node(segment_id)) for ring in assigned_rings]
+
+class TestPlacementEngine(unittest.TestCase):
+    def check_compatibility(self, hash_rings):
+        segment_ids = [str(i) for i in range(2000)] + ['x', 'segment-é', '']
+        copies = [1 + i % len(hash_rings) for i in range(len(segment_ids))]
+        engine = placement.PlacementEngine(hash_rings)
+        placements = engine.place(segment_ids, copies)
+        assert len(placements) == len(segment_ids)
+        for segment_id, n, result in zip(segment_ids, copies, placements):
+            expected = reference_placement(hash_rings, segment_id, n)
+            assert sorted((ring.id, node) for ring, node in result) == sorted(
+                    (ring.id, node) for ring, node in expected)
+
+    def test_compatibility(self):
+        self.check_compatibility(make_hash_rings(3, 7))
+        self.check_compatibility(make_hash_rings(1, 1))
+
+    def test_compatibility_without_numpy(self):
+        with mock.patch('trough.placement.numpy', None):
+            self.check_compatibility(make_hash_rings(3, 7))
+
+    def test_empty_ring(self):
+        hash_rings = make_hash_rings(2, 0)
+        result = placement.PlacementEngine(hash_rings).place(['1'], [2])
+        assert sorted(ring.id for ring, node in result[0]) == [0, 1]
+        assert [node for ring, node in result[0]] == [None, None]
+
+    def test_ketama_hash(self):
+        ring = HashRing()
+        for key in ('1', 'abc', 'segment-é'):
+            assert placement.ketama_hash(key) == ring.get_key(key)
+
+    def test_segment_shard(self):
+        segment_ids = [str(i) for i in range(1000)]
+        assert {placement.segment_shard(i, 1) for i in segment_ids} == {0}
+        shards = [placement.segment_shard(i, 4) for i in segment_ids]
+        assert set(shards) == {0, 1, 2, 3}
+        assert shards == [placement.segment_shard(i, 4) for i in segment_ids]
+        assert min(shards.count(shard) for shard in range(4)) > 200
+
+class TestRingMembership(unittest.TestCase):
+    def test_build_hash_rings(self):
+        host_ring_mapping = {
+            'id': 'ring-assignments',
+            'a': {'ring': 0, 'weight': 300},
+            'b': {'ring': 1, 'weight': 100},
+            'gone': {'ring': 1, 'weight': 100},
+            'stale-ring': {'ring': 5, 'weight': 100},
+        }
+        capacities = {'a': 400, 'b': 100, 'c': 100, 'd': 100, 'stale-ring': 50}
+        hash_rings = placement.build_hash_rings(host_ring_mapping, capacities, 2)
+        assert [ring.id for ring in hash_rings] == [0, 1]
+        assert 'gone' not in host_ring_mapping
+        assert host_ring_mapping['id'] == 'ring-assignments'
+        # new hosts go on the ring with the least capacity, not the fewest
+        # hosts: ring 1 has 100 bytes, then 200, then 300, ring 0 has 400
+        assert host_ring_mapping['c'] == {'ring': 1, 'weight': 100}
+        assert host_ring_mapping['d'] == {'ring': 1, 'weight': 100}
+        assert host_ring_mapping['stale-ring'] == {'ring': 1, 'weight': 50}
+        assert set(hash_rings[0].get_nodes()) == {'a'}
+        assert set(hash_rings[1].get_nodes()) == {'b', 'c', 'd', 'stale-ring'}
+
+    def test_rebalance_weights(self):
+        host_ring_mapping = {
+            'a': {'ring': 0, 'weight': 100},
+            'b': {'ring': 0, 'weight': 100},
+            'c': {'ring': 0, 'weight': 100},
+            'new': {'ring': 0, 'weight': 100},
+            'other-ring': {'ring': 1, 'weight': 100},
+        }
+        capacities = {'a': 100, 'b': 100, 'c': 100, 'new': 100, 'other-ring': 100}
+        assigned_bytes = {'a': 60, 'b': 36, 'c': 36, 'other-ring': 90}
+        changed = placement.rebalance_weights(
+                host_ring_mapping, capacities, assigned_bytes, 0.1)
+        # ring 0 average is 132 / 400 = 33% full
+        assert sorted(changed) == ['a']
+        assert host_ring_mapping['a']['weight'] == int(100 * 0.33 / 0.6)
+        assert host_ring_mapping['b']['weight'] == 100
+        assert host_ring_mapping['new']['weight'] == 100
+        assert host_ring_mapping['other-ring']['weight'] == 100
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,9 @@ from unittest import mock
 import trough
 import json
 import sqlite3
+import tempfile
+import threading
+import time
 from tempfile import NamedTemporaryFile
 from trough import sync
 from trough.settings import settings
@@ -90,6 +93,37 @@ class TestReadServer(unittest.TestCase):
         segment = trough.sync.Segment(segment_id="TEST", rethinker=rethinker, services=services, registry=registry, size=0)
         output = self.server.proxy_for_write_host('localhost', segment, "SELECT * FROM mock;", start_response=lambda *args, **kwargs: None)
         self.assertEqual(list(output), [b"test", b"output"])
+    def test_read_through(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'fetched.sqlite')
+            segment = mock.Mock(id='fetched')
+            segment.local_path = lambda: path
+            with self.assertRaises(AssertionError):
+                self.server.execute_query(segment, b'SELECT 1;')
+
+            def fetch_segment(segment):
+                time.sleep(0.2)
+                connection = sqlite3.connect(path)
+                connection.execute('CREATE TABLE test (test varchar(4));')
+                connection.execute('INSERT INTO test VALUES ("test");')
+                connection.commit()
+                connection.close()
+            request_fetch = mock.Mock(side_effect=fetch_segment)
+            self.server.request_fetch = request_fetch
+            results = []
+            def read():
+                cursor = self.server.execute_query(segment, b'SELECT * FROM test;')
+                results.append(json.loads(b''.join(self.server.sql_result_json_iter(cursor)).decode('utf-8')))
+            with mock.patch.dict(settings, {'READ_THROUGH': True}):
+                threads = [threading.Thread(target=read) for i in range(3)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(results, [[{'test': 'test'}]] * 3)
+            # one fetch for all three reads
+            self.assertEqual(request_fetch.call_count, 1)
+            self.assertEqual(self.server.fetches, {})
 
 if __name__ == '__main__':
     unittest.main()
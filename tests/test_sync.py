@@ -4,6 +4,8 @@ os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.co
 import unittest
 from unittest import mock
 from trough import sync
+from trough import local_index
+from trough.placement import segment_shard
 from trough.settings import settings
 import time
 import doublethink
@@ -11,7 +13,10 @@ import rethinkdb as r
 import random
 import string
 import tempfile
+import json
+import hashlib
 import logging
+import requests
 from hdfs3 import HDFileSystem
 import pytest
 
@@ -171,6 +176,24 @@ class TestHostRegistry(unittest.TestCase):
         time.sleep(0.4)
         hosts = registry.get_hosts()
         self.assertEqual(hosts, [])
+    def test_bulk_heartbeat(self):
+        registry = sync.HostRegistry(rethinker=self.rethinker, services=self.services)
+        ids = ['trough-read:test01:%s' % i for i in range(5)] + ['trough-write:test01:0']
+        with mock.patch.dict(settings, {'HEARTBEAT_BATCH_SIZE': 2}):
+            registry.bulk_heartbeat(ids[:3])
+            first = {svc['id']: svc for svc in self.rethinker.table('services').run()}
+            self.assertEqual(sorted(first), ids[:3])
+            self.assertEqual(first['trough-read:test01:1']['segment'], '1')
+            self.assertEqual(first['trough-read:test01:1']['role'], 'trough-read')
+            self.assertEqual(first['trough-read:test01:1']['url'], 'http://test01:%s/?segment=1' % settings['READ_PORT'])
+            time.sleep(0.1)
+            registry.bulk_heartbeat(ids)
+            second = {svc['id']: svc for svc in self.rethinker.table('services').run()}
+            self.assertEqual(sorted(second), sorted(ids))
+            self.assertEqual(second['trough-write:test01:0']['port'], settings['WRITE_PORT'])
+            for id in ids[:3]:
+                self.assertEqual(second[id]['first_heartbeat'], first[id]['first_heartbeat'])
+                self.assertGreater(second[id]['last_heartbeat'], first[id]['last_heartbeat'])
     def test_assign(self):
         registry = sync.HostRegistry(rethinker=self.rethinker, services=self.services)
         segment = sync.Segment('123456',
@@ -214,6 +237,108 @@ class TestHostRegistry(unittest.TestCase):
         output = registry.segments_for_host('localhost')
         self.assertEqual(output, [])
 
+class TestAssignmentQueue(unittest.TestCase):
+    def test_batched_commit(self):
+        rethinker = mock.Mock()
+        insert = rethinker.table.return_value.insert
+        queue = sync.AssignmentQueue(rethinker)
+        queue.batch_size = 3
+        queue.concurrency = 2
+        for i in range(5):
+            queue.enqueue({'id': 'node:%s' % i})
+        assert not insert.called
+        queue.enqueue({'id': 'node:5'})
+        # auto-commit once batch_size * concurrency are queued
+        assert insert.call_count == 2
+        assert queue.length() == 0
+        for call in insert.call_args_list:
+            assert len(call[0][0]) == 3
+            assert call[1] == {'conflict': 'replace'}
+
+    def test_resume_failed_commit(self):
+        rethinker = mock.Mock()
+        queue = sync.UnassignmentQueue(rethinker)
+        queue.batch_size = 2
+        deleted = []
+        def commit_batch(batch):
+            if batch[0].id == 'node:2':
+                raise Exception('oh no')
+            deleted.extend(item.id for item in batch)
+        queue.commit_batch = commit_batch
+        for i in range(5):
+            queue.enqueue(mock.Mock(id='node:%s' % i))
+        with self.assertRaises(Exception):
+            queue.commit()
+        assert sorted(deleted) == ['node:0', 'node:1', 'node:4']
+        assert [item.id for item in queue._queue] == ['node:2', 'node:3']
+
+        queue.commit_batch = lambda batch: deleted.extend(item.id for item in batch)
+        queue.commit()
+        assert sorted(deleted) == ['node:%s' % i for i in range(5)]
+        assert queue.length() == 0
+
+class TestPlacementContext(unittest.TestCase):
+    def test_placement_context(self):
+        registry = mock.Mock()
+        registry.get_hosts.return_value = [
+            {'node': 'warm01', 'available_bytes': 100},
+            {'node': 'cold01', 'available_bytes': 200, 'cold_storage': True},
+            {'node': 'warm02', 'available_bytes': 300, 'cold_storage': False},
+        ]
+        context = sync.PlacementContext(registry)
+        registry.get_hosts.assert_called_once_with(exclude_cold=False)
+        assert [host['node'] for host in context.cold_hosts] == ['cold01']
+        assert context.capacities == {'warm01': 100, 'warm02': 300}
+
+    def test_segment_policy_memoized(self):
+        cold_store_segment = mock.Mock(return_value=True)
+        minimum_assignments = mock.Mock(return_value=3)
+        with mock.patch.dict(settings, {
+                'COLD_STORE_SEGMENT': cold_store_segment,
+                'MINIMUM_ASSIGNMENTS': minimum_assignments}):
+            segment = sync.Segment('123', 100, None, None, None)
+            for i in range(3):
+                assert segment.cold_store() is True
+                assert segment.local_path() == segment.cold_storage_path()
+                assert segment.minimum_assignments() == 3
+        cold_store_segment.assert_called_once_with('123')
+        minimum_assignments.assert_called_once_with('123')
+
+class TestRebalancing(unittest.TestCase):
+    def make_move(self, copies, order, segment_id, size, node, old_node=None):
+        segment = sync.Segment(segment_id, size, None, None, None)
+        ring = mock.Mock(id=0)
+        assignment = None
+        if old_node:
+            assignment = sync.Assignment(None, d={
+                'id': '%s:%s' % (old_node, segment_id), 'node': old_node,
+                'segment': segment_id, 'hash_ring': 0, 'bytes': size})
+        return sync.Move(copies, order, segment, ring, node, assignment)
+
+    def test_schedule_moves(self):
+        registry = mock.Mock()
+        controller = sync.MasterSyncController(
+                rethinker=mock.Mock(), services=mock.Mock(), registry=registry)
+        moves = [
+            self.make_move(1, 0, 'moved-1', 100, 'node-b', old_node='node-a'),
+            self.make_move(1, 1, 'moved-2', 100, 'node-c', old_node='node-a'),
+            self.make_move(0, 2, 'new-1', 100, 'node-b'),
+            self.make_move(1, 3, 'moved-3', 100, 'node-b', old_node='node-a'),
+            self.make_move(0, 4, 'new-2', 100, 'node-b'),
+        ]
+        with mock.patch.dict(settings, {
+                'REBALANCE_MAX_BYTES_PER_CYCLE': 350,
+                'REBALANCE_MAX_BYTES_PER_NODE': 250}):
+            scheduled, deferred = controller.schedule_moves(moves)
+        # segments without any copies always go first, and always go
+        assert scheduled == 3
+        assert deferred == {'moved-1', 'moved-3'}
+        queued = [call[0][0] for call in registry.assignment_queue.enqueue.call_args_list]
+        assert [(a['id'], a.get('draining')) for a in queued] == [
+                ('node-b:new-1', None), ('node-b:new-2', None),
+                ('node-a:moved-2', True), ('node-c:moved-2', None)]
+        assert not registry.unassign.called
+
 class TestMasterSyncController(unittest.TestCase):
     def setUp(self):
         self.rethinker = doublethink.Rethinker(db=random_db, servers=settings['RETHINKDB_HOSTS'])
@@ -223,6 +348,7 @@ class TestMasterSyncController(unittest.TestCase):
         self.snakebite_client = mock.Mock()
         self.rethinker.table("services").delete().run()
         self.rethinker.table("assignment").delete().run()
+        self.rethinker.table("sync_state").delete().run()
     def get_foreign_controller(self):
         controller = sync.MasterSyncController(rethinker=self.rethinker,
             services=self.services,
@@ -307,6 +433,137 @@ class TestMasterSyncController(unittest.TestCase):
         # clean up after successful test
         hdfs.rm(controller.hdfs_path, recursive=True)
         hdfs.mkdir(controller.hdfs_path)
+    def test_assign_segments_incremental(self):
+        controller = self.get_local_controller()
+        hdfs = HDFileSystem(host=controller.hdfs_host, port=controller.hdfs_port)
+        hdfs.rm(controller.hdfs_path, recursive=True)
+        hdfs.mkdir(controller.hdfs_path)
+        with hdfs.open(os.path.join(controller.hdfs_path, '1.sqlite'), 'wb', replication=1) as f:
+            f.write(b'x' * 1024)
+        hostname = 'test.example.com'
+        self.registry.heartbeat(pool='trough-nodes',
+            service_id='trough:nodes:%s' % hostname,
+            node=hostname,
+            ttl=60,
+            available_bytes=1024*1024)
+        controller = self.get_local_controller()
+        controller.assign_segments()
+        assert controller.assigned_segments == {
+                '1': (1024, os.path.join(controller.hdfs_path, '1.sqlite'))}
+
+        # new segment, changed segment: only those are looked at
+        with hdfs.open(os.path.join(controller.hdfs_path, '2.sqlite'), 'wb', replication=1) as f:
+            f.write(b'x' * 512)
+        with mock.patch('trough.sync.Assignment.all') as all_assignments:
+            controller.assign_segments()
+            assert not all_assignments.called
+        assignments = {asmt['segment']: asmt for asmt in self.rethinker.table('assignment').filter(r.row['id'] != 'ring-assignments').run()}
+        assert set(assignments) == {'1', '2'}
+        assert assignments['2']['bytes'] == 512
+
+        with hdfs.open(os.path.join(controller.hdfs_path, '2.sqlite'), 'wb', replication=1) as f:
+            f.write(b'x' * 2048)
+        hdfs.rm(os.path.join(controller.hdfs_path, '1.sqlite'))
+        controller.assign_segments()
+        assignments = {asmt['segment']: asmt for asmt in self.rethinker.table('assignment').filter(r.row['id'] != 'ring-assignments').run()}
+        # not unassigned until it's missing from two listings in a row
+        assert set(assignments) == {'1', '2'}
+        assert controller.missing_segment_ids == {'1'}
+        controller.assign_segments()
+        assignments = {asmt['segment']: asmt for asmt in self.rethinker.table('assignment').filter(r.row['id'] != 'ring-assignments').run()}
+        assert set(assignments) == {'2'}
+        assert controller.missing_segment_ids == set()
+        assert assignments['2']['bytes'] == 2048
+
+        # a new master picks up where the old one left off
+        controller = self.get_local_controller()
+        with mock.patch('trough.sync.Segment.minimum_assignments') as minimum_assignments:
+            minimum_assignments.return_value = 1
+            controller.assign_segments()
+            assert not minimum_assignments.called
+        assert controller.assigned_segments == {
+                '2': (2048, os.path.join(controller.hdfs_path, '2.sqlite'))}
+        # clean up after successful test
+        hdfs.rm(controller.hdfs_path, recursive=True)
+        hdfs.mkdir(controller.hdfs_path)
+    def test_assign_segments_sharded(self):
+        controller = self.get_local_controller()
+        hdfs = HDFileSystem(host=controller.hdfs_host, port=controller.hdfs_port)
+        hdfs.rm(controller.hdfs_path, recursive=True)
+        hdfs.mkdir(controller.hdfs_path)
+        # one segment in each shard
+        segment_ids = {}
+        for i in range(100):
+            segment_ids.setdefault(segment_shard(str(i), 2), str(i))
+        for segment_id in segment_ids.values():
+            with hdfs.open(os.path.join(controller.hdfs_path, '%s.sqlite' % segment_id), 'wb', replication=1) as f:
+                f.write(b'x' * 1024)
+        hostname = 'test.example.com'
+        self.registry.heartbeat(pool='trough-nodes',
+            service_id='trough:nodes:%s' % hostname,
+            node=hostname,
+            ttl=60,
+            available_bytes=1024*1024)
+        def assigned_segments():
+            return {asmt['segment'] for asmt in self.rethinker.table('assignment').filter(r.row['id'] != 'ring-assignments').run()}
+        for shard in (0, 1):
+            with mock.patch.dict(settings, {'SEGMENT_MANAGER_SHARDS': 2, 'SEGMENT_MANAGER_SHARD': shard}):
+                controller = self.get_local_controller()
+                with mock.patch.object(controller, 'hold_election', return_value=True):
+                    controller.assign_segments()
+                assert set(controller.assigned_segments) == {segment_ids[shard]}
+                # doesn't touch the other shard's assignments
+                assert assigned_segments() == set(segment_ids[s] for s in range(shard + 1))
+        # clean up after successful test
+        hdfs.rm(controller.hdfs_path, recursive=True)
+        hdfs.mkdir(controller.hdfs_path)
+    def test_reconcile_segment_catalog(self):
+        controller = self.get_local_controller()
+        hdfs = HDFileSystem(host=controller.hdfs_host, port=controller.hdfs_port)
+        hdfs.rm(controller.hdfs_path, recursive=True)
+        hdfs.mkdir(controller.hdfs_path)
+        hdfs.mkdir(os.path.join(controller.hdfs_path, 'a'))
+        for path in ('1.sqlite', 'a/2.sqlite', 'a/3.txt'):
+            with hdfs.open(os.path.join(controller.hdfs_path, path), 'wb', replication=1) as f:
+                f.write(b'x' * 10)
+        self.rethinker.table('segment_catalog').delete().run()
+        controller.reconcile_segment_catalog()
+        catalog = {entry['id']: entry for entry in self.rethinker.table('segment_catalog').run()}
+        assert set(catalog) == {'1', '2'}
+        assert catalog['2']['remote_path'] == os.path.join(controller.hdfs_path, 'a/2.sqlite')
+        assert catalog['2']['size'] == 10
+
+        with mock.patch.dict(settings, {'USE_SEGMENT_CATALOG': True}):
+            listing = sorted(controller.get_segment_file_list(), key=lambda e: e['name'])
+        assert [entry['name'] for entry in listing] == [
+                os.path.join(controller.hdfs_path, '1.sqlite'),
+                os.path.join(controller.hdfs_path, 'a/2.sqlite')]
+        assert listing[0]['last_mod'] == catalog['1']['last_mod']
+
+        hdfs.rm(os.path.join(controller.hdfs_path, '1.sqlite'))
+        controller.reconcile_segment_catalog()
+        catalog = {entry['id']: entry for entry in self.rethinker.table('segment_catalog').run()}
+        assert set(catalog) == {'2'}
+
+        # a promotion that lands while reconciling keeps its checksum
+        self.rethinker.table('segment_catalog').get('2').delete().run()
+        ls_r = controller.ls_r
+        def ls_r_during_promotion(hdfs, path):
+            listing = list(ls_r(hdfs, path))
+            for file in listing:
+                if file['name'].endswith('2.sqlite'):
+                    sync.SegmentCatalog.record(
+                            self.rethinker, '2', file['name'], file['size'],
+                            file['last_mod'], checksum='abc', uncompressed_size=40)
+            return listing
+        with mock.patch.object(controller, 'ls_r', ls_r_during_promotion):
+            controller.reconcile_segment_catalog()
+        entry = self.rethinker.table('segment_catalog').get('2').run()
+        assert entry['checksum'] == 'abc'
+        assert entry['uncompressed_size'] == 40
+        # clean up after successful test
+        hdfs.rm(controller.hdfs_path, recursive=True)
+        hdfs.mkdir(controller.hdfs_path)
     @mock.patch("trough.sync.requests")
     def test_provision_writable_segment(self, requests):
         u = []
@@ -404,6 +661,171 @@ class TestMasterSyncController(unittest.TestCase):
     def test_sync(self):
         pass
 
+class TestDeltaSync(unittest.TestCase):
+    def test_file_block_checksums(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'a' * 10 + b'b' * 5)
+            f.flush()
+            blocksums = sync.file_block_checksums(f.name, 10)
+            assert blocksums['size'] == 15
+            assert blocksums['checksum'] == sync.file_checksum(f.name)
+            assert len(blocksums['blocks']) == 2
+            assert sync.file_block_checksums(f.name, 5)['blocks'][0] == sync.file_block_checksums(f.name, 5)['blocks'][1]
+
+    def test_patch_segment_from_hdfs(self):
+        with tempfile.TemporaryDirectory() as local_data, tempfile.TemporaryDirectory() as remote_dir:
+            # stands in for hdfs, backed by a local directory
+            fs = mock.Mock()
+            fs.exists = os.path.exists
+            remote_path = os.path.join(remote_dir, '1.sqlite')
+            reads = []
+            real_open = open
+            def hdfs_open(path, mode):
+                f = real_open(path, mode)
+                if path == remote_path:
+                    read = f.read
+                    f.read = lambda n=-1: reads.append(n) or read(n)
+                return f
+            fs.open = hdfs_open
+            old = b''.join(bytes([i]) * 100 for i in range(10))
+            new = old[:300] + b'x' * 100 + old[400:] + b'y' * 150
+            with open(remote_path, 'wb') as f:
+                f.write(new)
+            with open(remote_path + sync.BLOCKSUMS_SUFFIX, 'w') as f:
+                f.write(json.dumps(sync.file_block_checksums(remote_path, 100)))
+            segment = sync.Segment('1', size=len(new), rethinker=None, services=None, registry=None, remote_path=remote_path)
+            with mock.patch.dict(settings, {'LOCAL_DATA': local_data}), \
+                    mock.patch('trough.sync.HDFileSystem', return_value=fs):
+                with open(segment.local_path(), 'wb') as f:
+                    f.write(old)
+                controller = sync.LocalSyncController(rethinker=None, services=None, registry=None)
+                assert controller.patch_segment_from_hdfs(segment)
+                with open(segment.local_path(), 'rb') as f:
+                    assert f.read() == new
+                # fetched block 3 and the two new blocks, not the whole file
+                assert len(reads) == 3
+
+                # too much changed
+                with open(segment.local_path(), 'wb') as f:
+                    f.write(b'z' * len(old))
+                assert not controller.patch_segment_from_hdfs(segment)
+
+                # no block checksums
+                os.remove(remote_path + sync.BLOCKSUMS_SUFFIX)
+                assert not controller.patch_segment_from_hdfs(segment)
+
+class TestCompressedSegments(unittest.TestCase):
+    def test_segment_paths(self):
+        assert sync.segment_id_from_path('/a/b/c/foo.sqlite') == 'foo'
+        assert sync.segment_id_from_path('/a/b/c/foo.sqlite.zst') == 'foo'
+        assert sync.segment_path_variant('/a/foo.sqlite', True) == '/a/foo.sqlite.zst'
+        assert sync.segment_path_variant('/a/foo.sqlite.zst', False) == '/a/foo.sqlite'
+        assert sync.segment_path_variant('/a/foo.sqlite.zst', True) == '/a/foo.sqlite.zst'
+        entries = [
+            {'name': '/a/foo.sqlite', 'size': 100, 'last_mod': 1},
+            {'name': '/a/foo.sqlite.zst', 'size': 20, 'last_mod': 2},
+            {'name': '/a/foo.sqlite.blocksums', 'size': 5, 'last_mod': 1},
+            {'name': '/a/bar.sqlite', 'size': 100, 'last_mod': 3},
+            {'name': '/a/bar.sqlite.zst', 'size': 20, 'last_mod': 2},
+        ]
+        latest = sorted(e['name'] for e in sync.latest_segment_files(entries))
+        assert latest == ['/a/bar.sqlite', '/a/foo.sqlite.zst']
+
+    @unittest.skipIf(sync.zstandard is None, 'zstandard module not available')
+    def test_copy_compressed_segment_from_hdfs(self):
+        with tempfile.TemporaryDirectory() as local_data, tempfile.TemporaryDirectory() as remote_dir:
+            fs = mock.Mock()
+            fs.open = open
+            data = b'trough' * 10000
+            remote_path = os.path.join(remote_dir, '1.sqlite.zst')
+            with open(remote_path, 'wb') as f:
+                f.write(sync.zstandard.ZstdCompressor().compress(data))
+            segment = sync.Segment('1', size=len(data), rethinker=None, services=None, registry=None, remote_path=remote_path)
+            with mock.patch.dict(settings, {'LOCAL_DATA': local_data}), \
+                    mock.patch('trough.sync.HDFileSystem', return_value=fs):
+                controller = sync.LocalSyncController(rethinker=None, services=None, registry=None)
+                assert controller.copy_segment_from_hdfs(segment)
+                with open(segment.local_path(), 'rb') as f:
+                    assert f.read() == data
+                # no patching compressed segments
+                assert not controller.patch_segment_from_hdfs(segment)
+
+                # checksum is checked on the decompressed data, and a copy
+                # that doesn't match doesn't replace the local copy
+                with open(segment.local_path(), 'wb') as f:
+                    f.write(b'old')
+                with self.assertRaises(sync.ChecksumMismatch):
+                    controller.copy_segment_from_hdfs(segment, checksum='bogus')
+                with open(segment.local_path(), 'rb') as f:
+                    assert f.read() == b'old'
+                checksum = hashlib.sha256(data).hexdigest()
+                assert controller.copy_segment_from_hdfs(segment, checksum=checksum)
+
+class TestLocalLayout(unittest.TestCase):
+    def test_local_segment_path(self):
+        with tempfile.TemporaryDirectory() as local_data:
+            with mock.patch.dict(settings, {'LOCAL_DATA': local_data, 'LOCAL_DATA_LAYOUT_DEPTH': 2}):
+                path = sync.local_segment_path('123456')
+                self.assertEqual(path, local_index.segment_path(local_data, '123456', 2))
+                self.assertEqual(len(os.path.relpath(path, local_data).split(os.sep)), 3)
+                # not migrated yet
+                flat_path = os.path.join(local_data, '123456.sqlite')
+                with open(flat_path, 'wb'):
+                    pass
+                self.assertEqual(sync.local_segment_path('123456'), flat_path)
+                # migrated
+                os.makedirs(os.path.dirname(path))
+                os.rename(flat_path, path)
+                self.assertEqual(sync.local_segment_path('123456'), path)
+
+                controller = sync.LocalSyncController(rethinker=None, services=None, registry=None)
+                with open(flat_path, 'wb'):
+                    pass
+                os.utime(path, times=(1000, 1000))
+                with open(os.path.join(local_data, 'notes.txt'), 'wb'):
+                    pass
+                self.assertEqual(set(controller.local_segment_mtimes()), {'123456'})
+                self.assertGreater(controller.local_segment_mtimes()['123456'], 1000)
+                self.assertEqual(controller.local_segment_ids(), ['123456'])
+
+class TestChecksumVerification(unittest.TestCase):
+    def test_process_stale_segment_retries(self):
+        controller = sync.LocalSyncController(rethinker=None, services=None, registry=None)
+        segment = mock.Mock(id='1', remote_path='/hdfs/1.sqlite')
+        segment.retrieve_write_lock.return_value = None
+        mismatch = sync.ChecksumMismatch('mismatch')
+        with mock.patch.object(controller, 'segment_checksum', return_value='abc'), \
+                mock.patch.object(controller, 'copy_segment_from_hdfs') as copy:
+            copy.side_effect = [mismatch, True]
+            assert controller.process_stale_segment(segment)
+            assert copy.call_count == 2
+            copy.assert_called_with(segment, checksum='abc')
+            assert 'trough-read:%s:1' % settings['HOSTNAME'] in controller.healthy_service_ids
+
+            # gives up, leaving it to the download scheduler to retry later
+            copy.reset_mock()
+            copy.side_effect = [mismatch] * 3
+            with mock.patch.dict(settings, {'SEGMENT_CHECKSUM_RETRIES': 2}):
+                assert not controller.process_stale_segment(segment)
+            assert copy.call_count == 3
+
+    def test_process_stale_segment_listed_checksum(self):
+        controller = sync.LocalSyncController(rethinker=None, services=None, registry=None)
+        segment = mock.Mock(id='1', remote_path='/hdfs/1.sqlite')
+        segment.retrieve_write_lock.return_value = None
+        with mock.patch.object(controller, 'segment_checksum', return_value='new') as lookup, \
+                mock.patch.object(controller, 'copy_segment_from_hdfs') as copy:
+            # the checksum from the catalog listing saves a lookup...
+            assert controller.process_stale_segment(segment, checksum='listed')
+            copy.assert_called_once_with(segment, checksum='listed')
+            assert not lookup.called
+            # ... unless the copy doesn't match it
+            copy.reset_mock()
+            copy.side_effect = [sync.ChecksumMismatch('mismatch'), True]
+            assert controller.process_stale_segment(segment, checksum='listed')
+            copy.assert_called_with(segment, checksum='new')
+            assert lookup.call_count == 1
+
 class TestLocalSyncController(unittest.TestCase):
     def setUp(self):
         self.rethinker = doublethink.Rethinker(db=random_db, servers=settings['RETHINKDB_HOSTS'])
@@ -416,32 +838,32 @@ class TestLocalSyncController(unittest.TestCase):
             services=self.services,
             registry=self.registry)
     # v don't log out the error message on error test below.
-    @mock.patch("trough.sync.client")
+    @mock.patch("trough.sync.HDFileSystem")
     @mock.patch("trough.sync.logging.error")
-    def test_copy_segment_from_hdfs(self, error, snakebite):
-        results = [{'error': 'test error'}]
-        class C:
-            def __init__(*args, **kwargs):
-                pass
-            def copyToLocal(self, paths, dst, *args, **kwargs):
-                for result in results:
-                    if not result.get('error'):
-                        # create empty dest file
-                        with open(dst, 'wb') as f: pass
-                    yield result
-        snakebite.Client = C
+    def test_copy_segment_from_hdfs(self, error, hdfs):
+        hdfs.return_value.open.side_effect = IOError('test error')
         controller = self.make_fresh_controller()
-        segment = sync.Segment('test-segment',
-            services=self.services,
-            rethinker=self.rethinker,
-            registry=self.registry,
-            size=100,
-            remote_path='/fake/remote/path')
-        with self.assertRaises(Exception):
-            output = controller.copy_segment_from_hdfs(segment)
-        results = [{}]
-        output = controller.copy_segment_from_hdfs(segment)
-        self.assertEqual(output, True)
+        with tempfile.TemporaryDirectory() as remote_dir:
+            remote_path = os.path.join(remote_dir, 'test-segment.sqlite')
+            with open(remote_path, 'wb') as f:
+                f.write(b'x' * 100)
+            segment = sync.Segment('test-segment',
+                services=self.services,
+                rethinker=self.rethinker,
+                registry=self.registry,
+                size=100,
+                remote_path=remote_path)
+            with self.assertRaises(Exception):
+                output = controller.copy_segment_from_hdfs(segment)
+            hdfs.return_value.open.side_effect = open
+            # checksum is worked out as the copy is written
+            with self.assertRaises(sync.ChecksumMismatch):
+                controller.copy_segment_from_hdfs(segment, checksum='bogus')
+            output = controller.copy_segment_from_hdfs(
+                    segment, checksum=hashlib.sha256(b'x' * 100).hexdigest())
+            self.assertEqual(output, True)
+            with open(segment.local_path(), 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 100)
     def test_heartbeat(self):
         controller = self.make_fresh_controller()
         controller.heartbeat()
@@ -557,6 +979,24 @@ class TestLocalSyncController(unittest.TestCase):
             hdfs.rm(controller.hdfs_path, recursive=True)
             hdfs.mkdir(controller.hdfs_path)
 
+    def test_schedule_downloads(self):
+        controller = self.make_fresh_controller()
+        segments = {
+            segment_id: sync.Segment(segment_id,
+                services=self.services,
+                rethinker=self.rethinker,
+                registry=self.registry,
+                size=100,
+                remote_path='/fake/%s.sqlite' % segment_id)
+            for segment_id in ('1', '2', '3', '4')}
+        with mock.patch('trough.sync.ReadStats.demand', return_value={'1': 5, '2': 50}), \
+                mock.patch.object(controller, 'readable_copy_counts', return_value={'1': 1, '2': 1, '3': 1}), \
+                mock.patch.object(controller.download_scheduler, 'schedule') as schedule:
+            controller.schedule_downloads(['1', '2', '3', '4', '5'], segments, {}, {})
+        downloads = sorted(schedule.call_args[0][0], key=lambda download: download.priority)
+        # 4 has no other copies, then by demand, 5 is not assigned to us
+        assert [download.key for download in downloads] == ['4', '2', '1', '3']
+        assert downloads[0].source == '/fake/4.sqlite'
     @mock.patch("trough.sync.client")
     def test_hdfs_resiliency(self, snakebite):
         sync.init(self.rethinker)
@@ -572,24 +1012,19 @@ class TestLocalSyncController(unittest.TestCase):
                 pass
             def ls(*args, **kwargs):
                 yield {'length': 1024 * 1000, 'path': '/1.sqlite', 'modification_time': (time.time() + 1000000) * 1000}
-            def copyToLocal(*args, **kwargs):
-                return [{'error':'There was a problem...'}]
         snakebite.Client = C
         controller = self.make_fresh_controller()
-        controller.sync()
+        with mock.patch('trough.sync.HDFileSystem.open', side_effect=IOError('There was a problem...')):
+            controller.sync()
         class C:
             def __init__(*args, **kwargs):
                 pass
             def ls(*args, **kwargs):
                 yield {'length': 1024 * 1000, 'path': '/1.sqlite', 'modification_time': (time.time() + 1000000) * 1000}
-            def copyToLocal(*args, **kwargs):
-                def g():
-                    raise Exception("HDFS IS DOWN")
-                    yield 0
-                return g()
         snakebite.Client = C
         controller = self.make_fresh_controller()
-        controller.sync()
+        with mock.patch('trough.sync.HDFileSystem.open', side_effect=Exception("HDFS IS DOWN")):
+            controller.sync()
         class C:
             def __init__(*args, **kwargs):
                 pass
@@ -598,14 +1033,11 @@ class TestLocalSyncController(unittest.TestCase):
                     raise Exception("HDFS IS DOWN")
                     yield 0
                 return g()
-            def copyToLocal(*args, **kwargs):
-                def g():
-                    raise Exception("HDFS IS DOWN")
-                    yield 0
-                return g()
         snakebite.Client = C
         controller = self.make_fresh_controller()
-        controller.sync()
+        with mock.patch('trough.sync.HDFileSystem.ls', side_effect=Exception("HDFS IS DOWN")), \
+                mock.patch('trough.sync.HDFileSystem.open', side_effect=Exception("HDFS IS DOWN")):
+            controller.sync()
         self.rethinker.table('lock').delete().run()
         self.rethinker.table('assignment').delete().run()
         self.rethinker.table('services').delete().run()
@@ -632,6 +1064,28 @@ class TestLocalSyncController(unittest.TestCase):
         for svc in self.rethinker.table('services').run():
             assert svc['last_heartbeat'] > heartbeats_after
 
+    def test_periodic_heartbeat_node_model(self):
+        sync.init(self.rethinker)
+        self.rethinker.table(sync.SegmentMembership.table).delete().run()
+        controller = self.make_fresh_controller()
+        controller.sync_loop_timing = 1
+        controller.healthy_service_ids = {'trough-read:test01:id0', 'trough-write:test01:id0'}
+        # left over from the 'segment' model
+        self.registry.bulk_heartbeat(['trough-read:test01:id0'])
+        with mock.patch.dict(settings, {'SERVICE_REGISTRY_MODEL': 'node'}):
+            controller.periodic_heartbeat()
+            assert set(self.rethinker.table('services')['id'].run()) == {'trough-nodes:test01:None', 'trough-write:test01:id0'}
+            segment = sync.Segment('id0', 0, self.rethinker, self.services, self.registry)
+            copies = list(segment.readable_copies())
+            assert [copy['id'] for copy in copies] == ['trough-read:test01:id0']
+            assert copies[0]['url'] == 'http://test01:%s/?segment=id0' % settings['READ_PORT']
+            controller.delete_segment('id0')
+            assert segment.readable_copies_count() == 0
+        # and back
+        controller.periodic_heartbeat()
+        assert self.rethinker.table(sync.SegmentMembership.table).count().run() == 0
+        assert segment.readable_copies_count() == 1
+
     def test_provision_writable_segment(self):
         test_segment = sync.Segment('test',
             services=self.services,
@@ -714,6 +1168,164 @@ class TestLocalSyncController(unittest.TestCase):
             assert not self.rethinker.table('services').get('trough-read:test01:%s' % segment_id).run()
             assert self.rethinker.table('services').get('trough-read:test02:%s' % segment_id).run()
 
+    def test_collect_garbage_batches(self):
+        self.rethinker.table('lock').delete().run()
+        self.rethinker.table('assignment').delete().run()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            segment_ids = ['gc-locked', 'gc-spare', 'gc-only-copy', 'gc-serving']
+            for segment_id in segment_ids:
+                with open(os.path.join(tmp_dir, '%s.sqlite' % segment_id), 'wb'):
+                    pass
+            controller = self.make_fresh_controller()
+            controller.local_data = tmp_dir
+            for segment_id in ['gc-locked', 'gc-spare', 'gc-serving']:
+                controller.registry.heartbeat(pool='trough-read', node='test02', ttl=600, segment=segment_id)
+            controller.registry.heartbeat(pool='trough-read', node='test01', ttl=600, segment='gc-serving')
+            # write lock taken since we looked up our assignments
+            with mock.patch.object(controller.registry, 'segments_for_host', return_value=[]):
+                sync.Lock.acquire(self.rethinker, 'write:lock:gc-locked', {'segment': 'gc-locked'})
+                with mock.patch.dict(settings, {'GARBAGE_COLLECTION_BATCH_SIZE': 3}):
+                    controller.collect_garbage()
+            assert sorted(os.listdir(tmp_dir)) == ['gc-locked.sqlite', 'gc-only-copy.sqlite']
+            assert not self.rethinker.table('services').get('trough-read:test01:gc-serving').run()
+            self.rethinker.table('lock').delete().run()
+
+    def test_fetch_segment(self):
+        sync.init(self.rethinker)
+        sync.SegmentCatalog.record(
+                self.rethinker, 'fetch-me', '/trough/fetch-me.sqlite', 10,
+                int(time.time()), checksum='abc')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            controller = self.make_fresh_controller()
+            controller.local_data = tmp_dir
+            controller.copy_segment_from_hdfs = mock.Mock()
+            segment = sync.Segment('fetch-me', 0, self.rethinker, self.services, self.registry)
+            with mock.patch('shutil.disk_usage', return_value=mock.Mock(total=1000, used=0)):
+                controller.storage_in_bytes = 10
+                with self.assertRaises(Exception):
+                    controller.fetch_segment(segment)
+                assert not controller.copy_segment_from_hdfs.called
+                controller.storage_in_bytes = 100
+                controller.fetch_segment(segment)
+                controller.copy_segment_from_hdfs.assert_called_once_with(segment, checksum='abc')
+                assert segment.remote_path == '/trough/fetch-me.sqlite'
+                assert self.rethinker.table('services').get('trough-read:test01:fetch-me').run()
+                with self.assertRaises(KeyError):
+                    controller.fetch_segment(sync.Segment('not-in-hdfs', 0, self.rethinker, self.services, self.registry))
+
+    def test_reserve_room(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch('shutil.disk_usage', return_value=mock.Mock(total=1000, used=20)):
+            controller = self.make_fresh_controller()
+            controller.local_data = tmp_dir
+            controller.storage_in_bytes = 100
+            with controller.reserve_room('a', 40):
+                # the same segment is fetched once at a time
+                with self.assertRaises(sync.FetchInProgress):
+                    with controller.reserve_room('a', 40):
+                        pass
+                # 20 used + 40 reserved + 40 is over 90
+                with self.assertRaises(Exception):
+                    with controller.reserve_room('b', 40):
+                        pass
+                with controller.reserve_room('b', 30):
+                    pass
+            # reservations of processes that died don't count
+            with open(os.path.join(tmp_dir, sync.READ_THROUGH_RESERVATIONS, 'c.reservation'), 'w') as f:
+                f.write('%s 60' % 2**22)
+            with controller.reserve_room('b', 60):
+                pass
+            assert os.listdir(os.path.join(tmp_dir, sync.READ_THROUGH_RESERVATIONS)) == ['lock']
+
+    def test_collect_garbage_extra_replicas_fresh_controller(self):
+        # e.g. scripts/garbage_collector.py, which doesn't heartbeat anything
+        # itself, so has to go by the service registry
+        self.rethinker.table('lock').delete().run()
+        self.rethinker.table('assignment').delete().run()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for segment_id in ['fresh-served', 'fresh-stale']:
+                with open(os.path.join(tmp_dir, '%s.sqlite' % segment_id), 'wb') as f:
+                    f.write(b'x' * 10)
+                self.registry.heartbeat(pool='trough-read', node='test02', ttl=600, segment=segment_id)
+            self.registry.heartbeat(pool='trough-read', node='test01', ttl=600, segment='fresh-served')
+            controller = self.make_fresh_controller()
+            controller.local_data = tmp_dir
+            controller.storage_in_bytes = 100
+            assert not controller.healthy_service_ids
+            with mock.patch.object(controller.registry, 'segments_for_host', return_value=[]), \
+                    mock.patch.dict(settings, {'LOCAL_CACHE_EXTRA_REPLICAS': True}):
+                controller.collect_garbage()
+            assert os.listdir(tmp_dir) == ['fresh-served.sqlite']
+
+    def test_copy_segment_from_peer(self):
+        data = b'0123456789' * 100
+        checksum = hashlib.sha256(data).hexdigest()
+        def response(status_code, chunks, checksum=checksum):
+            resp = mock.MagicMock(status_code=status_code, headers={
+                'X-Trough-Checksum': checksum, 'ETag': '"v1"'})
+            resp.__enter__.return_value = resp
+            resp.iter_content.return_value = chunks
+            return resp
+        def interrupted():
+            yield data[:300]
+            raise requests.exceptions.ChunkedEncodingError('connection dropped')
+        self.registry.heartbeat(pool='trough-read', node='test01', ttl=600, segment='peer-me')
+        self.registry.heartbeat(pool='trough-read', node='test02', ttl=600, segment='peer-me')
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.dict(settings, {'PEER_TRANSFER': True, 'LOCAL_DATA': tmp_dir}):
+            controller = self.make_fresh_controller()
+            segment = sync.Segment('peer-me', 0, self.rethinker, self.services, self.registry)
+            # no checksum to go by, so straight to hdfs
+            with mock.patch('requests.get') as get:
+                assert not controller.copy_segment_from_peer(segment, None)
+                assert not get.called
+            # peer has another version
+            with mock.patch('requests.get', return_value=response(200, [data], checksum='old')):
+                assert not controller.copy_segment_from_peer(segment, checksum)
+            assert not os.path.exists(segment.local_path())
+            # resumes where it left off when the connection drops
+            with mock.patch('requests.get', side_effect=[
+                    response(200, interrupted()), response(206, [data[300:]])]) as get:
+                assert controller.copy_segment_from_peer(segment, checksum)
+            assert get.call_count == 2
+            assert get.call_args_list[0][0][0] == 'http://test02:%s/segment/peer-me/data' % settings['SYNC_LOCAL_PORT']
+            assert get.call_args_list[1][1]['headers'] == {'Range': 'bytes=300-', 'If-Range': '"v1"'}
+            with open(segment.local_path(), 'rb') as f:
+                assert f.read() == data
+
+    def test_collect_garbage_extra_replicas(self):
+        self.rethinker.table('lock').delete().run()
+        self.rethinker.table('assignment').delete().run()
+        self.rethinker.table(sync.ReadStats.table).delete().run()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            controller = self.make_fresh_controller()
+            controller.local_data = tmp_dir
+            for segment_id in ['extra-a', 'extra-b', 'extra-c', 'extra-stale']:
+                with open(os.path.join(tmp_dir, '%s.sqlite' % segment_id), 'wb') as f:
+                    f.write(b'x' * 10)
+                controller.registry.heartbeat(pool='trough-read', node='test02', ttl=600, segment=segment_id)
+                if segment_id != 'extra-stale':
+                    controller.healthy_service_ids.add(controller.read_id_tmpl % segment_id)
+            sync.ReadStats.record(self.rethinker, {'extra-c': 1})
+            time.sleep(0.01)
+            sync.ReadStats.record(self.rethinker, {'extra-b': 1})
+            with mock.patch.object(controller.registry, 'segments_for_host', return_value=[]), \
+                    mock.patch.dict(settings, {'LOCAL_CACHE_EXTRA_REPLICAS': True}):
+                # plenty of room, only the segment we're not serving goes
+                controller.storage_in_bytes = 100
+                controller.collect_garbage()
+                assert sorted(os.listdir(tmp_dir)) == ['extra-a.sqlite', 'extra-b.sqlite', 'extra-c.sqlite']
+                # over the high watermark (27 bytes), evicts never read
+                # 'extra-a' to get under the low watermark (24 bytes)
+                controller.storage_in_bytes = 30
+                controller.collect_garbage()
+                assert sorted(os.listdir(tmp_dir)) == ['extra-b.sqlite', 'extra-c.sqlite']
+                assert controller.read_id_tmpl % 'extra-a' not in controller.healthy_service_ids
+                # then least recently read 'extra-c'
+                controller.storage_in_bytes = 20
+                controller.collect_garbage()
+                assert sorted(os.listdir(tmp_dir)) == ['extra-b.sqlite']
+
 
 if __name__ == '__main__':
     unittest.main()
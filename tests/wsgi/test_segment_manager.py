@@ -1,5 +1,6 @@
 import pytest
-from trough.wsgi.segment_manager import server
+from unittest import mock
+from trough.wsgi.segment_manager import server, make_app
 import ujson
 import trough
 from trough.settings import settings
@@ -476,3 +477,34 @@ def test_delete_segment(segment_manager_server):
     with pytest.raises(FileNotFoundError):
         hdfs_ls = hdfs.ls(expected_remote_path, detail=True)
 
+def test_segment_data():
+    controller = mock.Mock()
+    app = make_app(controller)
+    app.testing = True
+    client = app.test_client()
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(b'0123456789')
+        f.flush()
+        controller.peer_transfer_source.return_value = (f.name, 'abc')
+
+        # off by default
+        result = client.get('/segment/test_segment_data/data')
+        assert result.status_code == 404
+
+        with mock.patch.dict(settings, {'PEER_TRANSFER': True}):
+            result = client.get('/segment/test_segment_data/data')
+            assert result.status_code == 200
+            assert result.data == b'0123456789'
+            assert result.headers['X-Trough-Checksum'] == 'abc'
+            controller.peer_transfer_source.assert_called_with('test_segment_data')
+
+            result = client.get(
+                    '/segment/test_segment_data/data', headers={
+                        'Range': 'bytes=4-', 'If-Range': result.headers['ETag']})
+            assert result.status_code == 206
+            assert result.data == b'456789'
+
+            # no up to date copy here
+            controller.peer_transfer_source.side_effect = KeyError('nope')
+            result = client.get('/segment/test_segment_data/data')
+            assert result.status_code == 404
@@ -31,7 +31,10 @@ import datetime
 import threading
 import time
 import collections
+from concurrent import futures
 from aiohttp import ClientSession
+from trough.placement import segment_shard
+from trough.membership import SegmentMembership, read_services_query, all_read_services_query
 
 class TroughException(Exception):
     def __init__(self, message, payload=None, returned_message=None):
@@ -42,10 +45,24 @@ class TroughException(Exception):
 class TroughSegmentNotFound(TroughException):
     pass
 
+# result of one segment's query in `TroughClient.read_many()`; exactly one of
+# `result` and `error` is not None
+ReadResult = collections.namedtuple('ReadResult', ['segment', 'result', 'error'])
+
 class TroughClient(object):
     logger = logging.getLogger('trough.client.TroughClient')
 
-    def __init__(self, rethinkdb_trough_db_url, promotion_interval=None):
+    # max number of segment ids per rethinkdb `get_all()` in `read_urls()`
+    READ_URL_BATCH_SIZE = 1000
+    # max seconds to wait before retrying a failed promotion
+    MAX_PROMOTION_BACKOFF = 3600
+    # seconds between checks for the segment_membership table, until it
+    # shows up
+    MEMBERSHIP_CHECK_INTERVAL = 60
+
+    def __init__(
+            self, rethinkdb_trough_db_url, promotion_interval=None,
+            http_pool_size=20, promotion_workers=4):
         '''
         TroughClient constructor
 
@@ -56,19 +73,41 @@ class TroughClient(object):
                 thread that "promotes" (pushed to hdfs) "dirty" trough segments
                 (segments that have received writes) periodically, sleeping for
                 `promotion_interval` seconds between cycles (default None)
+            http_pool_size: max number of keep-alive http connections to keep
+                open per trough worker; should be at least as big as the
+                `max_workers` passed to `read_many()` (default 20)
+            promotion_workers: max number of segment promotions to run at
+                once, if `promotion_interval` is specified (default 4)
         '''
         parsed = doublethink.parse_rethinkdb_url(rethinkdb_trough_db_url)
         self.rr = doublethink.Rethinker(
                 servers=parsed.hosts, db=parsed.database)
         self.svcreg = doublethink.ServiceRegistry(self.rr)
+        self._http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+                pool_connections=http_pool_size, pool_maxsize=http_pool_size)
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
         self._write_url_cache = {}
         self._read_url_cache = {}
-        self._dirty_segments = set()
+        self._membership = False
+        self._membership_checked = 0
+        # { segment_id: time first dirtied since last promotion started }
+        self._dirty_segments = {}
+        # { segment_id: time first dirtied, of promotion in progress }
+        self._promotions_in_flight = {}
+        # { segment_id: (consecutive failures, time of next attempt) }
+        self._promotion_failures = {}
+        # { segment_id: seconds from dirtied to promoted, last promotion }
+        self._promotion_lag = {}
         self._dirty_segments_lock = threading.RLock()
 
         self.promotion_interval = promotion_interval
         self._promoter_thread = None
+        self._promotion_pool = None
         if promotion_interval:
+            self._promotion_pool = futures.ThreadPoolExecutor(
+                    max_workers=promotion_workers)
             self._promoter_thread = threading.Thread(
                     target=self._promotrix, name='TroughClient-promoter')
             self._promoter_thread.setDaemon(True)
@@ -78,28 +117,110 @@ class TroughClient(object):
         while True:
             time.sleep(self.promotion_interval)
             try:
-                with self._dirty_segments_lock:
-                    dirty_segments = list(self._dirty_segments)
-                    self._dirty_segments.clear()
-                self.logger.info(
-                        'promoting %s trough segments', len(dirty_segments))
-                for segment_id in dirty_segments:
-                    try:
-                        self.promote(segment_id)
-                    except:
-                        self.logger.error(
-                                'problem promoting segment %s', segment_id,
-                                exc_info=True)
+                self._start_promotions()
             except:
                 self.logger.error(
                         'caught exception doing segment promotion',
                         exc_info=True)
 
+    def _start_promotions(self):
+        '''
+        Submits dirty segments to the promotion pool, skipping segments whose
+        previous promotion is still in progress (they stay dirty and get
+        promoted again once it finishes) and segments backing off after a
+        failed promotion.
+        '''
+        now = time.time()
+        ready = []
+        with self._dirty_segments_lock:
+            for segment_id, dirtied in list(self._dirty_segments.items()):
+                if segment_id in self._promotions_in_flight:
+                    continue
+                failures = self._promotion_failures.get(segment_id)
+                if failures and failures[1] > now:
+                    continue
+                del self._dirty_segments[segment_id]
+                self._promotions_in_flight[segment_id] = dirtied
+                ready.append(segment_id)
+            waiting = len(self._dirty_segments)
+            in_flight = len(self._promotions_in_flight)
+            oldest = min(
+                    list(self._dirty_segments.values())
+                    + list(self._promotions_in_flight.values()),
+                    default=now)
+        self.logger.info(
+                'promoting %s trough segments (%s promotions in flight, %s '
+                'dirty segments waiting, max promotion lag %0.1fs)',
+                len(ready), in_flight, waiting, now - oldest)
+        for segment_id in ready:
+            self._promotion_pool.submit(self._promote_dirty_segment, segment_id)
+
+    def _promote_dirty_segment(self, segment_id):
+        with self._dirty_segments_lock:
+            dirtied = self._promotions_in_flight[segment_id]
+        try:
+            self.promote(segment_id)
+            with self._dirty_segments_lock:
+                self._promotion_failures.pop(segment_id, None)
+                lag = self._promotion_lag[segment_id] = time.time() - dirtied
+            self.logger.debug(
+                    'promoted segment %s %0.1fs after it was dirtied',
+                    segment_id, lag)
+        except:
+            with self._dirty_segments_lock:
+                failures = self._promotion_failures.get(segment_id, (0, 0))[0] + 1
+                backoff = min(
+                        self.promotion_interval * 2 ** (failures - 1),
+                        self.MAX_PROMOTION_BACKOFF)
+                self._promotion_failures[segment_id] = (
+                        failures, time.time() + backoff)
+                # still dirty; keep the older timestamp so lag stays honest
+                self._dirty_segments[segment_id] = min(
+                        dirtied, self._dirty_segments.get(segment_id, dirtied))
+            self.logger.error(
+                    'problem promoting segment %s (%s consecutive failures, '
+                    'will retry in %ss)', segment_id, failures, backoff,
+                    exc_info=True)
+        finally:
+            with self._dirty_segments_lock:
+                del self._promotions_in_flight[segment_id]
+
+    def promotion_status(self):
+        '''
+        Returns dictionary `{segment_id: status}` for each segment that is
+        dirty, being promoted, backing off after failure, or has been promoted
+        by this client, where `status` is a dict with these keys:
+
+            'dirty_for': seconds since the segment received writes not yet
+                promoted, or None
+            'in_flight': whether a promotion is in progress
+            'failures': number of consecutive failed promotions
+            'last_lag': seconds from dirtied to promoted, last promotion
+        '''
+        now = time.time()
+        with self._dirty_segments_lock:
+            segment_ids = set(self._dirty_segments)
+            segment_ids.update(self._promotions_in_flight)
+            segment_ids.update(self._promotion_failures)
+            segment_ids.update(self._promotion_lag)
+            result = {}
+            for segment_id in segment_ids:
+                dirtied = min(
+                        self._dirty_segments.get(segment_id, now),
+                        self._promotions_in_flight.get(segment_id, now))
+                result[segment_id] = {
+                    'dirty_for': now - dirtied if dirtied < now else None,
+                    'in_flight': segment_id in self._promotions_in_flight,
+                    'failures': self._promotion_failures.get(segment_id, (0, 0))[0],
+                    'last_lag': self._promotion_lag.get(segment_id),
+                }
+        return result
+
     def promote(self, segment_id):
-        url = os.path.join(self.segment_manager_url(), 'promote')
+        url = os.path.join(self.segment_manager_url(segment_id), 'promote')
         payload_dict = {'segment': segment_id}
         self.logger.debug('posting %s to %s', json.dumps(payload_dict), url)
-        response = requests.post(url, json=payload_dict, timeout=21600)
+        response = self._http.post(url, json=payload_dict, timeout=21600)
         if response.status_code != 200:
             raise TroughException(
                     'unexpected response %r %r: %r from POST %r with '
@@ -130,7 +251,23 @@ class TroughClient(object):
                     "don't know how to make an sql value from %r (%r)" % (
                         x, type(x)))
 
-    def segment_manager_url(self):
+    def segment_manager_url(self, segment_id=None):
+        '''
+        Returns the url of the segment manager responsible for `segment_id`.
+        If the segment id space is split among several sync masters, that is
+        the healthy trough-segment-manager for the segment's shard, if there
+        is one. Otherwise it is the trough-sync-master.
+        '''
+        if segment_id is not None:
+            managers = list(self.svcreg.healthy_services('trough-segment-manager'))
+            if managers:
+                shard = segment_shard(segment_id, managers[0]['shards'])
+                for manager in managers:
+                    if manager['shard'] == shard:
+                        return manager['url']
+                self.logger.warning(
+                        'no healthy trough-segment-manager for shard %s, '
+                        'falling back to trough-sync-master', shard)
         master_node = self.svcreg.unique_service('trough-sync-master')
         if not master_node:
             raise TroughException(
@@ -138,7 +275,7 @@ class TroughClient(object):
         return master_node['url']
 
     def write_url_nocache(self, segment_id, schema_id='default'):
-        url = os.path.join(self.segment_manager_url(), 'provision')
+        url = os.path.join(self.segment_manager_url(segment_id), 'provision')
         payload_dict = {'segment': segment_id, 'schema': schema_id}
         self.logger.debug('posting %s to %s', json.dumps(payload_dict), url)
         response = requests.post(url, json=payload_dict, timeout=600)
@@ -152,13 +289,20 @@ class TroughClient(object):
         # assert result_dict['schema'] == schema_id  # previously provisioned?
         return result_dict['write_url']
 
+    def _include_membership(self):
+        '''
+        Whether to look for read services in the segment_membership table as
+        well, which is there once the trough servers have been upgraded.
+        '''
+        if not self._membership and time.time() - self._membership_checked > self.MEMBERSHIP_CHECK_INTERVAL:
+            self._membership = SegmentMembership.exists(self.rr)
+            self._membership_checked = time.time()
+        return self._membership
+
     def read_url_nocache(self, segment_id):
-        reql = self.rr.table('services', read_mode='outdated').get_all(
-                segment_id, index='segment').filter(
-                        {'role':'trough-read'}).filter(
-                                lambda svc: r.now().sub(
-                                    svc['last_heartbeat']).lt(svc['ttl'])
-                                ).order_by('load')
+        reql = read_services_query(
+                self.rr, [segment_id],
+                include_members=self._include_membership()).order_by('load')
         self.logger.debug('querying rethinkdb: %r', reql)
         results = reql.run()
         try:
@@ -168,6 +312,34 @@ class TroughClient(object):
                     'no read url for segment %s; usually this means the '
                     "segment hasn't been provisioned yet" % segment_id)
 
+    def read_urls(self, segment_ids):
+        '''
+        Looks up read urls for many segments at once, querying rethinkdb in
+        batches of `READ_URL_BATCH_SIZE` segments rather than once per
+        segment. Populates `self._read_url_cache` and returns dictionary
+        `{segment: url}`. Segments with no healthy read service are absent
+        from the result.
+        '''
+        segment_ids = list(segment_ids)
+        loads = {}
+        d = {}
+        for i in range(0, len(segment_ids), self.READ_URL_BATCH_SIZE):
+            batch = segment_ids[i:i+self.READ_URL_BATCH_SIZE]
+            reql = read_services_query(
+                    self.rr, batch,
+                    include_members=self._include_membership())
+            self.logger.debug(
+                    'querying rethinkdb for read urls of %s segments',
+                    len(batch))
+            for result in reql.run():
+                # pick the least loaded copy, like read_url_nocache() does
+                load = result.get('load') or 0
+                if result['segment'] not in d or load < loads[result['segment']]:
+                    d[result['segment']] = result['url']
+                    loads[result['segment']] = load
+        self._read_url_cache.update(d)
+        return d
+
     def read_urls_for_regex(self, regex):
         '''
         Looks up read urls for segments matching `regex`.
@@ -175,11 +347,8 @@ class TroughClient(object):
         `{segment: url}`
         '''
         d = {}
-        reql = self.rr.table('services', read_mode='outdated')\
-                .filter({'role': 'trough-read'})\
-                .filter(r.row.has_fields('segment'))\
-                .filter(lambda svc: svc['segment'].coerce_to('string').match(regex))\
-                .filter(lambda svc: r.now().sub(svc['last_heartbeat']).lt(svc['ttl']))
+        reql = all_read_services_query(
+                self.rr, regex, include_members=self._include_membership())
         self.logger.debug('querying rethinkdb: %r', reql)
         results = reql.run()
         for result in results:
@@ -201,13 +370,8 @@ class TroughClient(object):
             return None
 
     def readable_segments(self, regex=None):
-        reql = self.rr.table('services', read_mode='outdated')\
-                .filter({'role':'trough-read'})\
-                .filter(lambda svc: r.now().sub(svc['last_heartbeat'])\
-                                           .lt(svc['ttl']))
-        if regex:
-            reql = reql.filter(
-                    lambda svc: svc['segment'].coerce_to('string').match(regex))
+        reql = all_read_services_query(
+                self.rr, regex, include_members=self._include_membership())
         self.logger.debug('querying rethinkdb: %r', reql)
         results = reql.run()
         for result in reql.run():
@@ -251,7 +415,7 @@ class TroughClient(object):
                             response.text, write_url, sql_bytes), sql_bytes, response.text)
             if segment_id not in self._dirty_segments:
                 with self._dirty_segments_lock:
-                    self._dirty_segments.add(segment_id)
+                    self._dirty_segments.setdefault(segment_id, time.time())
         except Exception as e:
             self._write_url_cache.pop(segment_id, None)
             raise e
@@ -261,7 +425,7 @@ class TroughClient(object):
         sql = sql_tmpl % tuple(self.sql_value(v) for v in values)
         sql_bytes = sql.encode('utf-8')
         try:
-            response = requests.post(
+            response = self._http.post(
                     read_url, sql_bytes, timeout=600,
                     headers={'content-type': 'application/sql;charset=utf-8'})
             if response.status_code != 200:
@@ -278,6 +442,60 @@ class TroughClient(object):
             self._read_url_cache.pop(segment_id, None)
             raise e
 
+    def read_many(
+            self, segment_ids, sql_tmpl, values=(), max_workers=10,
+            ordered=True):
+        '''
+        Runs the same query against many segments, `max_workers` at a time.
+
+        Read urls for segments not already cached are looked up up front with
+        `read_urls()`, and queries go over the client's pool of keep-alive
+        http connections.
+
+        Failure to query one segment does not stop the others. Instead, each
+        segment gets a `ReadResult(segment, result, error)`, where `error` is
+        the exception raised by `read()` for that segment, if any.
+
+        Args:
+            segment_ids: iterable of segment ids to query
+            sql_tmpl: sql to run against each segment, see `read()`
+            values: values for `sql_tmpl`, see `read()`
+            max_workers: max number of queries in flight at once
+            ordered: if True, results are yielded in the order of
+                `segment_ids`; if False, they are yielded as soon as they
+                complete
+
+        Returns:
+            generator of `ReadResult`
+        '''
+        segment_ids = list(segment_ids)
+        uncached = [s for s in segment_ids if not self._read_url_cache.get(s)]
+        if uncached:
+            self.read_urls(uncached)
+
+        pool = futures.ThreadPoolExecutor(max_workers=max_workers)
+        fs = {}
+        try:
+            for segment_id in segment_ids:
+                future = pool.submit(self.read, segment_id, sql_tmpl, values)
+                fs[future] = segment_id
+            if ordered:
+                completed = iter(fs)
+            else:
+                completed = futures.as_completed(fs)
+            for future in completed:
+                try:
+                    yield ReadResult(fs[future], future.result(), None)
+                except Exception as e:
+                    self.logger.debug(
+                            'problem reading segment %s: %s', fs[future], e)
+                    yield ReadResult(fs[future], None, e)
+        finally:
+            # in case the caller stopped iterating early
+            for future in fs:
+                future.cancel()
+            pool.shutdown(wait=False)
+
     async def async_read(self, segment_id, sql_tmpl, values=()):
         read_url = self.read_url(segment_id)
         sql = sql_tmpl % tuple(self.sql_value(v) for v in values)
@@ -322,7 +540,7 @@ class TroughClient(object):
                         url, sql))
 
     def delete_segment(self, segment_id):
-        url = os.path.join(self.segment_manager_url(), 'segment', segment_id)
+        url = os.path.join(self.segment_manager_url(segment_id), 'segment', segment_id)
         self.logger.debug('DELETE %s', url)
         response = requests.delete(url, timeout=1200)
         if response.status_code == 404:
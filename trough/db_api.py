@@ -1,118 +1,373 @@
+'''
+trough/db_api.py - DB-API 2.0 (PEP 249) driver for trough
+
+Usage:
+
+    conn = trough.db_api.connect(
+            database='my-segment', rethinkdb=['rethinkdb01', 'rethinkdb02'])
+    cursor = conn.cursor()
+    cursor.execute('select * from crawled_url where url = %s', (url,))
+    for row in cursor:
+        ...
+
+Segment routing (read url and write url of each segment) is cached for
+`ROUTE_CACHE_TTL` seconds and shared by all connections to the same rethinkdb
+servers, and http connections to trough workers are kept alive and reused, so
+a statement normally costs exactly one http round trip. SELECT results are
+streamed from the trough read server as they are fetched, rather than
+buffered in full.
+'''
 import rethinkdb as r
 import ujson as json
-import datetime
-import re
 import doublethink
-import pycurl
-from io import BytesIO
 import logging
-from urllib.parse import urlparse, urlencode
-from http.client import HTTPConnection
+import sqlparse
+import threading
+import time
+from urllib.parse import urlparse
+from http.client import HTTPConnection, HTTPException
 import socks
+from trough.client import TroughClient
+from trough.placement import segment_shard
+from trough.membership import SegmentMembership, read_services_query
+
+apilevel = '2.0'
+threadsafety = 1 # threads may share the module, but not connections
+paramstyle = 'format'
+
+class Warning(Exception):
+    pass
+
+class Error(Exception):
+    pass
+
+class InterfaceError(Error):
+    pass
+
+class DatabaseError(Error):
+    pass
+
+class DataError(DatabaseError):
+    pass
+
+class OperationalError(DatabaseError):
+    pass
+
+class IntegrityError(DatabaseError):
+    pass
+
+class InternalError(DatabaseError):
+    pass
+
+class ProgrammingError(DatabaseError):
+    pass
+
+class NotSupportedError(DatabaseError):
+    pass
+
+# seconds to trust a cached read url or write url for a segment
+ROUTE_CACHE_TTL = 60
+# max bytes of sql to send to the write server in one request in executemany()
+MAX_WRITE_BATCH_BYTES = 4 * 1024 * 1024
 
 def healthy_services_query(rethinker, role):
     return rethinker.table('services').filter({"role": role}).filter(
         lambda svc: r.now().sub(svc["last_heartbeat"]) < svc["ttl"]
     )
 
+class _Router:
+    '''
+    Looks up and caches the read url and write url of segments. One instance
+    is shared by all connections to the same rethinkdb servers.
+    '''
+    logger = logging.getLogger('trough.db_api._Router')
+
+    _routers = {}
+    _routers_lock = threading.Lock()
+
+    @classmethod
+    def for_servers(cls, servers):
+        if isinstance(servers, str):
+            servers = [servers]
+        key = tuple(sorted(servers or ['localhost']))
+        with cls._routers_lock:
+            if key not in cls._routers:
+                cls._routers[key] = cls(list(key))
+            return cls._routers[key]
+
+    def __init__(self, servers):
+        self.rethinker = doublethink.Rethinker(
+                db='trough_configuration', servers=servers)
+        self._services = None
+        # whether the segment_membership table exists yet
+        self._membership = False
+        self._membership_checked = 0
+        self._read_urls = {}  # { segment: (url, expires) }
+        self._write_urls = {} # { segment: (url, expires) }
+
+    def read_url(self, segment):
+        url, expires = self._read_urls.get(segment, (None, 0))
+        if expires > time.time():
+            return url
+        if not self._membership and time.time() - self._membership_checked > ROUTE_CACHE_TTL:
+            self._membership = SegmentMembership.exists(self.rethinker)
+            self._membership_checked = time.time()
+        reql = read_services_query(
+                self.rethinker, [segment],
+                include_members=self._membership).order_by('load')
+        results = list(reql.run())
+        if not results:
+            raise OperationalError(
+                    'No healthy node found for segment %s' % segment)
+        url = results[0]['url']
+        self._read_urls[segment] = (url, time.time() + ROUTE_CACHE_TTL)
+        return url
+
+    def write_url(self, segment, connection):
+        url, expires = self._write_urls.get(segment, (None, 0))
+        if expires > time.time():
+            return url
+        if not self._services:
+            self._services = doublethink.ServiceRegistry(self.rethinker)
+        master_node = None
+        # the sync master for the segment's shard, if there is more than one
+        managers = list(self._services.healthy_services('trough-segment-manager'))
+        if managers:
+            shard = segment_shard(segment, managers[0]['shards'])
+            master_node = next((m for m in managers if m['shard'] == shard), None)
+        if not master_node:
+            master_node = self._services.unique_service('trough-sync-master')
+        if not master_node:
+            raise OperationalError(
+                    'no healthy trough-sync-master in service registry')
+        status, body = connection._request(
+                master_node['url'], segment.encode('utf-8'))
+        if status != 200:
+            raise OperationalError(
+                    'unexpected response %r %r provisioning segment %s' % (
+                        status, body, segment))
+        url = body.decode('utf-8').strip()
+        self.logger.info('segment %r write url is %r', segment, url)
+        self._write_urls[segment] = (url, time.time() + ROUTE_CACHE_TTL)
+        return url
+
+    def invalidate(self, segment):
+        self._read_urls.pop(segment, None)
+        self._write_urls.pop(segment, None)
+
+def _sql_literal(value):
+    try:
+        return TroughClient.sql_value(value)
+    except Exception as e:
+        raise ProgrammingError(str(e))
+
+def _render(operation, parameters):
+    if parameters is None:
+        return operation
+    try:
+        if isinstance(parameters, dict):
+            return operation % {
+                    k: _sql_literal(v) for k, v in parameters.items()}
+        return operation % tuple(_sql_literal(v) for v in parameters)
+    except (TypeError, ValueError, KeyError) as e:
+        raise ProgrammingError(
+                'problem substituting parameters into %.200r: %s' % (
+                    operation, e))
+
+def _is_select(sql):
+    statements = sqlparse.parse(sql)
+    return bool(statements) and statements[0].get_type() == 'SELECT'
+
 class TroughCursor():
-    def __init__(self, database=None, rethinkdb=None, proxy=None, proxy_port=9000, proxy_type='SOCKS5'):
-        self.database = database
-        self.rethinkdb = rethinkdb
-        self.proxy = proxy
-        self.proxy_port = proxy_port
-        self.proxy_type = socks.PROXY_TYPE_SOCKS5 if proxy_type == 'SOCKS5' else socks.PROXY_TYPE_SOCKS4
-        # use this flag to save time. don't provision database for each query.
-        self._writable = False
-        #self.rethinker = doublethink.rethinker()
-        self._write_url = None
-
-    def _do_read(self, query, raw=False):
-        # send query to server, return JSON
-        rethinker = doublethink.Rethinker(db="trough_configuration", servers=self.rethinkdb)
-        healthy_databases = list(rethinker.table('services').get_all(self.database, index='segment').run())
-        healthy_databases = [db for db in healthy_databases if db['role'] == 'trough-read' and (rethinker.now().run() - db['last_heartbeat']).seconds < db['ttl']]
+    def __init__(self, connection):
+        self.connection = connection
+        self.arraysize = 100
+        self.description = None
+        self.rowcount = -1
+        self._conn = None
+        self._rows = iter(())
+        self._closed = False
+
+    def _reset(self):
+        if self._conn:
+            # result set not fully read, can't reuse the http connection
+            self._conn.close()
+            self._conn = None
+        self.description = None
+        self.rowcount = -1
+        self._rows = iter(())
+
+    def _check_open(self):
+        if self._closed or self.connection._closed:
+            raise InterfaceError('cursor is closed')
+
+    def _do_read(self, query):
+        router = self.connection._router
+        url = router.read_url(self.connection.database)
         try:
-            assert len(healthy_databases) > 0
-        except:
-            raise Exception('No healthy node found for segment %s' % self.database)
-        url = urlparse(healthy_databases[0].get('url'))
-        if self.proxy:
-            conn = HTTPConnection(self.proxy, self.proxy_port)
-            conn.set_tunnel(url.netloc, url.port)
-            conn.sock = socks.socksocket()
-            conn.sock.set_proxy(self.proxy_type, self.proxy, self.proxy_port)
-            conn.sock.connect((url.netloc.split(":")[0], url.port))
+            conn, response = self.connection._open(url, query)
+        except Exception:
+            router.invalidate(self.connection.database)
+            raise
+        if response.status != 200:
+            body = response.read()
+            self.connection._release(conn)
+            router.invalidate(self.connection.database)
+            raise OperationalError(
+                    'Trough Query Failed: Database: %r Response: %r %r '
+                    'Query: %.200r' % (
+                        self.connection.database, response.status, body,
+                        query))
+        self._conn = conn
+        columns = response.getheader('X-Trough-Columns')
+        rows = self._stream_rows(conn, response)
+        if columns is not None:
+            columns = json.loads(columns)
         else:
-            conn = HTTPConnection(url.netloc)
-        request_path = "%s?%s" % (url.path, url.query)
-        conn.request("POST", request_path, query)
-        response = conn.getresponse()
-        results = json.loads(response.read())
-        self._last_results = results
+            # older read server, learn the columns from the first row
+            first = next(rows, None)
+            columns = list(first.keys()) if first else []
+            if first:
+                rows = self._prepend(first, rows)
+        self.description = [(c, None, None, None, None, None, None) for c in columns]
+        self._rows = (tuple(row.get(c) for c in columns) for row in rows)
+
+    @staticmethod
+    def _prepend(first, rows):
+        yield first
+        yield from rows
+
+    def _stream_rows(self, conn, response):
+        '''
+        Parses the read server's response incrementally. The read server
+        writes a json list with one row per line.
+        '''
+        complete = False
+        while True:
+            line = response.readline()
+            if not line:
+                break
+            line = line.strip()
+            if line.startswith(b'['):
+                line = line[1:]
+            if line.endswith(b']'):
+                line = line[:-1]
+                complete = True
+            elif line.endswith(b','):
+                line = line[:-1]
+            if line:
+                yield json.loads(line)
+        self._conn = None
+        if not complete:
+            conn.close()
+            raise OperationalError(
+                    'result stream for segment %r ended prematurely' % (
+                        self.connection.database))
+        self.connection._release(conn)
 
     def _do_write(self, query):
-        # send provision query to server if not self._write_url.
-        # after send provision query, set self._write_url.
-        # send query to server, return JSON
-        rethinker = doublethink.Rethinker(db="trough_configuration", servers=self.rethinkdb)
-        services = doublethink.ServiceRegistry(rethinker)
-        master_node = services.unique_service('trough-sync-master')
-        logging.info('master_node=%r', master_node)
-        if not master_node:
-            raise Exception('no healthy trough-sync-master in service registry')
-        if not self._write_url:
-            buffer = BytesIO()
-            c = pycurl.Curl()
-            c.setopt(c.URL, master_node.get('url'))
-            c.setopt(c.POSTFIELDS, self.database)
-            if self.proxy:
-                c.setopt(pycurl.PROXY, self.proxy)
-                c.setopt(pycurl.PROXYPORT, int(self.proxy_port))
-                c.setopt(pycurl.PROXYTYPE, self.proxy_type)
-            c.setopt(c.WRITEDATA, buffer)
-            c.perform()
-            c.close()
-            self._write_url = buffer.getvalue()
-            logging.info('self._write_url=%r', self._write_url)
-        buffer = BytesIO()
-        c = pycurl.Curl()
-        c.setopt(c.URL, self._write_url)
-        c.setopt(c.POSTFIELDS, query)
-        if self.proxy:
-            c.setopt(pycurl.PROXY, self.proxy)
-            c.setopt(pycurl.PROXYPORT, int(self.proxy_port))
-            c.setopt(pycurl.PROXYTYPE, self.proxy_type)
-        c.setopt(c.WRITEDATA, buffer)
-        c.perform()
-        c.close()
-        response = buffer.getvalue()
-        if response.strip() != b'OK':
-            raise Exception('Trough Query Failed: Database: %r Response: %r Query: %.200r' % (self.database, response, query))
-        self._last_results = None
-    def execute(self, sql, params=[], force=None, raw=False):
-        query = sql % tuple(repr(param) for param in params)
-        if force=='read' or query.strip()[:6].lower() == 'select':
-            return self._do_read(query, raw)
-        return self._do_write(query)
-    def executemany(self, queries):
-        query_types = set()
-        split_queries = sqlparse.split(queries, encoding=None)
-        for query in split_queries:
-            query_types = (query.strip()[:6].lower() == 'select')
-        if len(query_types > 1):
-            raise Exception('Queries passed to executemany() must be exclusively SELECT or non-SELECT queries.')
-        return self.execute(queries, force='read' if True in query_types else 'write')
+        router = self.connection._router
+        url = router.write_url(self.connection.database, self.connection)
+        try:
+            status, body = self.connection._request(url, query)
+        except Exception:
+            router.invalidate(self.connection.database)
+            raise
+        if body.strip() != b'OK':
+            router.invalidate(self.connection.database)
+            raise OperationalError(
+                    'Trough Query Failed: Database: %r Response: %r Query: '
+                    '%.200r' % (self.connection.database, body, query))
+
+    def execute(self, operation, parameters=None, force=None):
+        self._check_open()
+        self._reset()
+        query = _render(operation, parameters)
+        if force == 'read' or (force != 'write' and _is_select(query)):
+            self._do_read(query.encode('utf-8'))
+        else:
+            self._do_write(query.encode('utf-8'))
+        return self
+
+    def executemany(self, operation, seq_of_parameters):
+        '''
+        Executes a write statement once for each item of `seq_of_parameters`,
+        sending the statements to the write server in batches of up to
+        `MAX_WRITE_BATCH_BYTES` per request, each of which runs in a single
+        transaction.
+        '''
+        self._check_open()
+        self._reset()
+        if _is_select(operation):
+            raise ProgrammingError(
+                    'executemany() does not support SELECT statements')
+        batch = []
+        batch_bytes = 0
+        for parameters in seq_of_parameters:
+            statement = _render(operation, parameters).strip().rstrip(';')
+            statement = statement.encode('utf-8') + b';\n'
+            if batch and batch_bytes + len(statement) > MAX_WRITE_BATCH_BYTES:
+                self._do_write(b''.join(batch))
+                batch = []
+                batch_bytes = 0
+            batch.append(statement)
+            batch_bytes += len(statement)
+        if batch:
+            self._do_write(b''.join(batch))
+        return self
+
     def executescript(self, queries):
-        self.executemany(queries)
+        self._check_open()
+        self._reset()
+        statements = [s for s in sqlparse.split(queries) if s.strip()]
+        selects = [_is_select(s) for s in statements]
+        if any(selects) and not all(selects):
+            raise ProgrammingError(
+                    'Queries passed to executescript() must be exclusively '
+                    'SELECT or non-SELECT queries.')
+        if any(selects):
+            if len(statements) > 1:
+                raise NotSupportedError(
+                        'trough runs exactly one SELECT query per request')
+            return self.execute(statements[0], force='read')
+        return self.execute(queries, force='write')
+
     def close(self):
-        pass
-    def fetchall(self):
-        return self._last_results
-    def fetchmany(self, size=100):
-        return self._last_results[0:size]
+        self._reset()
+        self._closed = True
+
     def fetchone(self):
-        return [v for k,v in self._last_results[0].items()]
+        self._check_open()
+        return next(self._rows, None)
+
+    def fetchmany(self, size=None):
+        self._check_open()
+        size = size or self.arraysize
+        rows = []
+        for row in self._rows:
+            rows.append(row)
+            if len(rows) >= size:
+                break
+        return rows
+
+    def fetchall(self):
+        self._check_open()
+        return list(self._rows)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def setinputsizes(self, sizes):
+        pass
+
+    def setoutputsize(self, size, column=None):
+        pass
 
 class TroughConnection():
     def __init__(self, *args, database=None, rethinkdb=None, proxy=None, proxy_port=9000, proxy_type='SOCKS5', **kwargs):
@@ -120,23 +375,76 @@ class TroughConnection():
         self.rethinkdb = rethinkdb
         self.proxy = proxy
         self.proxy_port = int(proxy_port)
-        self.proxy_type = proxy_type
+        self.proxy_type = socks.PROXY_TYPE_SOCKS5 if proxy_type == 'SOCKS5' else socks.PROXY_TYPE_SOCKS4
+        self._router = _Router.for_servers(rethinkdb)
+        self._idle = {} # { netloc: [HTTPConnection] }
+        self._closed = False
+
+    def _connect(self, url):
+        if self.proxy:
+            conn = HTTPConnection(self.proxy, self.proxy_port)
+            conn.set_tunnel(url.netloc, url.port)
+            conn.sock = socks.socksocket()
+            conn.sock.set_proxy(self.proxy_type, self.proxy, self.proxy_port)
+            conn.sock.connect((url.netloc.split(":")[0], url.port))
+        else:
+            conn = HTTPConnection(url.netloc)
+        return conn
+
+    def _open(self, url, body):
+        '''
+        Posts `body` to `url` over a kept-alive http connection if there is
+        one. Returns `(conn, response)`; the caller must read the response
+        in full and then pass `conn` to `_release()`, or close `conn`.
+        '''
+        if self._closed:
+            raise InterfaceError('connection is closed')
+        url = urlparse(url)
+        path = "%s?%s" % (url.path or '/', url.query)
+        idle = self._idle.setdefault(url.netloc, [])
+        while True:
+            reused = bool(idle)
+            conn = idle.pop() if reused else self._connect(url)
+            try:
+                conn.request("POST", path, body)
+                response = conn.getresponse()
+                conn._trough_netloc = url.netloc
+                return conn, response
+            except (HTTPException, OSError) as e:
+                conn.close()
+                if not reused:
+                    raise OperationalError(
+                            'problem posting to %s: %s' % (url.geturl(), e))
+                # server closed the idle connection, try another
+
+    def _request(self, url, body):
+        conn, response = self._open(url, body)
+        data = response.read()
+        self._release(conn)
+        return response.status, data
+
+    def _release(self, conn):
+        if self._closed or conn.sock is None:
+            conn.close()
+        else:
+            self._idle.setdefault(conn._trough_netloc, []).append(conn)
+
     def cursor(self):
-        return TroughCursor(database=self.database,
-            rethinkdb=self.rethinkdb,
-            proxy=self.proxy,
-            proxy_port=self.proxy_port,
-            proxy_type=self.proxy_type)
-    def execute(self, query):
-        return self.cursor().execute(query)
-    def executemany(self, queries):
-        return self.cursor().executemany(query)
+        return TroughCursor(self)
+    def execute(self, query, parameters=None):
+        return self.cursor().execute(query, parameters)
+    def executemany(self, query, seq_of_parameters):
+        return self.cursor().executemany(query, seq_of_parameters)
     def executescript(self, queries):
-        return self.cursor().executescript(query)
+        return self.cursor().executescript(queries)
     def close(self):
-        pass
+        self._closed = True
+        for conns in self._idle.values():
+            for conn in conns:
+                conn.close()
+        self._idle.clear()
     def commit(self):
         pass
 
 def connect(*args, **kwargs):
-    return TroughConnection(**kwargs)
\ No newline at end of file
+    return TroughConnection(**kwargs)
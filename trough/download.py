@@ -0,0 +1,279 @@
+'''
+trough/download.py - prioritized, rate limited segment downloads
+
+Copyright (C) 2017-2019 Internet Archive
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+USA.
+'''
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+class TokenBucket:
+    '''
+    Limits throughput to `rate` bytes per second, with bursts of up to
+    `burst` bytes. Reserving more than is available puts the bucket in debt,
+    which the next reservation has to wait out, so that a download bigger
+    than the burst size still goes through, and the average rate holds.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n):
+        '''Takes `n` bytes worth of tokens, returns seconds to wait before using them.'''
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0, -self.tokens / self.rate)
+            self.tokens -= n
+            return wait
+
+class Download:
+    '''
+    A download waiting its turn. `fn()` does the work and returns True on
+    success. Lower `priority` goes first.
+    '''
+    def __init__(self, key, size, priority, fn, source=None):
+        self.key = key
+        self.size = size or 0
+        self.priority = priority
+        self.fn = fn
+        self.source = source
+        self.attempts = 0
+        self.not_before = 0
+        self.dropped = False
+
+    def __repr__(self):
+        return '<Download:key=%r,size=%r,priority=%r,attempts=%r>' % (
+                self.key, self.size, self.priority, self.attempts)
+
+class DownloadScheduler:
+    '''
+    Runs downloads on `threads` worker threads, highest priority first,
+    keeping to `max_bytes_per_sec` overall and `max_bytes_per_sec_per_datanode`
+    for each hdfs datanode (going by `locate(source)`, which returns a dict of
+    { datanode: bytes }). Failed downloads are retried after `retry_delay`
+    seconds, doubling with each failure up to `max_retry_delay`.
+
+    The queue outlives sync loops: each loop hands `schedule()` everything
+    that needs downloading as of now, which replaces what was queued before,
+    keeping track of retries.
+    '''
+    # how far back to look when working out the download rate
+    RATE_WINDOW = 600
+
+    def __init__(
+            self, threads, max_bytes_per_sec=None,
+            max_bytes_per_sec_per_datanode=None, locate=None,
+            retry_delay=60, max_retry_delay=3600):
+        self.threads = threads
+        self.bucket = TokenBucket(max_bytes_per_sec) if max_bytes_per_sec else None
+        self.max_bytes_per_sec_per_datanode = max_bytes_per_sec_per_datanode
+        self.datanode_buckets = {}
+        self.locate = locate
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._cond = threading.Condition()
+        # { key: Download } of downloads waiting to run
+        self._pending = {}
+        # { key: Download } of downloads running now
+        self._running = {}
+        # (priority, seq, key) of pending downloads that are ready to run;
+        # entries whose download has been dropped or rescheduled are skipped
+        self._ready = []
+        # (not_before, seq, key) of pending downloads waiting to be retried
+        self._delayed = []
+        self._entries = {}  # { key: seq of its current heap entry }
+        self._seq = itertools.count()
+        # (time, bytes) of recently finished downloads
+        self._finished = collections.deque()
+        self._workers = []
+
+    def start(self):
+        if not self._workers:
+            for i in range(self.threads):
+                worker = threading.Thread(
+                        target=self._work, daemon=True,
+                        name='DownloadWorker-%s' % i)
+                worker.start()
+                self._workers.append(worker)
+
+    def schedule(self, downloads):
+        '''
+        Makes `downloads` the set of downloads to do, dropping any queued
+        ones that aren't in it. Downloads that are already running carry on.
+        '''
+        self.start()
+        with self._cond:
+            keys = {download.key for download in downloads}
+            for key, download in self._running.items():
+                download.dropped = key not in keys
+            old_pending, self._pending = self._pending, {}
+            self._ready = []
+            self._delayed = []
+            self._entries = {}
+            for download in downloads:
+                running = self._running.get(download.key)
+                if running:
+                    running.priority = download.priority
+                    continue
+                old = old_pending.get(download.key)
+                if old:
+                    download.attempts = old.attempts
+                    download.not_before = old.not_before
+                self._push(download)
+            self._cond.notify_all()
+
+    def _push(self, download):
+        self._pending[download.key] = download
+        seq = next(self._seq)
+        self._entries[download.key] = seq
+        if download.not_before > time.time():
+            heapq.heappush(self._delayed, (download.not_before, seq, download.key))
+        else:
+            heapq.heappush(self._ready, (download.priority, seq, download.key))
+
+    def _next(self):
+        '''Returns the next download to run, or None. Call with the lock held.'''
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            not_before, seq, key = heapq.heappop(self._delayed)
+            if self._entries.get(key) == seq:
+                download = self._pending[key]
+                heapq.heappush(self._ready, (download.priority, seq, key))
+        while self._ready:
+            priority, seq, key = heapq.heappop(self._ready)
+            if self._entries.get(key) == seq:
+                del self._entries[key]
+                return self._pending.pop(key)
+        return None
+
+    def _throttle(self, download):
+        '''Returns how long to wait before starting `download`.'''
+        wait = 0
+        if self.bucket:
+            wait = self.bucket.reserve(download.size)
+        if self.max_bytes_per_sec_per_datanode and self.locate and download.source:
+            try:
+                datanodes = self.locate(download.source)
+            except Exception as e:
+                logging.warning('could not find datanodes for %s: %s', download.source, e)
+                datanodes = {}
+            for datanode, nbytes in datanodes.items():
+                bucket = self.datanode_buckets.get(datanode)
+                if bucket is None:
+                    bucket = self.datanode_buckets.setdefault(
+                            datanode, TokenBucket(self.max_bytes_per_sec_per_datanode))
+                wait = max(wait, bucket.reserve(nbytes))
+        return wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                download = self._next()
+                while download is None:
+                    timeout = None
+                    if self._delayed:
+                        timeout = max(0, self._delayed[0][0] - time.time())
+                    self._cond.wait(timeout)
+                    download = self._next()
+                self._running[download.key] = download
+            wait = self._throttle(download)
+            if wait:
+                logging.debug('waiting %0.1f sec to download %r, to keep under the rate limit', wait, download.key)
+                time.sleep(wait)
+            try:
+                succeeded = download.fn()
+            except Exception as e:
+                logging.error('problem downloading %r', download.key, exc_info=True)
+                succeeded = False
+            with self._cond:
+                del self._running[download.key]
+                if succeeded:
+                    self._finished.append((time.time(), download.size))
+                elif not download.dropped and download.key not in self._pending:
+                    download.attempts += 1
+                    delay = min(
+                            self.retry_delay * 2 ** (download.attempts - 1),
+                            self.max_retry_delay)
+                    download.not_before = time.time() + delay
+                    logging.info(
+                            'download of %r failed (%s attempts), will retry '
+                            'in %s sec', download.key, download.attempts, delay)
+                    self._push(download)
+                self._cond.notify_all()
+
+    def join(self, timeout=None):
+        '''
+        Waits until nothing is running and nothing is ready to run (downloads
+        waiting to be retried don't count).
+
+        Returns:
+            True if that happened before `timeout`
+        '''
+        deadline = timeout and time.time() + timeout
+        with self._cond:
+            while self._running or self._ready_count():
+                remaining = deadline and deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _ready_count(self):
+        now = time.time()
+        return sum(1 for download in self._pending.values() if download.not_before <= now)
+
+    def rate(self):
+        '''Returns bytes per second downloaded lately, or None if we can't tell.'''
+        with self._cond:
+            cutoff = time.time() - self.RATE_WINDOW
+            while self._finished and self._finished[0][0] < cutoff:
+                self._finished.popleft()
+            if not self._finished:
+                return None
+            elapsed = max(time.time() - self._finished[0][0], 1)
+            return sum(nbytes for t, nbytes in self._finished) / elapsed
+
+    def status(self):
+        '''
+        Returns a dict with the number of downloads queued and running, the
+        bytes left to download, the recent download rate and an estimate of
+        how long it will take to download everything queued.
+        '''
+        rate = self.rate()
+        with self._cond:
+            queued_bytes = sum(d.size for d in self._pending.values())
+            running_bytes = sum(d.size for d in self._running.values())
+            status = {
+                'queued': len(self._pending),
+                'retrying': sum(1 for d in self._pending.values() if d.attempts),
+                'running': len(self._running),
+                'bytes_remaining': queued_bytes + running_bytes,
+                'bytes_per_sec': rate,
+                'eta': None,
+            }
+        if rate:
+            status['eta'] = status['bytes_remaining'] / rate
+        return status
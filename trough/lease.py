@@ -0,0 +1,229 @@
+'''
+trough/lease.py - leader election with leases stored in rethinkdb
+
+Copyright (C) 2017-2019 Internet Archive
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+USA.
+'''
+import logging
+import threading
+import time
+import uuid
+import rethinkdb as r
+
+class Lease:
+    '''
+    An exclusive, expiring lease on a named row of the `lease` table, like
+
+        {
+            "id": "trough-sync-master",
+            "holder": "wbgrp-svc001.us.archive.org/5b0c6d...",
+            "token": 12,
+            "ttl": 15,
+            "expires": r.time(...),
+            "acquired_on": r.time(...),
+            "renewed_on": r.time(...),
+            ... `info` ...
+        }
+
+    `start()` runs a background thread that keeps renewing the lease while
+    this process holds it. While somebody else holds it, the thread follows
+    the row with a changefeed, and tries to take over as soon as the lease is
+    released or should have been renewed and wasn't, rather than polling.
+
+    `token` goes up by one every time the lease changes hands. A holder that
+    stalls (e.g. a long gc pause) can go on believing it holds the lease after
+    somebody else has taken over, so writes that only the holder may make
+    should be wrapped with `fence()`, which refuses to run them unless the
+    lease still has the holder's token.
+    '''
+    table = 'lease'
+
+    def __init__(
+            self, rethinker, name, node, ttl, info=None,
+            on_acquired=None, on_lost=None):
+        self.rethinker = rethinker
+        self.name = name
+        self.node = node
+        # unique to this instance, so that a restarted process doesn't
+        # mistake its predecessor's lease for its own
+        self.holder = '%s/%s' % (node, uuid.uuid4().hex)
+        self.ttl = ttl
+        self.info = info or {}
+        self.on_acquired = on_acquired
+        self.on_lost = on_lost
+        self.token = None
+        # set while we hold the lease
+        self.acquired = threading.Event()
+        # time.monotonic() at which our hold on the lease lapses, if we don't
+        # manage to renew it first
+        self._held_until = 0
+        # time.monotonic() at which the current holder's lease should lapse,
+        # going by the changefeed
+        self._lapses_at = 0
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+
+    @classmethod
+    def table_ensure(cls, rr):
+        if cls.table not in rr.table_list().run():
+            logging.info('creating rethinkdb table %r', cls.table)
+            rr.table_create(cls.table).run()
+
+    @property
+    def held(self):
+        return self.token is not None and time.monotonic() < self._held_until
+
+    def renew(self):
+        '''
+        Takes the lease if it is free or has expired, or extends it if we
+        already hold it, in a single atomic query.
+
+        Returns:
+            True if we hold the lease
+        '''
+        lease_doc = dict(self.info, id=self.name, node=self.node, holder=self.holder, ttl=self.ttl)
+        started = time.monotonic()
+        result = self.rethinker.table(self.table).get(self.name).replace(
+                lambda lease: r.branch(
+                    lease.eq(None),
+                    r.expr(lease_doc).merge({
+                        'token': 1, 'acquired_on': r.now(),
+                        'renewed_on': r.now(), 'expires': r.now().add(self.ttl)}),
+                    lease['holder'].eq(self.holder),
+                    lease.merge({'renewed_on': r.now(), 'expires': r.now().add(self.ttl)}),
+                    lease['holder'].eq(None).or_(lease['expires'].lt(r.now())),
+                    r.expr(lease_doc).merge({
+                        'token': lease['token'].add(1), 'acquired_on': r.now(),
+                        'renewed_on': r.now(), 'expires': r.now().add(self.ttl)}),
+                    lease),
+                return_changes='always').run()
+        new_val = result['changes'][0]['new_val']
+        if new_val['holder'] == self.holder:
+            # the lease expires ttl seconds after the server got our query,
+            # which was after `started`
+            self._held_until = started + self.ttl
+            if self.token != new_val['token']:
+                self.token = new_val['token']
+                self.acquired.set()
+                logging.info(
+                        'acquired lease %r (token %s)', self.name, self.token)
+                if self.on_acquired:
+                    self.on_acquired(self)
+            return True
+        else:
+            self._lost('%r holds it (token %s)' % (new_val['node'], new_val['token']))
+            if self._lapses_at <= time.monotonic():
+                # haven't heard from the changefeed yet, try again in a bit
+                self._lapses_at = time.monotonic() + self.ttl / 3
+            return False
+
+    def release(self):
+        '''Gives up the lease, if we hold it, so somebody else can take over.'''
+        self._stop.set()
+        self._changed.set()
+        if self.token is None:
+            return
+        self.rethinker.table(self.table).get(self.name).replace(
+                lambda lease: r.branch(
+                    lease['holder'].default(None).eq(self.holder),
+                    lease.merge({'holder': None, 'expires': r.now()}),
+                    lease)).run()
+        self._lost('released it')
+
+    def _lost(self, reason):
+        if self.token is not None:
+            logging.warning(
+                    'lost lease %r (token %s): %s', self.name, self.token,
+                    reason)
+            self.token = None
+            self.acquired.clear()
+            if self.on_lost:
+                self.on_lost(self)
+
+    def fence(self, query, token=None):
+        '''
+        Returns reql that runs `query` (reql built with the `rethinkdb`
+        module, not with the rethinker) only if we still hold the lease with
+        `token` (by default, the token we have now), and raises an error
+        otherwise.
+        '''
+        token = token or self.token
+        return self.rethinker.table(self.table).get(self.name).do(
+                lambda lease: r.branch(
+                    lease.ne(None).and_(lease['holder'].eq(self.holder)).and_(lease['token'].eq(token)),
+                    query,
+                    r.error('lease %r is no longer held with token %s' % (self.name, token))))
+
+    def observe(self, lease):
+        '''Takes note of a new value of the lease row from the changefeed.'''
+        if lease is None or lease.get('holder') is None:
+            self._lapses_at = 0
+        elif lease['holder'] != self.holder:
+            # it was renewed just now, so it's good for another ttl seconds
+            self._lapses_at = time.monotonic() + lease['ttl']
+        else:
+            return
+        self._changed.set()
+
+    def watch_forever(self):
+        while not self._stop.is_set():
+            try:
+                changes = self.rethinker.table(self.table).get(self.name).changes(
+                        include_initial=True).run()
+                for change in changes:
+                    self.observe(change.get('new_val'))
+                    if self._stop.is_set():
+                        break
+            except Exception as e:
+                logging.warning(
+                        'problem following lease %r, will retry: %s',
+                        self.name, e)
+                # we might have missed the lease being released
+                self._lapses_at = 0
+                self._changed.set()
+                self._stop.wait(1)
+
+    def renew_forever(self):
+        while not self._stop.is_set():
+            if self.held:
+                timeout = self.ttl / 3
+            else:
+                # wake up if the changefeed tells us the lease was released,
+                # otherwise when it should lapse
+                timeout = min(max(0, self._lapses_at - time.monotonic()), self.ttl)
+            self._changed.wait(timeout)
+            self._changed.clear()
+            if self._stop.is_set():
+                break
+            if not self.held and time.monotonic() < self._lapses_at:
+                # just the current holder renewing
+                continue
+            try:
+                self.renew()
+            except Exception as e:
+                logging.warning('problem renewing lease %r: %s', self.name, e)
+                if not self.held:
+                    self._lost('could not renew it: %s' % e)
+                self._stop.wait(1)
+
+    def start(self):
+        threading.Thread(
+                target=self.watch_forever, daemon=True,
+                name='LeaseWatcher-%s' % self.name).start()
+        threading.Thread(
+                target=self.renew_forever, daemon=True,
+                name='LeaseRenewer-%s' % self.name).start()
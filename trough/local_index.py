@@ -0,0 +1,229 @@
+'''
+trough/local_index.py - layout and in-memory index of the segments on local disk
+
+Copyright (C) 2017-2019 Internet Archive
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+USA.
+'''
+import collections
+import hashlib
+import logging
+import os
+import re
+import threading
+
+try:
+    import inotify_simple
+    from inotify_simple import flags
+except ImportError:
+    inotify_simple = None
+
+SUFFIX = '.sqlite'
+# names of the hash prefix directories of the sharded layout
+SUBDIR_RE = re.compile(r'^[0-9a-f]{2}$')
+
+LocalSegment = collections.namedtuple('LocalSegment', ['size', 'mtime', 'inode', 'path'])
+
+def segment_id(filename):
+    '''Returns the segment id of `filename`, or None if it's not a segment.'''
+    if filename and filename.endswith(SUFFIX):
+        return filename[:-len(SUFFIX)]
+    return None
+
+def segment_path(directory, segment_id, depth=0):
+    '''
+    Returns the path of segment `segment_id` under `directory`, `depth`
+    levels of hash prefix directories down, like
+    `<directory>/3f/a2/<segment_id>.sqlite` for depth 2. Each level has up
+    to 256 directories, named after the next two hex digits of the md5 of
+    the segment id. With depth 0, every segment goes straight in
+    `directory`.
+    '''
+    digest = hashlib.md5(str(segment_id).encode('utf-8')).hexdigest()
+    subdirs = [digest[2*i:2*i+2] for i in range(depth)]
+    return os.path.join(directory, *subdirs, '%s%s' % (segment_id, SUFFIX))
+
+def scan(directory):
+    '''
+    Yields (segment_id, os.DirEntry) for every segment file under
+    `directory`, whatever the layout, including segments left in the top
+    directory, or at a different depth, by a layout change that hasn't
+    been migrated yet.
+    '''
+    with os.scandir(directory) as entries:
+        entries = list(entries)
+    for entry in entries:
+        try:
+            if SUBDIR_RE.match(entry.name) and entry.is_dir(follow_symlinks=False):
+                yield from scan(entry.path)
+                continue
+        except FileNotFoundError:
+            continue
+        id = segment_id(entry.name)
+        if id is not None:
+            yield id, entry
+
+class LocalSegmentIndex:
+    '''
+    Keeps track of the segment files under `directory` (see `scan()`), so
+    that sync loops and garbage collection don't have to list the
+    directory and stat every file every time.
+
+    The index is built with one pass of `os.scandir()` the first time it is
+    read. After that it is kept current by inotify events, which are applied
+    each time the index is read (so a change made by another process shows
+    up as soon as the kernel has queued the event), and by `update()`, which
+    trough calls when it copies, provisions, promotes or deletes a segment
+    itself. Writes to sqlite files that are held open are not followed, so
+    the size and mtime of a segment that is being written to are as of the
+    last time it was closed or touched.
+
+    Needs the `inotify_simple` module, see `available()`.
+    '''
+    def __init__(self, directory, depth=0):
+        self.directory = directory
+        self.depth = depth
+        # { segment_id: LocalSegment }, None until built
+        self._segments = None
+        self._inotify = None
+        self._watches = {}  # { watch descriptor: directory }
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def available():
+        return inotify_simple is not None
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return LocalSegment(st.st_size, st.st_mtime, st.st_ino, path)
+
+    def _watch(self, directory):
+        '''Watches `directory` and any hash prefix directories under it.'''
+        wd = self._inotify.add_watch(
+                directory,
+                flags.CREATE | flags.DELETE | flags.MOVED_FROM
+                | flags.MOVED_TO | flags.CLOSE_WRITE | flags.ATTRIB
+                | flags.DELETE_SELF | flags.MOVE_SELF)
+        self._watches[wd] = directory
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if SUBDIR_RE.match(entry.name) and entry.is_dir(follow_symlinks=False):
+                    self._watch(entry.path)
+
+    def _build(self):
+        if self._inotify is None:
+            self._inotify = inotify_simple.INotify()
+            # watch before scanning, so that nothing that changes during the
+            # scan is missed
+            self._watch(self.directory)
+        segments = {}
+        for id, entry in scan(self.directory):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            segment = LocalSegment(st.st_size, st.st_mtime, st.st_ino, entry.path)
+            if id not in segments or segment.mtime > segments[id].mtime:
+                segments[id] = segment
+        self._segments = segments
+        logging.info('indexed %s segments in %s', len(segments), self.directory)
+
+    def _rebuild(self, reason):
+        logging.warning('rebuilding index of %s: %s', self.directory, reason)
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+            self._watches = {}
+        self._build()
+
+    def _catch_up(self):
+        '''Applies queued inotify events. Call with the lock held.'''
+        if self._segments is None:
+            self._build()
+            return
+        # { segment_id: set of paths that changed }
+        changed = collections.defaultdict(set)
+        while True:
+            events = self._inotify.read(timeout=0)
+            if not events:
+                break
+            for event in events:
+                if event.mask & flags.Q_OVERFLOW:
+                    self._rebuild('inotify event queue overflowed')
+                    return
+                directory = self._watches.get(event.wd)
+                if event.mask & (flags.DELETE_SELF | flags.MOVE_SELF | flags.IGNORED):
+                    if directory == self.directory:
+                        self._rebuild('directory was deleted or moved')
+                        return
+                    self._watches.pop(event.wd, None)
+                    continue
+                if directory is None:
+                    continue
+                path = os.path.join(directory, event.name)
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.CREATE | flags.MOVED_TO) and SUBDIR_RE.match(event.name):
+                        # files might have landed in it before we were watching
+                        try:
+                            self._watch(path)
+                            for id, entry in scan(path):
+                                changed[id].add(entry.path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                id = segment_id(event.name)
+                if id is not None:
+                    changed[id].add(path)
+        for id, paths in changed.items():
+            self._update(id, paths)
+
+    def _update(self, segment_id, paths=()):
+        '''
+        Looks for segment `segment_id` at `paths`, where it was last seen,
+        and where the layout says it should be.
+        '''
+        paths = set(paths)
+        paths.add(segment_path(self.directory, segment_id, self.depth))
+        paths.add(segment_path(self.directory, segment_id))
+        if segment_id in self._segments:
+            paths.add(self._segments[segment_id].path)
+        found = [segment for segment in map(self._stat, paths) if segment]
+        if found:
+            self._segments[segment_id] = max(found, key=lambda segment: segment.mtime)
+        else:
+            self._segments.pop(segment_id, None)
+    def update(self, segment_id):
+        '''Takes note of the segment file having been written or deleted.'''
+        with self._lock:
+            if self._segments is not None:
+                self._update(segment_id)
+
+    def segments(self):
+        '''Returns { segment_id: LocalSegment } of the segments on disk.'''
+        with self._lock:
+            self._catch_up()
+            return dict(self._segments)
+
+    def close(self):
+        with self._lock:
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+                self._watches = {}
+            self._segments = None
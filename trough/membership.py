@@ -0,0 +1,327 @@
+'''
+trough/membership.py - node-level advertisement of the segments a node serves
+
+Copyright (C) 2017-2019 Internet Archive
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+USA.
+'''
+import collections
+import logging
+import uuid
+import zlib
+import doublethink
+import rethinkdb as r
+
+def healthy(svc):
+    return r.now().sub(svc['last_heartbeat']).lt(svc['ttl'])
+
+def bucket(segment_id, buckets):
+    '''Returns which of a node's `buckets` membership records lists `segment_id`.'''
+    return zlib.crc32(str(segment_id).encode('utf-8')) % buckets
+
+def node_service_id(node):
+    '''Returns the id of the 'trough-nodes' service that `node` heartbeats.'''
+    return 'trough-nodes:%s:None' % node
+
+class SegmentMembership(doublethink.Document):
+    '''
+    The segments a node serves for reading, split by `bucket()` over a fixed
+    number of records per node, like `{ "id": "wbgrp-svc001:17", "node":
+    "wbgrp-svc001", "bucket": 17, "port": 6444, "segments": ["1234", ...],
+    "version": "4bd1c2...", "node_service_id": "trough-nodes:wbgrp-svc001:None",
+    "updated_on": r.time(...) }`.
+
+    Under SERVICE_REGISTRY_MODEL 'node', these stand in for the
+    'trough-read:<node>:<segment>' documents in the `services` table: a
+    segment copy is up if it's listed here and its node's 'trough-nodes'
+    service is healthy. The multi index on `segments` maps each segment to
+    the nodes that serve it. `version` is a new uuid with every change, so
+    that `MembershipPublisher` can tell when somebody else has changed a
+    record.
+    '''
+    table = 'segment_membership'
+
+    @classmethod
+    def table_create(cls, rr):
+        rr.table_create(cls.table).run()
+        rr.table(cls.table).index_create('segments', multi=True).run()
+        rr.table(cls.table).index_wait('segments').run()
+
+    @classmethod
+    def record_id(cls, node, bucket):
+        return '%s:%s' % (node, bucket)
+
+    @classmethod
+    def record(cls, node, bucket, segments, port, version=None):
+        return {
+            'id': cls.record_id(node, bucket),
+            'node': node,
+            'bucket': bucket,
+            'port': port,
+            'segments': sorted(segments),
+            'version': version or uuid.uuid4().hex,
+            'node_service_id': node_service_id(node),
+            'updated_on': r.now(),
+        }
+
+    @classmethod
+    def exists(cls, rr):
+        return cls.table in rr.table_list().run()
+
+    @classmethod
+    def add(cls, rr, node, segment_id, port, buckets):
+        '''Lists `segment_id` as served by `node`.'''
+        segment_id = str(segment_id)
+        record = cls.record(node, bucket(segment_id, buckets), [segment_id], port)
+        return rr.table(cls.table).insert(record, conflict=lambda id, old, new: r.branch(
+            old['segments'].contains(segment_id), old,
+            old.merge({
+                'segments': old['segments'].set_insert(segment_id),
+                'version': new['version'],
+                'updated_on': new['updated_on']}))).run()
+
+    @staticmethod
+    def _without(segment_id):
+        return lambda doc: r.branch(
+            doc['segments'].contains(segment_id),
+            {'segments': doc['segments'].set_difference([segment_id]),
+             'version': r.uuid(), 'updated_on': r.now()},
+            {})
+
+    @classmethod
+    def remove(cls, rr, node, segment_id, buckets):
+        '''
+        Stops listing `segment_id` as served by `node`.
+
+        Returns:
+            True if it was listed
+        '''
+        result = cls.remove_many(rr, node, [segment_id], buckets)
+        return bool(result.get('replaced'))
+
+    @classmethod
+    def remove_many(cls, rr, node, segment_ids, buckets):
+        '''Stops listing `segment_ids` as served by `node`, in one query.'''
+        by_record = collections.defaultdict(list)
+        for segment_id in segment_ids:
+            segment_id = str(segment_id)
+            by_record[cls.record_id(node, bucket(segment_id, buckets))].append(segment_id)
+        removals = [
+            {'id': id, 'segments': segments}
+            for id, segments in by_record.items()]
+        return rr.expr(removals).for_each(
+                lambda removal: r.table(cls.table).get(removal['id']).update(
+                    lambda doc: r.branch(
+                        doc['segments'].set_intersection(removal['segments']).is_empty(),
+                        {},
+                        {'segments': doc['segments'].set_difference(removal['segments']),
+                         'version': r.uuid(), 'updated_on': r.now()}))).run()
+
+    @classmethod
+    def remove_everywhere(cls, rr, segment_id):
+        '''Stops listing `segment_id` as served by any node.'''
+        segment_id = str(segment_id)
+        return rr.table(cls.table).get_all(segment_id, index='segments').update(
+                cls._without(segment_id)).run()
+
+    @classmethod
+    def nodes(cls, rr, segment_id):
+        '''Returns the nodes that list `segment_id`, healthy or not.'''
+        return set(rr.table(cls.table, read_mode='outdated').get_all(
+            str(segment_id), index='segments')['node'].run())
+
+    @classmethod
+    def clear(cls, rr, node, buckets):
+        '''Deletes `node`'s records, e.g. after going back to the 'segment' model.'''
+        return rr.table(cls.table).get_all(
+                *[cls.record_id(node, b) for b in range(buckets)]).delete().run()
+
+def _read_services(member, segments):
+    '''
+    Expands membership record `member` into what the 'trough-read' service
+    of each of `segments` would look like under the 'segment' model, or
+    nothing if the node isn't healthy.
+    '''
+    def expand(node):
+        return segments.map(lambda segment: {
+            'id': r.expr('trough-read:').add(member['node'], ':', segment),
+            'role': 'trough-read',
+            'node': member['node'],
+            'segment': segment,
+            'port': member['port'],
+            'url': r.expr('http://').add(
+                member['node'], ':', member['port'].coerce_to('string'),
+                '/?segment=', segment),
+            'ttl': node['ttl'],
+            'load': node['load'],
+            'first_heartbeat': node['first_heartbeat'],
+            'last_heartbeat': node['last_heartbeat'],
+        })
+    return r.table('services', read_mode='outdated').get(
+            member['node_service_id']).do(lambda node: r.branch(
+                node.ne(None).and_(healthy(node)), expand(node), []))
+
+def read_services_query(rethinker, segment_ids, include_members=True):
+    '''
+    Returns a query for the healthy 'trough-read' services of `segment_ids`,
+    advertised either way (see `SegmentMembership`). Pass `rethinker=None`
+    to nest the query inside another one.
+    '''
+    table = rethinker.table if rethinker else r.table
+    segment_ids = [str(segment_id) for segment_id in segment_ids]
+    query = table('services', read_mode='outdated')\
+            .get_all(*segment_ids, index='segment')\
+            .filter({'role': 'trough-read'})\
+            .filter(healthy)
+    if include_members:
+        query = query.union(r.expr(segment_ids).concat_map(
+            lambda segment: r.table(SegmentMembership.table, read_mode='outdated')\
+                    .get_all(segment, index='segments')\
+                    .concat_map(lambda member: _read_services(member, r.expr([segment])))))
+    return query
+
+def all_read_services_query(rethinker, regex=None, include_members=True):
+    '''
+    Returns a query for all healthy 'trough-read' services, or those of
+    segments matching `regex`, advertised either way. Under the 'node' model
+    `first_heartbeat` is that of the node rather than the segment copy.
+    '''
+    query = rethinker.table('services', read_mode='outdated')\
+            .filter({'role': 'trough-read'})\
+            .filter(lambda svc: svc.has_fields('segment'))
+    if regex:
+        query = query.filter(
+                lambda svc: svc['segment'].coerce_to('string').match(regex))
+    query = query.filter(healthy)
+    if include_members:
+        def segments(member):
+            if regex:
+                return member['segments'].filter(lambda segment: segment.match(regex))
+            return member['segments']
+        query = query.union(r.table(SegmentMembership.table, read_mode='outdated')\
+                .concat_map(lambda member: _read_services(member, segments(member))))
+    return query
+
+class MembershipPublisher:
+    '''
+    Keeps `node`'s membership records in line with the segments it serves.
+    The first `publish()` writes every record in full. After that only
+    additions and removals since the last `publish()` are sent, in one query,
+    each applied only if the record is still at the version we last wrote.
+    A record that somebody else has changed in the meantime (provisioning
+    adds a segment, deleting or garbage collecting one removes it) is
+    rewritten, keeping segments they added since our last write.
+    '''
+    def __init__(self, rethinker, node, port, buckets):
+        self.rethinker = rethinker
+        self.node = node
+        self.port = port
+        self.buckets = buckets
+        # { bucket: (version, set of segments) } as last written by us
+        self._published = {}
+
+    def publish(self, segment_ids):
+        '''
+        Makes `segment_ids` the segments listed as served by this node.
+
+        Returns:
+            (number of records rewritten, number of records updated)
+        '''
+        wanted = collections.defaultdict(set)
+        for segment_id in segment_ids:
+            segment_id = str(segment_id)
+            wanted[bucket(segment_id, self.buckets)].add(segment_id)
+        ids = [SegmentMembership.record_id(self.node, b) for b in range(self.buckets)]
+        current = {
+            doc['bucket']: doc['version']
+            for doc in self.rethinker.table(SegmentMembership.table)\
+                    .get_all(*ids).pluck('bucket', 'version').run()}
+        stale = []
+        changed = []
+        for b in range(self.buckets):
+            published = self._published.get(b)
+            if published is None or current.get(b) != published[0]:
+                stale.append(b)
+            elif wanted[b] != published[1]:
+                changed.append(b)
+        # { bucket: (expected version, new version, segments, update) }
+        writes = {}
+        if stale:
+            keep = self._added_by_others(stale, current)
+            for b in stale:
+                segments = wanted[b] | keep.get(b, set())
+                record = SegmentMembership.record(self.node, b, segments, self.port)
+                writes[b] = (current.get(b), record['version'], segments, record)
+        for b in changed:
+            version, published = self._published[b]
+            new_version = uuid.uuid4().hex
+            writes[b] = (version, new_version, wanted[b], {
+                'id': SegmentMembership.record_id(self.node, b),
+                'add': sorted(wanted[b] - published),
+                'remove': sorted(published - wanted[b]),
+                'version': new_version})
+        if writes:
+            self._write(writes)
+        return len(stale), len(changed)
+
+    def _added_by_others(self, stale, current):
+        '''
+        Returns { bucket: segments } added to the `stale` records by somebody
+        else since we last wrote them.
+        '''
+        keep = {}
+        previously = [b for b in stale if b in self._published and b in current]
+        if previously:
+            for doc in self.rethinker.table(SegmentMembership.table).get_all(
+                    *[SegmentMembership.record_id(self.node, b) for b in previously]).run():
+                keep[doc['bucket']] = set(doc['segments']) - self._published[doc['bucket']][1]
+        return keep
+
+    def _write(self, writes):
+        '''
+        Applies each of `writes`, a full record or additions and removals,
+        if the record is still at the version we expect (None for no
+        record). Records that somebody else got to first are left alone, and
+        found to be stale next time. Only the writes that were applied are
+        remembered as published.
+        '''
+        def apply(write):
+            def replace(doc):
+                update = doc.merge({
+                    'segments': doc['segments'].set_union(write['update']['add'])\
+                            .set_difference(write['update']['remove']),
+                    'version': write['update']['version'],
+                    'updated_on': r.now()})
+                return r.branch(
+                    doc.default({'version': None})['version'].ne(write['expected']), doc,
+                    write['update'].has_fields('node'), write['update'], update)
+            return r.table(SegmentMembership.table).get(
+                    write['update']['id']).replace(replace, return_changes=True)
+        query = r.expr([
+            {'expected': expected, 'update': update}
+            for expected, new_version, segments, update in writes.values()
+        ]).for_each(apply)
+        result = self.rethinker.expr(query).run()
+        applied = {
+            change['new_val']['id']: change['new_val']['version']
+            for change in result.get('changes', []) if change.get('new_val')}
+        for b, (expected, new_version, segments, update) in writes.items():
+            if applied.get(SegmentMembership.record_id(self.node, b)) == new_version:
+                self._published[b] = (new_version, segments)
+        if len(applied) < len(writes):
+            logging.info(
+                    'membership of %s changed under us, %s of %s writes '
+                    'applied', self.node, len(applied), len(writes))
@@ -0,0 +1,237 @@
+'''
+trough/placement.py - batch placement of segments on hash rings
+
+Copyright (C) 2017-2019 Internet Archive
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+USA.
+'''
+import bisect
+import hashlib
+import logging
+import random
+from uhashring import HashRing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def ketama_hash(key):
+    '''
+    Returns the position of `key` on a ketama continuum, same as
+    `uhashring.HashRing(compat=True).get_key(key)`.
+    '''
+    return int.from_bytes(
+            hashlib.md5(str(key).encode('utf-8')).digest()[:4], 'little')
+
+def segment_shard(segment_id, shards):
+    '''
+    Returns which of `shards` segment manager shards (numbered from 0) is
+    responsible for `segment_id`. The segment id space is split by hash so
+    that shards get about the same number of segments however ids are
+    assigned.
+    '''
+    if shards <= 1:
+        return 0
+    return ketama_hash(segment_id) % shards
+
+def build_hash_rings(host_ring_mapping, capacities, ring_count):
+    '''
+    Builds `ring_count` hash rings out of the hosts in `capacities`.
+
+    Updates `host_ring_mapping` in place: hosts that are not in `capacities`
+    anymore are dropped, and hosts that are new (or were on a ring that no
+    longer exists) are put on the ring with the least total capacity and
+    weighted by their capacity.
+
+    Args:
+        host_ring_mapping: dict like `{ 'host1': { 'ring': 0, 'weight':
+            188921 }, ... }`, the persistent record of which ring each host
+            is on and what its weight is; other keys (like 'id') are ignored
+        capacities: dict like `{ 'host1': 188921, ... }` of the storage
+            capacity in bytes of each available host
+        ring_count: number of hash rings
+
+    Returns:
+        list of `uhashring.HashRing`, each with an `id` attribute that is its
+        index in the list
+    '''
+    hash_rings = []
+    for i in range(ring_count):
+        ring = HashRing()
+        ring.id = i
+        hash_rings.append(ring)
+    ring_capacities = [0] * ring_count
+
+    hosts = [key for key in host_ring_mapping.keys() if isinstance(host_ring_mapping[key], dict)]
+    for hostname in hosts:
+        host = host_ring_mapping[hostname]
+        if hostname not in capacities:
+            logging.info('pruning worker %r from pool (worker went offline?) [was: hash ring %s]', hostname, host)
+            del host_ring_mapping[hostname]
+        elif host['ring'] >= ring_count:
+            logging.info('worker %r was on hash ring %s, which no longer exists', hostname, host['ring'])
+            del host_ring_mapping[hostname]
+        else:
+            hash_rings[host['ring']].add_node(hostname, { 'weight': host['weight'] })
+            ring_capacities[host['ring']] += capacities[hostname] or 0
+            logging.debug("Host '%s' assigned to ring %s", hostname, host['ring'])
+
+    for hostname in sorted(capacities):
+        if hostname in host_ring_mapping or not ring_count:
+            continue
+        weight = capacities[hostname]
+        ring_id = min(range(ring_count), key=lambda i: (ring_capacities[i], i))
+        host_ring_mapping[hostname] = { 'weight': weight, 'ring': ring_id }
+        hash_rings[ring_id].add_node(hostname, { 'weight': weight })
+        ring_capacities[ring_id] += weight or 0
+        logging.info("new trough worker %r assigned to ring %r", hostname, ring_id)
+    return hash_rings
+
+def rebalance_weights(host_ring_mapping, capacities, assigned_bytes, threshold, max_factor=2):
+    '''
+    Adjusts the hash ring weights in `host_ring_mapping` (see
+    `build_hash_rings()`) so that hosts on the same ring fill up at the same
+    rate. A host whose assigned bytes as a fraction of its capacity is off by
+    more than `threshold` (e.g. 0.1 for 10%) from the average of its ring
+    has its weight scaled by the ratio of the two, by at most a factor of
+    `max_factor` either way. Hosts with nothing assigned yet are left alone.
+
+    Returns:
+        list of hosts whose weights changed
+    '''
+    rings = {}
+    for hostname, host in host_ring_mapping.items():
+        if isinstance(host, dict) and capacities.get(hostname):
+            rings.setdefault(host['ring'], []).append(hostname)
+    changed = []
+    for ring_id, hostnames in rings.items():
+        total_assigned = sum(assigned_bytes.get(h, 0) for h in hostnames)
+        total_capacity = sum(capacities[h] for h in hostnames)
+        if not total_assigned:
+            continue
+        average = total_assigned / total_capacity
+        for hostname in hostnames:
+            if not assigned_bytes.get(hostname):
+                continue
+            utilization = assigned_bytes[hostname] / capacities[hostname]
+            if abs(utilization / average - 1) <= threshold:
+                continue
+            factor = min(max(average / utilization, 1 / max_factor), max_factor)
+            host = host_ring_mapping[hostname]
+            weight = max(1, int(host['weight'] * factor))
+            logging.info(
+                    'worker %r on ring %s is %0.1f%% full vs %0.1f%% for the '
+                    'ring, changing weight from %s to %s', hostname, ring_id,
+                    100 * utilization, 100 * average, host['weight'], weight)
+            host_ring_mapping[hostname] = dict(host, weight=weight)
+            changed.append(hostname)
+    return changed
+
+def choose_rings(segment_id, ring_count, copies, rng=None):
+    '''
+    Returns the indexes of the `copies` hash rings (out of `ring_count`)
+    that segment `segment_id` is placed on. This is the same set of rings
+    that `random.seed(segment_id); random.sample(hash_rings, copies)` picks,
+    but without touching the global random number generator.
+
+    Seeding the random number generator is by far the most expensive part
+    of placing a segment, so when the segment goes on every ring (the usual
+    case, with MINIMUM_ASSIGNMENTS == MAXIMUM_ASSIGNMENTS) we skip it and
+    return the rings in order. Reseeding an existing `rng` is also quite a
+    bit cheaper than creating a new `random.Random`.
+    '''
+    if copies == ring_count:
+        return range(ring_count)
+    rng = rng or random.Random()
+    rng.seed(segment_id)
+    return rng.sample(range(ring_count), copies)
+
+class Ring:
+    '''
+    Read-only snapshot of a `uhashring.HashRing`'s continuum, for looking up
+    many keys at once.
+    '''
+    def __init__(self, hash_ring):
+        self.id = getattr(hash_ring, 'id', None)
+        points = hash_ring.get_points()
+        self.tokens = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+        if numpy is not None:
+            self._tokens = numpy.array(self.tokens, dtype=numpy.uint32)
+            self._nodes = numpy.array(self.nodes, dtype=object)
+
+    def get_nodes(self, hashes):
+        '''
+        Returns the node that each of `hashes` lands on (the node of the
+        first token strictly after the hash, wrapping around), like
+        `HashRing.get_node()` does for a single key.
+        '''
+        if not self.tokens:
+            return [None] * len(hashes)
+        if numpy is not None:
+            positions = numpy.searchsorted(self._tokens, hashes, side='right')
+            positions[positions == len(self.tokens)] = 0
+            return self._nodes[positions]
+        nodes = []
+        for h in hashes:
+            position = bisect.bisect(self.tokens, h)
+            nodes.append(self.nodes[position if position < len(self.tokens) else 0])
+        return nodes
+
+class PlacementEngine:
+    '''
+    Places segments on hash rings in bulk. For each segment,
+    `place()` returns the same (ring, node) pairs that picking rings with
+    `random.seed(segment_id); random.sample(hash_rings, copies)` and then
+    calling `ring.get_node(segment_id)` on each would (though not
+    necessarily in the same order), but hashes each segment id only once
+    and looks up all of them on each ring in one go.
+    '''
+    def __init__(self, hash_rings):
+        self.hash_rings = list(hash_rings)
+        self.rings = [Ring(hash_ring) for hash_ring in self.hash_rings]
+
+    def hashes(self, segment_ids):
+        if numpy is not None:
+            digests = b''.join(
+                    hashlib.md5(str(segment_id).encode('utf-8')).digest()[:4]
+                    for segment_id in segment_ids)
+            return numpy.frombuffer(digests, dtype='<u4')
+        return [ketama_hash(segment_id) for segment_id in segment_ids]
+
+    def place(self, segment_ids, copies):
+        '''
+        Args:
+            segment_ids: list of segment ids
+            copies: list of the number of hash rings to place each segment
+                on, in the same order as `segment_ids` (see
+                `Segment.minimum_assignments()`)
+
+        Returns:
+            list of lists of (hash_ring, node) tuples, one list per segment,
+            in the same order as `segment_ids`, where `hash_ring` is one of
+            the rings passed to the constructor
+        '''
+        hashes = self.hashes(segment_ids)
+        nodes_by_ring = [ring.get_nodes(hashes) for ring in self.rings]
+        rng = random.Random()
+        placements = []
+        for i, segment_id in enumerate(segment_ids):
+            placements.append([
+                (self.hash_rings[r], nodes_by_ring[r][i])
+                for r in choose_rings(segment_id, len(self.rings), copies[i], rng)])
+        return placements
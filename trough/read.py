@@ -9,6 +9,9 @@ import logging
 import requests
 import urllib
 import doublethink
+import collections
+import threading
+import time
 
 if settings['SENTRY_DSN']:
     try:
@@ -23,6 +26,73 @@ class ReadServer:
         self.services = doublethink.ServiceRegistry(self.rethinker)
         self.registry = trough.sync.HostRegistry(rethinker=self.rethinker, services=self.services)
         trough.sync.init(self.rethinker)
+        # { segment_id: reads } since read stats were last saved
+        self.read_counts = collections.Counter()
+        self.read_counts_lock = threading.Lock()
+        self.read_counts_saved = time.time()
+        # { segment_id: threading.Event } of segments being fetched to serve
+        # reads, set once the fetch is over
+        self.fetches = {}
+        self.fetches_lock = threading.Lock()
+
+    def count_read(self, segment_id):
+        '''
+        Counts a read of `segment_id`, and every READ_STATS_FLUSH_INTERVAL
+        seconds, adds up the counts in the read_stats table.
+        '''
+        if not settings['READ_STATS_FLUSH_INTERVAL']:
+            return
+        with self.read_counts_lock:
+            self.read_counts[segment_id] += 1
+            if time.time() - self.read_counts_saved < settings['READ_STATS_FLUSH_INTERVAL']:
+                return
+            counts, self.read_counts = self.read_counts, collections.Counter()
+            self.read_counts_saved = time.time()
+        try:
+            trough.sync.ReadStats.record(self.rethinker, counts)
+        except Exception as e:
+            logging.warning('problem saving read stats for %s segments: %s', len(counts), e)
+
+    def fetch_segment(self, segment):
+        '''
+        Fetches `segment` to serve a read, by asking the local segment manager
+        to (see `LocalSyncController.fetch_segment()`). Concurrent reads of
+        the same segment wait for one fetch, for up to READ_THROUGH_TIMEOUT
+        seconds.
+        '''
+        with self.fetches_lock:
+            fetched = self.fetches.get(segment.id)
+            fetching = fetched is None
+            if fetching:
+                fetched = self.fetches[segment.id] = threading.Event()
+        if fetching:
+            try:
+                logging.info('fetching segment %r to serve a read', segment.id)
+                self.request_fetch(segment)
+            finally:
+                with self.fetches_lock:
+                    del self.fetches[segment.id]
+                fetched.set()
+        elif not fetched.wait(settings['READ_THROUGH_TIMEOUT']):
+            raise Exception(
+                    'timed out waiting for segment %r to be fetched' % segment.id)
+        if not os.path.isfile(segment.local_path()):
+            raise Exception('failed to fetch segment %r' % segment.id)
+
+    def request_fetch(self, segment):
+        url = 'http://localhost:%s/segment/%s/fetch' % (settings['SYNC_LOCAL_PORT'], segment.id)
+        response = requests.post(url, timeout=settings['READ_THROUGH_TIMEOUT'])
+        if response.status_code == 409:
+            # another read server process asked first, wait for its copy,
+            # which is moved into place once complete
+            deadline = time.time() + settings['READ_THROUGH_TIMEOUT']
+            while not os.path.isfile(segment.local_path()) and time.time() < deadline:
+                time.sleep(0.5)
+        elif response.status_code != 204:
+            raise Exception(
+                    'unexpected response %r %r: %r from POST %r' % (
+                        response.status_code, response.reason,
+                        response.text, url))
 
     def proxy_for_write_host(self, node, segment, query, start_response):
         # enforce that we are querying the correct database, send an explicit hostname.
@@ -31,6 +101,8 @@ class ReadServer:
             status_line = '{status_code} {reason}'.format(status_code=r.status_code, reason=r.reason)
             # headers [('Content-Type','application/json')]
             headers = [("Content-Type", r.headers['Content-Type'],)]
+            if 'X-Trough-Columns' in r.headers:
+                headers.append(('X-Trough-Columns', r.headers['X-Trough-Columns']))
             start_response(status_line, headers)
             for chunk in r.iter_content():
                 yield chunk
@@ -62,6 +134,8 @@ class ReadServer:
         # if the user sent more than one query, or the query is not a SELECT, raise an exception.
         if len(sqlparse.split(query)) != 1 or sqlparse.parse(query)[0].get_type() != 'SELECT':
             raise Exception('Exactly one SELECT query per request, please.')
+        if settings['READ_THROUGH'] and not os.path.isfile(segment.local_path()):
+            self.fetch_segment(segment)
         assert os.path.isfile(segment.local_path())
 
         logging.info("Connecting to sqlite database: {segment}".format(segment=segment.local_path()))
@@ -95,7 +169,10 @@ class ReadServer:
                 ##     start_response(status_line, headers)
                 ##     return r.iter_content()
             cursor = self.execute_query(segment, query)
-            start_response('200 OK', [('Content-Type','application/json')])
+            self.count_read(segment.id)
+            # column names, so that clients can describe empty results too
+            columns = ujson.dumps([d[0] for d in cursor.description or ()])
+            start_response('200 OK', [('Content-Type','application/json'), ('X-Trough-Columns', columns)])
             return self.sql_result_json_iter(cursor)
         except Exception as e:
             logging.error('500 Server Error due to exception', exc_info=True)
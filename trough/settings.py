@@ -77,6 +77,49 @@ settings = {
     'COLD_STORAGE_PATH': "/mount/hdfs/trough-data/{prefix}/{segment_id}.sqlite",
     'COLD_STORE_SEGMENT': False,
     'COPY_THREAD_POOL_SIZE': 2,
+    'DOWNLOAD_MAX_BYTES_PER_SEC': None, # local sync downloads segments from hdfs at most this fast, in total (None for no limit)
+    'DOWNLOAD_MAX_BYTES_PER_SEC_PER_DATANODE': None, # ...and at most this fast from any one hdfs datanode (None for no limit)
+    'DOWNLOAD_RETRY_DELAY': 60, # seconds to wait before retrying a failed segment download, doubling with each failure...
+    'DOWNLOAD_MAX_RETRY_DELAY': 60 * 60, # ...up to this many seconds
+    'DELTA_SYNC_BLOCK_SIZE': 1024 * 1024, # promotion publishes checksums of each block of this many bytes next to the segment in hdfs (None to disable)
+    'DELTA_SYNC': False, # local sync refreshes an out of date segment by fetching only the blocks that changed, going by those checksums
+    'DELTA_SYNC_MAX_CHANGED_FRACTION': 0.5, # ...unless more than this fraction of blocks changed, in which case it copies the whole segment
+    'COMPRESS_SEGMENTS': False, # promotion uploads segments to hdfs zstd compressed, as .sqlite.zst (workers need the zstandard module to download them, whatever this is set to)
+    'SEGMENT_COMPRESSION_LEVEL': 3, # ...at this zstd compression level
+    'VERIFY_SEGMENT_CHECKSUMS': True, # local sync checks each segment it copies from hdfs against the checksum recorded in the segment catalog at promotion, before putting it in place
+    'SEGMENT_CHECKSUM_RETRIES': 2, # ...and copies it again up to this many times straight away if it doesn't match (after that the download scheduler retries with backoff)
+    'LOCAL_DATA_LAYOUT_DEPTH': 0, # levels of hash prefix directories (256 per level) to spread segments over under LOCAL_DATA, 0 for all in one directory; move existing segments with scripts/migrate_local_layout.py
+    'LOCAL_SEGMENT_INDEX': False, # keep an index of the segments in LOCAL_DATA up to date with inotify (needs the inotify_simple module), instead of listing and stat'ing every file every sync loop and garbage collection
+    'SYNC_WAIT_FOR_DOWNLOADS': False, # local sync loop waits for the segment downloads it scheduled to finish (or fail), instead of leaving them to run in the background
+    'READ_STATS_WINDOW': 60 * 60, # reads of each segment are counted in windows of this many seconds, and the current and previous windows decide which segments local sync downloads first
+    'READ_STATS_FLUSH_INTERVAL': 60, # read servers save read counts to rethinkdb every N seconds (None to disable)
+    'ASSIGNMENT_COMMIT_BATCH_SIZE': 1000, # sync master saves assignment changes to rethinkdb N at a time...
+    'ASSIGNMENT_COMMIT_CONCURRENCY': 4, # ...with up to N batches in flight at once
+    'HEARTBEAT_BATCH_SIZE': 1000, # workers heartbeat their per-segment services N at a time...
+    'HEARTBEAT_CONCURRENCY': 4, # ...with up to N batches in flight at once
+    'GARBAGE_COLLECTION_BATCH_SIZE': 1000, # workers look up readable copies and write locks of N segment files at a time when deciding which to garbage collect
+    'LOCAL_CACHE_EXTRA_REPLICAS': False, # instead of deleting segments no longer assigned to them as soon as there are enough other copies, workers keep serving them as extra replicas while local disk use (plus pending downloads) is under LOCAL_CACHE_HIGH_WATERMARK...
+    'LOCAL_CACHE_HIGH_WATERMARK': 0.9, # ...a fraction of STORAGE_IN_BYTES, above which they delete them, least recently read first...
+    'LOCAL_CACHE_LOW_WATERMARK': 0.8, # ...until local disk use is back under this fraction of STORAGE_IN_BYTES
+    'READ_THROUGH': False, # read servers have the local segment manager fetch segments they don't have to serve a read, if disk use of LOCAL_DATA is under LOCAL_CACHE_HIGH_WATERMARK; they're then kept as extra replicas (see LOCAL_CACHE_EXTRA_REPLICAS)
+    'READ_THROUGH_TIMEOUT': 600, # reads of a segment that is already being fetched wait up to N seconds for it
+    'PEER_TRANSFER': False, # workers serve up to date copies of their segments to each other at GET /segment/<id>/data on SYNC_LOCAL_PORT, and copy segments from the least loaded other node serving them, falling back to hdfs...
+    'PEER_TRANSFER_MAX_PEERS': 2, # ...after trying this many peers
+    'PEER_TRANSFER_TIMEOUT': 60, # seconds to wait for a peer to connect or send more data
+    'PEER_TRANSFER_RETRIES': 3, # times to resume an interrupted copy from a peer with a range request
+    'SERVICE_REGISTRY_MODEL': 'segment', # 'segment': workers heartbeat a trough-read service per segment; 'node': workers list the segments they serve in the segment_membership table, kept alive by their trough-nodes heartbeat
+    'SERVICE_REGISTRY_BUCKETS': 64, # under the 'node' model, each worker splits its segments over N membership records
+    'REBALANCE_MAX_BYTES_PER_CYCLE': None, # sync master moves at most this many bytes worth of segments to new nodes per sync cycle (None for no limit)
+    'REBALANCE_MAX_BYTES_PER_NODE': None, # ...and at most this many bytes worth to any one node per sync cycle (None for no limit)
+    'RING_WEIGHT_REBALANCE_INTERVAL': 60 * 60 * 24, # sync master adjusts hash ring weights by how full each node is every N seconds (None to disable)
+    'RING_WEIGHT_REBALANCE_THRESHOLD': 0.1, # ...when a node is more than this fraction fuller or emptier than average for its ring
+    'SYNC_MASTER_LEASE': False, # elect the sync master with a lease in the `lease` table, renewed in the background and taken over as soon as it lapses, instead of holding an election every ELECTION_CYCLE
+    'SYNC_MASTER_LEASE_TTL': 15, # ...the lease lapses if not renewed for this many seconds
+    'SEGMENT_MANAGER_SHARDS': 1, # split the segment id space into this many shards, each with its own sync master (requires SYNC_MASTER_LEASE)
+    'SEGMENT_MANAGER_SHARD': 0, # ...and this sync master looks after this shard (0 to SEGMENT_MANAGER_SHARDS - 1)
+    'USE_SEGMENT_CATALOG': False, # read the list of segments from the segment_catalog table in rethinkdb instead of listing hdfs
+    'SEGMENT_CATALOG_RECONCILE_INTERVAL': 60 * 60 * 6, # sync master checks the segment catalog against hdfs every N seconds (None to disable)
+    'FULL_ASSIGNMENT_PASS_INTERVAL': 60 * 60 * 24, # sync master looks at every segment, not just the ones that changed, at least this often (in seconds)
 }
 
 
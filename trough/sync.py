@@ -9,7 +9,6 @@ import socket
 import json
 import os
 import time
-import random
 import sys
 import string
 import requests
@@ -17,12 +16,26 @@ import datetime
 import sqlite3
 import re
 import contextlib
-from uhashring import HashRing
+from trough.placement import PlacementEngine, build_hash_rings, rebalance_weights, segment_shard
+from trough.lease import Lease
+from trough.download import Download, DownloadScheduler
+from trough import local_index
+from trough.local_index import LocalSegmentIndex
+from trough.membership import SegmentMembership, MembershipPublisher, read_services_query
 import ujson
 from hdfs3 import HDFileSystem
 import threading
 import tempfile
 from concurrent import futures
+import hashlib
+import collections
+import shutil
+import fcntl
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 class ClientError(Exception):
     pass
@@ -90,26 +103,79 @@ def setup_connection(conn):
     conn.create_function('BUILDREDIRECTARRAY', 4, build_redirect_array)
 
 class AssignmentQueue:
+    '''
+    Queues up assignments to be saved, and saves them in batches of at most
+    ASSIGNMENT_COMMIT_BATCH_SIZE, up to ASSIGNMENT_COMMIT_CONCURRENCY batches
+    at a time. Saving is idempotent, so if any batch fails, `commit()`
+    raises an exception and leaves the failed batches queued, and the next
+    `commit()` picks up where the failed one left off.
+    '''
+    noun = 'assignments'
     def __init__(self, rethinker):
         self._queue = []
         self.rethinker = rethinker
+        self.batch_size = settings['ASSIGNMENT_COMMIT_BATCH_SIZE']
+        self.concurrency = settings['ASSIGNMENT_COMMIT_CONCURRENCY']
+        # if set, a function that wraps a write query so that it only runs if
+        # this process is still the sync master (see `Lease.fence()`)
+        self.fence = None
     def enqueue(self, item):
         self._queue.append(item)
-        if self.length() >= 1000:
+        if self.length() >= self.batch_size * self.concurrency:
             self.commit()
+    def commit_batch(self, batch):
+        # conflict='replace' so that existing assignments can be updated
+        if self.fence:
+            self.fence(r.table('assignment').insert(batch, conflict='replace')).run()
+        else:
+            self.rethinker.table('assignment').insert(batch, conflict='replace').run()
     def commit(self):
-        logging.info("Committing %s assignments", self.length())
-        self.rethinker.table('assignment').insert(self._queue).run()
-        del self._queue[:]
+        if not self._queue:
+            return
+        queue, self._queue = self._queue, []
+        batches = [queue[i:i+self.batch_size] for i in range(0, len(queue), self.batch_size)]
+        logging.info(
+                "Committing %s %s in %s batches", len(queue), self.noun,
+                len(batches))
+        start = time.time()
+        failed = []
+        committed = 0
+        with futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            fs = {pool.submit(self.commit_batch, batch): batch for batch in batches}
+            for i, future in enumerate(futures.as_completed(fs), 1):
+                batch = fs[future]
+                try:
+                    future.result()
+                    committed += len(batch)
+                except Exception as e:
+                    logging.warning(
+                            'failed to commit batch of %s %s: %s',
+                            len(batch), self.noun, e)
+                    failed.extend(batch)
+                if len(batches) > 1 and (i % 10 == 0 or i == len(batches)):
+                    logging.info(
+                            'committed %s of %s %s so far (%0.1f sec)',
+                            committed, len(queue), self.noun,
+                            time.time() - start)
+        if failed:
+            # keep them for the next commit
+            self._queue[:0] = failed
+            raise Exception(
+                    'failed to commit %s of %s %s, will retry on next '
+                    'commit' % (len(failed), len(queue), self.noun))
     def length(self):
         return len(self._queue)
+    def clear(self):
+        self._queue = []
 
 class UnassignmentQueue(AssignmentQueue):
-    def commit(self):
-        logging.info("Committing %s unassignments", self.length())
-        ids = [item.id for item in self._queue]
-        self.rethinker.table('assignment').get_all(*ids).delete().run()
-        del self._queue[:]
+    noun = 'unassignments'
+    def commit_batch(self, batch):
+        ids = [item.id for item in batch]
+        if self.fence:
+            self.fence(r.table('assignment').get_all(*ids).delete()).run()
+        else:
+            self.rethinker.table('assignment').get_all(*ids).delete().run()
 
 class Assignment(doublethink.Document):
     def populate_defaults(self):
@@ -120,7 +186,17 @@ class Assignment(doublethink.Document):
     def table_create(cls, rr):
         rr.table_create(cls.table).run()
         rr.table(cls.table).index_create('segment').run()
+        rr.table(cls.table).index_create('draining').run()
         rr.table(cls.table).index_wait('segment').run()
+        rr.table(cls.table).index_wait('draining').run()
+    @classmethod
+    def draining_assignments(cls, rr):
+        '''
+        Assignments that have been superseded by an assignment of the same
+        segment to another node, but are kept around until the new node is
+        serving the segment.
+        '''
+        return (Assignment(rr, d=asmt) for asmt in rr.table(cls.table, read_mode='outdated').get_all(True, index='draining').run())
     @classmethod
     def host_assignments(cls, rr, node):
         return (Assignment(rr, d=asmt) for asmt in rr.table(cls.table, read_mode='outdated').between('%s:\x01' % node, '%s:\x7f' % node, right_bound="closed").run())
@@ -130,6 +206,223 @@ class Assignment(doublethink.Document):
     @classmethod
     def segment_assignments(cls, rr, segment):
         return (Assignment(rr, d=asmt) for asmt in rr.table(cls.table, read_mode='outdated').get_all(segment, index="segment").run())
+    @classmethod
+    def segments_assignments(cls, rr, segments, batch_size=1000):
+        '''Assignments of all of `segments`, looked up `batch_size` segments per query.'''
+        segments = list(segments)
+        for i in range(0, len(segments), batch_size):
+            for asmt in rr.table(cls.table, read_mode='outdated').get_all(*segments[i:i+batch_size], index="segment").run():
+                yield Assignment(rr, d=asmt)
+
+# a segment that needs to be assigned to `node` on `ring`, replacing
+# `assignment` (None if this is a new copy of the segment), with `copies` the
+# number of copies the segment currently has on the rings it is placed on
+Move = collections.namedtuple(
+        'Move', ['copies', 'order', 'segment', 'ring', 'node', 'assignment'])
+
+class SyncState(doublethink.Document):
+    '''Bookkeeping that the sync master persists across failovers.'''
+    table = 'sync_state'
+
+def file_checksum(path, block_size=1024 * 1024):
+    '''Returns the hex sha256 digest of the file at `path`.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ChecksumMismatch(Exception):
+    pass
+
+class FetchInProgress(Exception):
+    pass
+
+# reservations of local disk by segments being fetched to serve reads, kept
+# in this directory under LOCAL_DATA (see `LocalSyncController.reserve_room()`)
+READ_THROUGH_RESERVATIONS = '.read-through'
+
+def verify_checksum(segment, checksum, expected):
+    '''
+    Raises `ChecksumMismatch` if `expected` (the checksum recorded when
+    `segment` was promoted) is known and `checksum` (of our copy) differs.
+    '''
+    if expected and checksum != expected:
+        raise ChecksumMismatch(
+                'copy of segment %r from hdfs %s has checksum %s, expected %s' % (
+                    segment.id, segment.remote_path, checksum, expected))
+
+class HashingFile:
+    '''
+    Wraps file `f`, keeping a running sha256 digest of what is read from or
+    written to it, so that a file can be checksummed while it is streamed.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.digest.update(data)
+        return data
+    def write(self, data):
+        self.digest.update(data)
+        return self.f.write(data)
+
+# promotion publishes block checksums of each segment at the segment's hdfs
+# path plus this suffix, so that workers can fetch just the blocks that changed
+BLOCKSUMS_SUFFIX = '.blocksums'
+
+def file_block_checksums(path, block_size):
+    '''
+    Reads the file at `path` once, and returns a dict with its size, its hex
+    sha256 digest as 'checksum' (same as `file_checksum()`), and 'blocks',
+    a list of hex sha1 digests of each `block_size` bytes of the file.
+    '''
+    digest = hashlib.sha256()
+    blocks = []
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+            blocks.append(hashlib.sha1(block).hexdigest())
+            size += len(block)
+    return {
+        'size': size,
+        'block_size': block_size,
+        'checksum': digest.hexdigest(),
+        'blocks': blocks,
+    }
+
+SEGMENT_SUFFIX = '.sqlite'
+COMPRESSED_SEGMENT_SUFFIX = '.sqlite.zst'
+
+def is_segment_path(path):
+    '''True if `path` is a segment file in hdfs, compressed or not.'''
+    return path.endswith(SEGMENT_SUFFIX) or path.endswith(COMPRESSED_SEGMENT_SUFFIX)
+
+def segment_id_from_path(path):
+    name = path.split('/')[-1]
+    for suffix in (COMPRESSED_SEGMENT_SUFFIX, SEGMENT_SUFFIX):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def segment_path_variant(path, compressed):
+    '''
+    Returns `path` (a segment file in hdfs, compressed or not) with the
+    suffix for a compressed segment file if `compressed`, otherwise for a
+    plain one.
+    '''
+    if path.endswith(COMPRESSED_SEGMENT_SUFFIX):
+        path = path[:-len(COMPRESSED_SEGMENT_SUFFIX)] + SEGMENT_SUFFIX
+    return path + '.zst' if compressed else path
+
+def latest_segment_files(entries):
+    '''
+    Filters hdfs3 `ls(detail=True)` style `entries` down to segment files,
+    one per segment. If a segment has both a compressed and an uncompressed
+    file (e.g. promotion was interrupted after switching
+    COMPRESS_SEGMENTS), the most recently modified one wins.
+    '''
+    latest = {}
+    for entry in entries:
+        if not is_segment_path(entry['name']):
+            continue
+        segment_id = segment_id_from_path(entry['name'])
+        if segment_id not in latest or entry['last_mod'] > latest[segment_id]['last_mod']:
+            latest[segment_id] = entry
+    return latest.values()
+
+class SegmentCatalog(doublethink.Document):
+    '''
+    One document per segment in hdfs, keyed by segment id, recording its
+    remote path, size, mtime and checksum. Kept up to date by segment
+    promotion and deletion (and by `MasterSyncController.reconcile_segment_catalog`
+    for changes made behind trough's back), so that sync loops can find out
+    what is in hdfs without listing it.
+    '''
+    table = 'segment_catalog'
+    @classmethod
+    def listing(cls, rr):
+        '''
+        Returns the catalog as an iterator of dicts that look like hdfs3
+        `ls(detail=True)` entries.
+        '''
+        for entry in rr.table(cls.table, read_mode='outdated').run():
+            yield {
+                'name': entry['remote_path'],
+                'kind': 'file',
+                # placement goes by how much room the segment takes up on
+                # workers, not in hdfs
+                'size': entry.get('uncompressed_size') or entry['size'],
+                'last_mod': entry['last_mod'],
+                'checksum': entry.get('checksum'),
+            }
+    @classmethod
+    def record(
+            cls, rr, segment_id, remote_path, size, last_mod, checksum=None,
+            uncompressed_size=None):
+        entry = cls(rr, d={
+            'remote_path': remote_path,
+            'size': size,
+            'uncompressed_size': uncompressed_size,
+            'last_mod': last_mod,
+            'checksum': checksum,
+            'updated_on': doublethink.utcnow(),
+        })
+        entry.id = segment_id
+        entry.save()
+        return entry
+
+class ReadStats(doublethink.Document):
+    '''
+    Number of reads of each segment, keyed by segment id, in the current and
+    previous READ_STATS_WINDOW second windows, like `{ "id": "1234",
+    "window": 439876, "reads": 40, "previous_reads": 112, "last_read":
+    r.time(...) }`. Read servers add to them every so often, and local sync
+    uses them to download the segments in demand first.
+    '''
+    table = 'read_stats'
+    @staticmethod
+    def current_window():
+        return int(time.time() // settings['READ_STATS_WINDOW'])
+    @classmethod
+    def record(cls, rr, counts, window=None):
+        '''Adds `counts`, a dict of { segment_id: reads }, to the stats.'''
+        window = window if window is not None else cls.current_window()
+        docs = [{
+            'id': segment_id, 'window': window, 'reads': reads,
+            'previous_reads': 0, 'last_read': r.now(),
+        } for segment_id, reads in counts.items()]
+        rr.table(cls.table).insert(docs, conflict=lambda id, old, new: r.branch(
+            old['window'].eq(new['window']),
+            old.merge({'reads': old['reads'].add(new['reads']), 'last_read': new['last_read']}),
+            new.merge({'previous_reads': r.branch(
+                old['window'].eq(new['window'].sub(1)), old['reads'], 0)}))).run()
+    @classmethod
+    def last_reads(cls, rr, segment_ids, batch_size=1000):
+        '''Returns { segment_id: time of last read } for `segment_ids`.'''
+        segment_ids = list(segment_ids)
+        last_reads = {}
+        for i in range(0, len(segment_ids), batch_size):
+            for stats in rr.table(cls.table, read_mode='outdated').get_all(
+                    *segment_ids[i:i+batch_size]).pluck('id', 'last_read').run():
+                last_reads[stats['id']] = stats.get('last_read')
+        return last_reads
+    @classmethod
+    def demand(cls, rr, segment_ids, window=None, batch_size=1000):
+        '''Returns { segment_id: recent reads } for `segment_ids`.'''
+        window = window if window is not None else cls.current_window()
+        segment_ids = list(segment_ids)
+        demand = {}
+        for i in range(0, len(segment_ids), batch_size):
+            for stats in rr.table(cls.table, read_mode='outdated').get_all(
+                    *segment_ids[i:i+batch_size]).run():
+                if stats['window'] == window:
+                    demand[stats['id']] = stats['reads'] + stats['previous_reads']
+                elif stats['window'] == window - 1:
+                    demand[stats['id']] = stats['reads']
+        return demand
 
 class Lock(doublethink.Document):
     @classmethod
@@ -160,6 +453,11 @@ def init(rethinker):
     Assignment.table_ensure(rethinker)
     Lock.table_ensure(rethinker)
     Schema.table_ensure(rethinker)
+    SyncState.table_ensure(rethinker)
+    SegmentCatalog.table_ensure(rethinker)
+    Lease.table_ensure(rethinker)
+    ReadStats.table_ensure(rethinker)
+    SegmentMembership.table_ensure(rethinker)
     default_schema = Schema.load(rethinker, 'default')
     if not default_schema:
         default_schema = Schema(rethinker, d={'sql':''})
@@ -168,6 +466,12 @@ def init(rethinker):
         default_schema.save()
     else:
         logging.info('default schema already exists %r', default_schema)
+    try:
+        # index added after the assignment table was first created
+        rethinker.table('assignment').index_create('draining').run()
+        rethinker.table('assignment').index_wait('draining').run()
+    except Exception as e:
+        pass
     try:
         rethinker.table('services').index_create('segment').run()
         rethinker.table('services').index_create('role').run()
@@ -180,6 +484,22 @@ def init(rethinker):
     for d in snakebite_client.mkdir([settings['HDFS_PATH']], create_parent=True):
         logging.info('created hdfs dir %r', d)
 
+def local_segment_path(segment_id, local_data=None):
+    '''
+    Returns the path of the local copy of segment `segment_id` under
+    `local_data` (by default LOCAL_DATA) in the layout set by
+    LOCAL_DATA_LAYOUT_DEPTH, unless it is still in the top directory,
+    waiting for scripts/migrate_local_layout.py to move it.
+    '''
+    local_data = local_data or settings['LOCAL_DATA']
+    depth = settings['LOCAL_DATA_LAYOUT_DEPTH']
+    path = local_index.segment_path(local_data, segment_id, depth)
+    if depth and not os.path.exists(path):
+        flat_path = local_index.segment_path(local_data, segment_id)
+        if os.path.exists(flat_path):
+            return flat_path
+    return path
+
 class Segment(object):
     def __init__(self, segment_id, size, rethinker, services, registry, remote_path=None):
         self.id = segment_id
@@ -188,15 +508,15 @@ class Segment(object):
         self.services = services
         self.registry = registry
         self.remote_path = remote_path
+        self._cold_store = None
+        self._minimum_assignments = None
     def host_key(self, host):
         return "%s:%s" % (host, self.id)
     def all_copies(self):
         ''' returns the 'assigned' segment copies, whether or not they are 'up' '''
         return Assignment.segment_assignments(self.rethinker, self.id)
     def readable_copies_query(self):
-        return self.rethinker.table('services', read_mode='outdated').get_all(self.id, index="segment").filter({"role": 'trough-read'}).filter(
-                lambda svc: r.now().sub(svc["last_heartbeat"]).lt(svc["ttl"])
-            )
+        return read_services_query(self.rethinker, [self.id])
     def readable_copies(self):
         '''returns the 'up' copies of this segment to read from, per rethinkdb.'''
         return self.readable_copies_query().run()
@@ -215,15 +535,20 @@ class Segment(object):
         return bool(Assignment.load(self.rethinker, self.host_key(host)))
     def minimum_assignments(self):
         '''This function should return the minimum number of assignments which is acceptable for a given segment.'''
-        if hasattr(settings['MINIMUM_ASSIGNMENTS'], "__call__"):
-            return settings['MINIMUM_ASSIGNMENTS'](self.id)
-        else:
-            return settings['MINIMUM_ASSIGNMENTS']
+        # settings don't change at runtime, so only evaluate the policy once
+        if self._minimum_assignments is None:
+            if hasattr(settings['MINIMUM_ASSIGNMENTS'], "__call__"):
+                self._minimum_assignments = settings['MINIMUM_ASSIGNMENTS'](self.id)
+            else:
+                self._minimum_assignments = settings['MINIMUM_ASSIGNMENTS']
+        return self._minimum_assignments
     def cold_store(self):
-        if hasattr(settings['COLD_STORE_SEGMENT'], "__call__"):
-            return settings['COLD_STORE_SEGMENT'](self.id)
-        else:
-            return settings['COLD_STORE_SEGMENT']
+        if self._cold_store is None:
+            if hasattr(settings['COLD_STORE_SEGMENT'], "__call__"):
+                self._cold_store = settings['COLD_STORE_SEGMENT'](self.id)
+            else:
+                self._cold_store = settings['COLD_STORE_SEGMENT']
+        return self._cold_store
     def cold_storage_path(self):
         return settings['COLD_STORAGE_PATH'].format(prefix=str(self.id)[0:-3], segment_id=self.id)
     def new_write_lock(self):
@@ -241,10 +566,11 @@ class Segment(object):
     def local_path(self):
         if self.cold_store():
             return self.cold_storage_path()
-        return os.path.join(settings['LOCAL_DATA'], "%s.sqlite" % self.id)
+        return local_segment_path(self.id)
     def local_segment_exists(self):
         return os.path.isfile(self.local_path())
     def provision_local_segment(self, schema_sql):
+        os.makedirs(os.path.dirname(self.local_path()), exist_ok=True)
         connection = sqlite3.connect(self.local_path())
         setup_connection(connection)
         cursor = connection.cursor()
@@ -290,15 +616,75 @@ class HostRegistry(object):
         doc['load'] = os.getloadavg()[1] # load average over last 5 mins
         logging.info('Heartbeat: role[%s] node[%s] at IP %s:%s with ttl %s' % (pool, node, node, doc.get('port'), ttl))
         return self.services.heartbeat(doc)
-    def bulk_heartbeat(self, ids):
-        self.rethinker.table('services').get_all(*ids).update({ 'last_heartbeat': r.now(), 'load': os.getloadavg()[1] }).run()
-        # send a non-bulk heartbeat for each id we *didn't* just update
+    def segment_service_doc(self, service_id, load):
+        '''
+        Returns a new service registry entry for per-segment service
+        `service_id` (like 'trough-read:node1:segment1'), with the same
+        fields `heartbeat()` would give it.
+        '''
+        pool, node, segment = service_id.split(":")
+        port = settings['WRITE_PORT'] if pool == 'trough-write' else settings['READ_PORT']
+        return {
+            'id': service_id,
+            'role': pool,
+            'node': node,
+            'segment': segment,
+            'port': port,
+            'url': 'http://%s:%s/?segment=%s' % (node, port, segment),
+            'ttl': round(settings['SYNC_LOOP_TIMING'] * 4),
+            'load': load,
+            'last_heartbeat': r.now(),
+            'first_heartbeat': r.now(),
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+        }
+    def bulk_heartbeat_batch(self, ids, load):
+        '''
+        Heartbeats the services in `ids`, creating any that don't exist yet.
+
+        Returns:
+            number of services created
+        '''
+        result = self.rethinker.table('services').get_all(*ids).update(
+                {'last_heartbeat': r.now(), 'load': load}).run()
+        if result['replaced'] + result['unchanged'] >= len(ids):
+            return 0
+        # some don't exist (yet, or any more), find out which
         missing_ids = set(ids) - set(self.rethinker.table('services').get_all(*ids).get_field('id').run())
-        for id in missing_ids:
-            pool, node, segment = id.split(":")
-            port = settings['WRITE_PORT'] if pool == 'trough-write' else settings['READ_PORT']
-            url = 'http://%s:%s/?segment=%s' % (node, port, segment)
-            self.heartbeat(pool=pool, node=node, segment=segment, port=port, url=url, ttl=round(settings['SYNC_LOOP_TIMING'] * 4))
+        if missing_ids:
+            self.rethinker.table('services').insert(
+                    [self.segment_service_doc(id, load) for id in missing_ids],
+                    conflict='replace').run()
+        return len(missing_ids)
+    def bulk_heartbeat(self, ids):
+        '''
+        Heartbeats the per-segment services in `ids`, in batches of
+        HEARTBEAT_BATCH_SIZE with up to HEARTBEAT_CONCURRENCY batches in
+        flight at once. Only batches where the update touched fewer services
+        than it was given are checked for services that need creating.
+        '''
+        ids = list(ids)
+        load = os.getloadavg()[1] # load average over last 5 mins
+        batch_size = settings['HEARTBEAT_BATCH_SIZE']
+        batches = [ids[i:i+batch_size] for i in range(0, len(ids), batch_size)]
+        created = 0
+        failed = 0
+        with futures.ThreadPoolExecutor(max_workers=settings['HEARTBEAT_CONCURRENCY']) as pool:
+            fs = {pool.submit(self.bulk_heartbeat_batch, batch, load): batch for batch in batches}
+            for future in futures.as_completed(fs):
+                try:
+                    created += future.result()
+                except Exception as e:
+                    logging.warning(
+                            'failed to heartbeat batch of %s services: %s',
+                            len(fs[future]), e)
+                    failed += 1
+        if created:
+            logging.info('created %s service registry entries', created)
+        if failed:
+            raise Exception(
+                    'failed to heartbeat %s of %s batches of services' % (
+                        failed, len(batches)))
     def assign(self, hostname, segment, remote_path):
         logging.info("Assigning segment: %s to '%s'" % (segment.id, hostname))
         asmt = Assignment(self.rethinker, d={
@@ -325,6 +711,19 @@ class HostRegistry(object):
         logging.info('Checked for segments assigned to %s: Found %s segment(s)' % (host, len(segments)))
         return list(segments.values())
 
+class PlacementContext:
+    '''
+    The hosts that segments can be assigned to, as of the start of an
+    assignment cycle, looked up once per cycle rather than once per segment.
+    '''
+    def __init__(self, registry):
+        # list of healthy 'trough-nodes' services
+        self.hosts = registry.get_hosts(exclude_cold=False)
+        self.warm_hosts = [host for host in self.hosts if not host.get('cold_storage')]
+        self.cold_hosts = [host for host in self.hosts if host.get('cold_storage')]
+        # { node: bytes of storage }
+        self.capacities = {host['node']: host.get('available_bytes') for host in self.warm_hosts}
+
 # Base class, not intended for use.
 class SyncController:
     __metaclass__ = abc.ABCMeta
@@ -357,6 +756,9 @@ class SyncController:
         self.storage_in_bytes = settings['STORAGE_IN_BYTES']
     def start(self):
         pass
+    def sleep(self, seconds):
+        '''Sleeps between sync loops.'''
+        time.sleep(seconds)
     def check_config(self):
         raise Exception('Not Implemented')
     def ls_r(self, hdfs, path):
@@ -367,10 +769,16 @@ class SyncController:
     def check_health(self):
         pass
     def get_segment_file_list(self):
-        logging.info('Looking for *.sqlite in hdfs recursively under %s', self.hdfs_path)
+        if settings['USE_SEGMENT_CATALOG']:
+            if not self.rethinker.table(SegmentCatalog.table).is_empty().run():
+                logging.info('Reading segment list from %s table', SegmentCatalog.table)
+                return SegmentCatalog.listing(self.rethinker)
+            logging.warning(
+                    '%s table is empty (not reconciled yet?), falling back '
+                    'to listing hdfs', SegmentCatalog.table)
+        logging.info('Looking for *.sqlite and *.sqlite.zst in hdfs recursively under %s', self.hdfs_path)
         hdfs = HDFileSystem(host=self.hdfs_host, port=self.hdfs_port)
-        return (entry for entry in self.ls_r(hdfs, self.hdfs_path)
-                if entry['name'].endswith('.sqlite'))
+        return latest_segment_files(self.ls_r(hdfs, self.hdfs_path))
     def list_schemas(self):
         gen = self.rethinker.table(Schema.table)['id'].run()
         result = list(gen)
@@ -402,6 +810,120 @@ class MasterSyncController(SyncController):
         super().__init__(*args, **kwargs)
         self.current_master = {}
         self.current_host_nodes = []
+        # { segment_id: (size, remote_path) } of segments whose assignments
+        # are up to date as of the last assign_segments() pass
+        self.assigned_segments = {}
+        # fingerprint of the hash rings `self.assigned_segments` was computed
+        # with; if this changes, every segment needs to be looked at again
+        self.placement_key = None
+        self.last_full_assignment_pass = 0
+        # segments that still have assignments but were missing from the
+        # last hdfs listing; they're unassigned if they're missing again
+        self.missing_segment_ids = set()
+        # this master only looks after segments in its shard of the segment
+        # id space (see `trough.placement.segment_shard()`); shard 0 also
+        # looks after the hash rings and the segment catalog
+        self.shards = settings['SEGMENT_MANAGER_SHARDS']
+        self.shard = settings['SEGMENT_MANAGER_SHARD']
+        self.lease = None
+        # lease token of the term `assigned_segments` was computed in
+        self.lease_token = None
+        if settings['SYNC_MASTER_LEASE']:
+            self.lease = Lease(
+                    self.rethinker, self.lease_name(), node=self.hostname,
+                    ttl=settings['SYNC_MASTER_LEASE_TTL'],
+                    info={'url': self.master_candidate()['url'], 'shard': self.shard},
+                    on_acquired=self.advertise_master)
+
+    def lease_name(self):
+        if self.shards > 1:
+            return 'trough-sync-master:%s' % self.shard
+        return 'trough-sync-master'
+
+    def in_shard(self, segment_id):
+        return segment_shard(segment_id, self.shards) == self.shard
+
+    def start(self):
+        if self.lease:
+            self.lease.start()
+        if settings['SEGMENT_CATALOG_RECONCILE_INTERVAL']:
+            threading.Thread(
+                    target=self.reconcile_segment_catalog_periodically_forever,
+                    name='SegmentCatalogReconciler', daemon=True).start()
+
+    def sleep(self, seconds):
+        if self.lease and not self.lease.held:
+            # get to work as soon as we take over
+            self.lease.acquired.wait(seconds)
+        else:
+            time.sleep(seconds)
+
+    def reconcile_segment_catalog_periodically_forever(self):
+        while True:
+            time.sleep(settings['SEGMENT_CATALOG_RECONCILE_INTERVAL'])
+            # only the sync master (for shard 0) reconciles
+            if self.current_master.get('node') != self.hostname or self.shard != 0:
+                continue
+            try:
+                self.reconcile_segment_catalog()
+            except:
+                logging.error('problem reconciling segment catalog', exc_info=True)
+
+    def reconcile_segment_catalog(self):
+        '''
+        Compares the segment catalog against a recursive listing of hdfs,
+        adding or updating entries for files that are missing or differ and
+        deleting entries for files that are gone. Entries changed by a
+        segment promotion while this is running are left alone.
+        '''
+        start = time.time()
+        catalog = {entry['id']: entry for entry in self.rethinker.table(SegmentCatalog.table).run()}
+        hdfs = HDFileSystem(host=self.hdfs_host, port=self.hdfs_port)
+        listed = set()
+        updated = 0
+        for file in latest_segment_files(self.ls_r(hdfs, self.hdfs_path)):
+            segment_id = segment_id_from_path(file['name'])
+            listed.add(segment_id)
+            entry = catalog.get(segment_id)
+            if entry and (entry['remote_path'], entry['size'], entry['last_mod']) == (file['name'], file['size'], file['last_mod']):
+                continue
+            logging.info('updating segment catalog entry for %s from hdfs: %r', segment_id, file)
+            self.rethinker.table(SegmentCatalog.table).insert({
+                    'id': segment_id,
+                    'remote_path': file['name'],
+                    'size': file['size'],
+                    'last_mod': file['last_mod'],
+                    'checksum': None,
+                    'uncompressed_size': None,
+                    'updated_on': doublethink.utcnow(),
+                }, conflict=lambda id, old, new: r.branch(
+                    old['last_mod'].gt(new['last_mod']), old,
+                    old.merge(new.without('checksum', 'uncompressed_size')).merge(r.branch(
+                        # promotion's checksum and uncompressed size only
+                        # hold for the file it promoted
+                        old['remote_path'].ne(new['remote_path'])\
+                                .or_(old['size'].ne(new['size']))\
+                                .or_(old['last_mod'].ne(new['last_mod'])),
+                        {'checksum': None, 'uncompressed_size': None}, {})))).run()
+            updated += 1
+
+        deleted = 0
+        if listed:
+            for segment_id, entry in catalog.items():
+                if segment_id in listed:
+                    continue
+                logging.info('deleting segment catalog entry for %s, not found in hdfs', segment_id)
+                # unless it was promoted again in the meantime
+                self.rethinker.table(SegmentCatalog.table).get(segment_id).replace(
+                        lambda e: r.branch(
+                            e['last_mod'].eq(entry['last_mod']), None, e)).run()
+                deleted += 1
+        elif catalog:
+            logging.warning('found no segments in hdfs, not deleting anything from the segment catalog')
+        logging.info(
+                'reconciled segment catalog with hdfs in %0.1f sec: %s '
+                'segments in hdfs, %s entries updated, %s deleted',
+                time.time() - start, len(listed), updated, deleted)
 
     def check_config(self):
         try:
@@ -409,6 +931,8 @@ class MasterSyncController(SyncController):
             assert settings['HDFS_HOST'], "HDFS_HOST must be set, or I can't communicate with HDFS."
             assert settings['HDFS_PORT'], "HDFS_PORT must be set, or I can't communicate with HDFS."
             assert settings['ELECTION_CYCLE'] > 0, "ELECTION_CYCLE must be greater than zero. It governs the number of seconds in a sync master election period."
+            assert 0 <= settings['SEGMENT_MANAGER_SHARD'] < settings['SEGMENT_MANAGER_SHARDS'], "SEGMENT_MANAGER_SHARD must be between 0 and SEGMENT_MANAGER_SHARDS - 1."
+            assert settings['SEGMENT_MANAGER_SHARDS'] == 1 or settings['SYNC_MASTER_LEASE'], "SYNC_MASTER_LEASE must be enabled to run more than one SEGMENT_MANAGER_SHARDS."
             assert settings['HOSTNAME'], "HOSTNAME must be set, or I can't figure out my own hostname."
             assert settings['EXTERNAL_IP'], "EXTERNAL_IP must be set. We need to know which IP to use."
             assert settings['SYNC_SERVER_PORT'], "SYNC_SERVER_PORT must be set. We need to know the output port."
@@ -416,17 +940,42 @@ class MasterSyncController(SyncController):
         except AssertionError as e:
             sys.exit("{} Exiting...".format(str(e)))
 
-    def hold_election(self):
-        logging.debug(
-                'Holding Sync Master Election (current master is %s)...',
-                self.current_master.get('url'))
-        candidate = {
+    def master_candidate(self):
+        return {
             "id": "trough-sync-master",
             "node": self.hostname,
             "port": self.sync_server_port,
             "url": "http://%s:%s/" % (self.hostname, self.sync_server_port),
             "ttl": self.election_cycle + self.sync_loop_timing * 4,
         }
+
+    def advertise_master(self, lease=None):
+        '''
+        Lease mode: we are the master, say so in the service registry, where
+        clients look for the master. With more than one shard, clients look
+        for the trough-segment-manager service for a segment's shard, and
+        fall back to the trough-sync-master, which is the master for shard 0.
+        '''
+        candidate = self.master_candidate()
+        if self.shards > 1:
+            self.services.heartbeat(dict(
+                candidate, id='trough-segment-manager:%s' % self.shard,
+                role='trough-segment-manager', load=0, shard=self.shard,
+                shards=self.shards, lease_token=self.lease.token))
+        if self.shard == 0:
+            self.current_master = self.services.heartbeat(dict(
+                candidate, role='trough-sync-master', load=0,
+                lease_token=self.lease.token))
+        else:
+            self.current_master = dict(candidate, shard=self.shard)
+
+    def hold_election(self):
+        if self.lease:
+            return self.check_lease()
+        logging.debug(
+                'Holding Sync Master Election (current master is %s)...',
+                self.current_master.get('url'))
+        candidate = self.master_candidate()
         sync_master = self.services.unique_service('trough-sync-master', candidate=candidate)
         if sync_master.get('node') == self.hostname:
             if self.current_master.get('node') != sync_master.get('node'):
@@ -440,6 +989,34 @@ class MasterSyncController(SyncController):
             self.current_master = sync_master
             return False
 
+    def check_lease(self):
+        '''
+        Lease mode counterpart of `hold_election()`: the lease is renewed in
+        the background, so this only checks whether we hold it.
+        '''
+        token = self.lease.token
+        if not self.lease.held:
+            logging.debug('I am not the master (I do not hold the lease)')
+            if self.current_master.get('node') == self.hostname:
+                self.current_master = {}
+            return False
+        if token != self.lease_token:
+            logging.info('I am the new master! (lease token %s)', token)
+            # somebody else may have been master since we last were, so
+            # nothing we remember from then can be trusted, and anything
+            # left queued from then must not be committed
+            self.assigned_segments = {}
+            self.placement_key = None
+            self.missing_segment_ids = set()
+            self.registry.assignment_queue.clear()
+            self.registry.unassignment_queue.clear()
+            fence = lambda query: self.lease.fence(query, token)
+            self.registry.assignment_queue.fence = fence
+            self.registry.unassignment_queue.fence = fence
+            self.lease_token = token
+        self.advertise_master()
+        return True
+
     def delete_segment(self, segment_id):
         '''
         Looks up the segment's assignments and services to determine which
@@ -482,6 +1059,7 @@ class MasterSyncController(SyncController):
                         'deleted crufty trough-write service %r => %r',
                         service['id'], result)
             workers.add(service['node'])
+        workers.update(SegmentMembership.nodes(self.rethinker, segment_id))
 
         if not workers:
             raise KeyError(
@@ -505,12 +1083,178 @@ class MasterSyncController(SyncController):
                 'rethinkdb result of deleting %s assignment: %s',
                 segment_id, result)
 
+        # and any membership listings left by workers that didn't answer
+        result = SegmentMembership.remove_everywhere(self.rethinker, segment_id)
+        logging.info(
+                'rethinkdb result of removing %s from segment membership: %s',
+                segment_id, result)
+
+        # delete from the catalog before the files go away, so no sync loop
+        # reading the catalog tries to fetch a file that no longer exists
+        result = self.rethinker.table(SegmentCatalog.table)\
+                .get(segment_id).delete().run()
+        logging.info(
+                'rethinkdb result of deleting %s from segment catalog: %s',
+                segment_id, result)
+
         # delete files from hdfs
         hdfs_paths = [a['remote_path'] for a in assignments if a.get('remote_path')]
         if hdfs_paths:
             hdfs_cli = client.Client(settings['HDFS_HOST'], settings['HDFS_PORT'])
             result = list(hdfs_cli.delete(hdfs_paths))
             logging.info('%s', result)
+            # and the block checksums published with them, if any
+            try:
+                result = list(hdfs_cli.delete(
+                    [path + BLOCKSUMS_SUFFIX for path in set(hdfs_paths)]))
+                logging.info('%s', result)
+            except Exception as e:
+                logging.info('no block checksums deleted for %s: %s', segment_id, e)
+            # and the segment file in the other form (compressed or not), if
+            # it was promoted again since it was assigned
+            try:
+                result = list(hdfs_cli.delete([
+                    segment_path_variant(path, not path.endswith(COMPRESSED_SEGMENT_SUFFIX))
+                    for path in set(hdfs_paths)]))
+                logging.info('%s', result)
+            except Exception as e:
+                logging.info('no other form of segment file deleted for %s: %s', segment_id, e)
+
+    def compute_placement_key(self, host_ring_mapping, cold_hosts):
+        '''
+        Returns a fingerprint of everything besides the segment itself that
+        determines where a segment is assigned: hash ring membership and
+        weights, and the set of cold storage hosts.
+        '''
+        placement = {
+            'rings': {k: v for k, v in host_ring_mapping.items() if k != 'id'},
+            'cold_hosts': sorted(host['node'] for host in cold_hosts),
+            'max_copies': settings['MAXIMUM_ASSIGNMENTS'],
+        }
+        return hashlib.sha1(json.dumps(placement, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def shard_assignments(self):
+        '''Returns all assignments of segments in this master's shard.'''
+        assignments = Assignment.all(self.rethinker)
+        if self.shards == 1:
+            return assignments
+        return (assignment for assignment in assignments
+                if assignment.segment is not None and self.in_shard(assignment.segment))
+
+    def load_assigned_segments(self, assignments):
+        '''
+        Rebuilds `self.assigned_segments` from the assignment table, e.g.
+        after taking over from another master. Segments whose assignments
+        disagree about size or remote path are left out, so that they are
+        looked at again.
+        '''
+        assigned_segments = {}
+        inconsistent = set()
+        for assignment in assignments:
+            if assignment.segment is None:
+                continue
+            value = (assignment.bytes, assignment.remote_path)
+            if assigned_segments.setdefault(assignment.segment, value) != value:
+                inconsistent.add(assignment.segment)
+        for segment_id in inconsistent:
+            del assigned_segments[segment_id]
+        self.assigned_segments = assigned_segments
+
+    def schedule_moves(self, moves):
+        '''
+        Queues up assignments for `moves`, most under-replicated segments
+        first, until REBALANCE_MAX_BYTES_PER_CYCLE bytes in total, or
+        REBALANCE_MAX_BYTES_PER_NODE bytes for any one node, have been
+        assigned. Segments that have no copies at all are always assigned.
+        The assignment being replaced, if any, is marked as draining rather
+        than deleted, so that the old node keeps serving the segment until
+        the new one has it (see `release_drained_assignments()`).
+
+        Returns:
+            tuple (number of moves scheduled, set of ids of segments with
+            moves that were put off until a later cycle)
+        '''
+        max_bytes_per_cycle = settings['REBALANCE_MAX_BYTES_PER_CYCLE']
+        max_bytes_per_node = settings['REBALANCE_MAX_BYTES_PER_NODE']
+        cycle_bytes = 0
+        node_bytes = collections.Counter()
+        deferred_segment_ids = set()
+        scheduled = 0
+        for move in sorted(moves, key=lambda move: (move.copies, move.order)):
+            segment = move.segment
+            size = segment.size or 0
+            if move.copies > 0 and (
+                    (max_bytes_per_cycle is not None
+                        and cycle_bytes + size > max_bytes_per_cycle)
+                    or (max_bytes_per_node is not None
+                        and node_bytes[move.node] + size > max_bytes_per_node)):
+                deferred_segment_ids.add(segment.id)
+                continue
+            cycle_bytes += size
+            node_bytes[move.node] += size
+            scheduled += 1
+            logging.info("Segment [%s] will be assigned to host '%s' for ring [%s]", segment.id, move.node, move.ring.id)
+            if move.assignment:
+                logging.info("Draining old assignment to node '%s' for segment [%s]: (%s will be deleted once the new node is serving it)", move.assignment.node, segment.id, move.assignment)
+                move.assignment['draining'] = True
+                self.registry.assignment_queue.enqueue(move.assignment)
+            self.registry.assignment_queue.enqueue(Assignment(self.rethinker, d={
+                                                'id': '%s:%s' % (move.node, segment.id),
+                                                'hash_ring': move.ring.id,
+                                                'node': move.node,
+                                                'segment': segment.id,
+                                                'assigned_on': doublethink.utcnow(),
+                                                'remote_path': segment.remote_path,
+                                                'bytes': segment.size }))
+        if deferred_segment_ids:
+            logging.info(
+                    'assigned %s bytes this cycle, putting off moves of %s '
+                    'segments until later', cycle_bytes,
+                    len(deferred_segment_ids))
+        return scheduled, deferred_segment_ids
+
+    def release_drained_assignments(self):
+        '''
+        Deletes draining assignments whose replacement node has a healthy
+        trough-read service for the segment, or that have no replacement
+        anymore.
+        '''
+        draining = [
+                assignment for assignment in Assignment.draining_assignments(self.rethinker)
+                if self.in_shard(assignment.segment)]
+        if not draining:
+            return
+        current_nodes = {}
+        for assignment in Assignment.segments_assignments(
+                self.rethinker, {a.segment for a in draining}):
+            if not assignment.draining:
+                current_nodes['%s-%s' % (assignment.hash_ring, assignment.segment)] = assignment.node
+        service_ids = {}
+        for assignment in draining:
+            node = current_nodes.get('%s-%s' % (assignment.hash_ring, assignment.segment))
+            if node:
+                service_ids[assignment.id] = 'trough-read:%s:%s' % (node, assignment.segment)
+        healthy_service_ids = set()
+        segment_ids = list({assignment.segment for assignment in draining})
+        for i in range(0, len(segment_ids), 1000):
+            healthy_service_ids.update(read_services_query(
+                self.rethinker, segment_ids[i:i+1000])['id'].run())
+        released = 0
+        for assignment in draining:
+            if assignment.id not in service_ids or service_ids[assignment.id] in healthy_service_ids:
+                logging.info('deleting drained assignment %s', assignment.id)
+                self.registry.unassign(assignment)
+                released += 1
+        logging.info(
+                '%s of %s draining assignments have been replaced',
+                released, len(draining))
+        self.registry.commit_unassignments()
+
+    def assigned_bytes_by_node(self):
+        '''Returns a dict of total bytes of segments assigned to each node.'''
+        return self.rethinker.table('assignment', read_mode='outdated')\
+                .has_fields('node')\
+                .group('node').sum(lambda asmt: asmt['bytes'].default(0)).run()
 
     def assign_segments(self):
         logging.debug('Assigning and balancing segments...')
@@ -527,14 +1271,20 @@ class MasterSyncController(SyncController):
         segments = []
         for file in segment_files:
             segment = Segment(
-                segment_id=file['name'].split('/')[-1].replace('.sqlite', ''),
+                segment_id=segment_id_from_path(file['name']),
                 size=file['size'],
                 remote_path=file['name'],
                 rethinker=self.rethinker,
                 services=self.services,
                 registry=self.registry)
             segments.append(segment) # TODO: fix this per comment above.
-        logging.info('assigning and balancing %r segments', len(segments))
+        logging.info('found %r segments', len(segments))
+        # an empty listing more likely means trouble talking to hdfs than
+        # that every segment is gone
+        listing_empty = not segments
+        if self.shards > 1:
+            segments = [segment for segment in segments if self.in_shard(segment.id)]
+            logging.info('%r segments are in shard %s of %s', len(segments), self.shard, self.shards)
 
         # host_ring_mapping will be e.g. { 'host1': { 'ring': 0, 'weight': 188921 }, 'host2': { 'ring': 0, 'weight': 190190091 }... }
         # the keys are node names, the values are array indices for the hash_rings variable (below)
@@ -543,60 +1293,142 @@ class MasterSyncController(SyncController):
             host_ring_mapping = Assignment(self.rethinker, {})
             host_ring_mapping.id = "ring-assignments"
 
-        host_weights = {host['node']: self.registry.total_bytes_for_node(host['node'])
-                        for host in self.registry.get_hosts()}
+        context = PlacementContext(self.registry)
+        host_weights = context.capacities
+
+        sync_state_id = 'assignment' if self.shards == 1 else 'assignment:%s' % self.shard
+        sync_state = SyncState.load(self.rethinker, sync_state_id)
+        if not sync_state:
+            sync_state = SyncState(self.rethinker, {})
+            sync_state.id = sync_state_id
+
+        # every so often, adjust host weights so that hosts fill up evenly
+        # (the master for shard 0 looks after the hash rings for everybody)
+        rebalance_interval = settings['RING_WEIGHT_REBALANCE_INTERVAL']
+        if self.shard == 0 and rebalance_interval is not None and time.time() - (sync_state.last_weight_rebalance or 0) > rebalance_interval:
+            rebalance_weights(
+                    host_ring_mapping, host_weights, self.assigned_bytes_by_node(),
+                    settings['RING_WEIGHT_REBALANCE_THRESHOLD'])
+            sync_state.last_weight_rebalance = time.time()
 
         # instantiate N hash rings where N is the lesser of (the maximum number of copies of any segment)
-        # and (the number of currently available hosts)
-        hash_rings = []
-        for i in range(min(max_copies, len(host_weights))):
-            ring = HashRing()
-            ring.id = i
-            hash_rings.append(ring)
-
-        # prune hosts that don't exist anymore
-        for host in [key for key in host_ring_mapping.keys() if key not in host_weights and key != 'id']:
-            logging.info('pruning worker %r from pool (worker went offline?) [was: hash ring %s]', host, host_ring_mapping[host])
-            del(host_ring_mapping[host])
-
-        # assign each host to one hash ring. Save the assignment in rethink so it's reproducible.
-        # weight each host assigned to a hash ring with its total assignable bytes quota
-        for hostname in [key for key in host_ring_mapping.keys() if key != 'id']:
-            host = host_ring_mapping[hostname]
-            hash_rings[host['ring']].add_node(hostname, { 'weight': host['weight'] })
-            logging.info("Host '%s' assigned to ring %s" % (hostname, host['ring']))
-
-        new_hosts = [host for host in host_weights if host not in host_ring_mapping]
-        for host in new_hosts:
-            weight = host_weights[host]
-            host_ring = sorted(hash_rings, key=lambda ring: len(ring.get_nodes()))[0].id # TODO: this should be sorted by bytes, not raw # of nodes
-            host_ring_mapping[host] = { 'weight': weight, 'ring': host_ring }
-            hash_rings[host_ring].add_node(host, { 'weight': weight })
-            logging.info("new trough worker %r assigned to ring %r", host, host_ring)
-
-        host_ring_mapping.save()
+        # and (the number of currently available hosts), assign each host to one hash ring, and
+        # weight each host assigned to a hash ring with its total assignable bytes quota. Save the
+        # assignment in rethink so it's reproducible.
+        hash_rings = build_hash_rings(
+                host_ring_mapping, host_weights,
+                min(max_copies, len(host_weights)))
+        if self.shard == 0:
+            # other shards come up with the same rings from the same mapping
+            host_ring_mapping.save()
+
+        # Work out which segments need to be (re)assigned. If the hash rings
+        # or cold storage hosts changed since the last pass, any segment may
+        # have moved, so look at all of them. Otherwise only look at segments
+        # that are new, have changed size or location, or have disappeared.
+        placement_key = self.compute_placement_key(
+                host_ring_mapping, context.cold_hosts)
+        full_pass = False
+        if placement_key != self.placement_key:
+            if (placement_key == sync_state.placement_key
+                    and sync_state.committed is not False
+                    and self.placement_key is None):
+                # we just became master and the rings are unchanged since the
+                # previous master's last pass, so pick up where it left off
+                logging.info('loading existing assignments to resume incremental assignment')
+                self.load_assigned_segments(self.shard_assignments())
+                self.last_full_assignment_pass = sync_state.last_full_pass or 0
+            else:
+                logging.info('hash rings changed since last pass, looking at every segment')
+                full_pass = True
+        if time.time() - self.last_full_assignment_pass > settings['FULL_ASSIGNMENT_PASS_INTERVAL']:
+            logging.info('periodic full assignment pass, looking at every segment')
+            full_pass = True
+
+        current_segment_ids = {segment.id for segment in segments}
+        if full_pass:
+            assignments = self.shard_assignments()
+            segments_to_assign = segments
+        else:
+            segments_to_assign = [
+                    segment for segment in segments
+                    if self.assigned_segments.get(segment.id) != (segment.size, segment.remote_path)]
+            removed_segment_ids = [
+                    segment_id for segment_id in
+                    set(self.assigned_segments) | self.missing_segment_ids
+                    if not listing_empty and segment_id not in current_segment_ids]
+            assignments = Assignment.segments_assignments(
+                    self.rethinker,
+                    [segment.id for segment in segments_to_assign] + removed_segment_ids)
+        logging.info(
+                'assigning and balancing %r of %r segments (full_pass=%s)',
+                len(segments_to_assign), len(segments), full_pass)
 
         # 'ring_assignments' will be like { "0-192811": Assignment(), "1-192811": Assignment()... }
         ring_assignments = {}
         cold_assignments = {}
-        for assignment in Assignment.all(self.rethinker):
-            if assignment.hash_ring == 'cold':
+        # assignments of segments that are no longer in hdfs
+        orphaned_assignments = []
+        missing_segment_ids = set()
+        for assignment in assignments:
+            if assignment.id == 'ring-assignments':
+                continue
+            if not listing_empty and assignment.segment not in current_segment_ids:
+                # a segment can be left out of a listing cut short by
+                # trouble talking to hdfs, so only give up on it if it was
+                # missing from the previous listing too
+                if assignment.segment in self.missing_segment_ids:
+                    orphaned_assignments.append(assignment)
+                else:
+                    missing_segment_ids.add(assignment.segment)
+            elif assignment.draining:
+                # release_drained_assignments() takes care of these
+                continue
+            elif assignment.hash_ring == 'cold':
                 dict_key = "%s-%s" % (assignment.node, assignment.segment)
                 cold_assignments[dict_key] = assignment
-            elif assignment.id != 'ring-assignments':
+            else:
                 dict_key = "%s-%s" % (assignment.hash_ring, assignment.segment)
                 ring_assignments[dict_key] = assignment
 
+        if (segments_to_assign or orphaned_assignments) and sync_state.committed is not False:
+            # if we die partway through committing changes, the next master
+            # can't trust the assignment table to be consistent
+            sync_state.committed = False
+            sync_state.save()
+
         changed_assignments = 0
+        for assignment in orphaned_assignments:
+            logging.info('removing assignment %s because segment %s is gone from hdfs', assignment.id, assignment.segment)
+            changed_assignments += 1
+            self.registry.unassign(assignment)
+
+        # find position of each warm segment in N hash rings, where N is the
+        # minimum number of assignments for that segment, all in one batch
+        warm_segments = [segment for segment in segments_to_assign if not segment.cold_store()]
+        placements = dict(zip(
+            (segment.id for segment in warm_segments),
+            PlacementEngine(hash_rings).place(
+                [segment.id for segment in warm_segments],
+                [segment.minimum_assignments() for segment in warm_segments])))
+
+        # segments that need to be assigned to a new node, see schedule_moves()
+        moves = []
         i = 0
-        for segment in segments:
+        for segment in segments_to_assign:
             i += 1
             if i % 10000 == 0:
                 logging.info(
                         'processed assignments for %s of %s segments so far',
-                        i, len(segments))
+                        i, len(segments_to_assign))
+            if self.lease:
+                # the lease is renewed in the background, just make sure we
+                # still have it
+                if not self.lease.held or self.lease.token != self.lease_token:
+                    logging.warning('lost the sync master lease partway through assigning segments')
+                    return False
             # if it's been over 80% of an election cycle since the last heartbeat, hold an election so we don't lose master status
-            if datetime.datetime.now() - datetime.timedelta(seconds=0.8 * self.election_cycle) > last_heartbeat:
+            elif datetime.datetime.now() - datetime.timedelta(seconds=0.8 * self.election_cycle) > last_heartbeat:
                 if self.hold_election():
                     last_heartbeat = datetime.datetime.now()
                 else:
@@ -604,8 +1436,9 @@ class MasterSyncController(SyncController):
             logging.debug("Assigning segment [%s]", segment.id)
             if segment.cold_store():
                 # assign segment, so we can advertise the service
-                for cold_host in self.registry.get_cold_hosts():
-                    if not cold_assignments.get("%s-%s" % (cold_host['node'], segment.id)):
+                for cold_host in context.cold_hosts:
+                    cold_assignment = cold_assignments.get("%s-%s" % (cold_host['node'], segment.id))
+                    if not cold_assignment:
                         logging.info("Segment [%s] will be assigned to cold storage tier host [%s]", segment.id, cold_host['node'])
                         changed_assignments += 1
                         self.registry.assignment_queue.enqueue(Assignment(self.rethinker, d={
@@ -615,44 +1448,62 @@ class MasterSyncController(SyncController):
                                                         'remote_path': segment.remote_path,
                                                         'bytes': segment.size,
                                                         'hash_ring': "cold" }))
+                    elif (cold_assignment.bytes, cold_assignment.remote_path) != (segment.size, segment.remote_path):
+                        cold_assignment['bytes'] = segment.size
+                        cold_assignment['remote_path'] = segment.remote_path
+                        self.registry.assignment_queue.enqueue(cold_assignment)
                 for ring in hash_rings:
                     warm_dict_key = '%s-%s' % (ring.id, segment.id)
                     if warm_dict_key in ring_assignments:
                         logging.info('removing warm assignnment %s because segment %s is cold', ring_assignments[warm_dict_key], segment.id)
                         self.registry.unassign(ring_assignments[warm_dict_key])
                 continue
-            # find position of segment in N hash rings, where N is the minimum number of assignments for this segment
-            random.seed(segment.id) # (seed random so we always get the same sample of hash rings for this item)
-            assigned_rings = random.sample(hash_rings, segment.minimum_assignments())
-            logging.debug("Segment [%s] will use rings %s", segment.id, [s.id for s in assigned_rings])
-            for ring in assigned_rings:
-                # get the node for the key from hash ring, updating or creating assignments from corresponding entry in 'ring_assignments' as necessary
-                assigned_node = ring.get_node(segment.id)
-                dict_key = "%s-%s" % (ring.id, segment.id)
-                assignment = ring_assignments.get(dict_key)
+            logging.debug("Segment [%s] will use rings %s", segment.id, [ring.id for ring, node in placements[segment.id]])
+            current_assignments = [
+                    ring_assignments.get("%s-%s" % (ring.id, segment.id))
+                    for ring, node in placements[segment.id]]
+            copies = sum(1 for assignment in current_assignments if assignment)
+            for (ring, assigned_node), assignment in zip(placements[segment.id], current_assignments):
                 logging.debug("Current assignment: '%s' New assignment: '%s'", assignment.node if assignment else None, assigned_node)
                 if assignment is None or assignment.node != assigned_node:
-                    changed_assignments += 1
-                    logging.info("Segment [%s] will be assigned to host '%s' for ring [%s]", segment.id, assigned_node, ring.id)
-                    if assignment:
-                        logging.info("Removing old assignment to node '%s' for segment [%s]: (%s will be deleted)", assignment.node, segment.id, assignment)
-                        self.registry.unassign(assignment)
-                        del ring_assignments[dict_key]
-                    ring_assignments[dict_key] = ring_assignments.get(dict_key, Assignment(self.rethinker, d={ 
-                                                        'hash_ring': ring.id,
-                                                        'node': assigned_node,
-                                                        'segment': segment.id,
-                                                        'assigned_on': doublethink.utcnow(),
-                                                        'remote_path': segment.remote_path,
-                                                        'bytes': segment.size }))
-                    ring_assignments[dict_key]['node'] = assigned_node
-                    ring_assignments[dict_key]['id'] = "%s:%s" % (ring_assignments[dict_key]['node'], ring_assignments[dict_key]['segment'])
-                    self.registry.assignment_queue.enqueue(ring_assignments[dict_key])
+                    moves.append(Move(
+                        copies, len(moves), segment, ring, assigned_node, assignment))
+                elif (assignment.bytes, assignment.remote_path) != (segment.size, segment.remote_path):
+                    # segment changed in hdfs (e.g. promoted), keep the
+                    # assignment up to date
+                    assignment['bytes'] = segment.size
+                    assignment['remote_path'] = segment.remote_path
+                    self.registry.assignment_queue.enqueue(assignment)
+
+        scheduled, deferred_segment_ids = self.schedule_moves(moves)
+        changed_assignments += scheduled
         logging.info("%s assignments changed during this sync cycle.", changed_assignments)
         # commit assignments that were created or updated
         self.registry.commit_unassignments()
         self.registry.commit_assignments()
+        self.release_drained_assignments()
 
+        # remember what we did so the next pass can skip unchanged segments
+        if full_pass:
+            self.assigned_segments = {}
+            self.last_full_assignment_pass = time.time()
+        else:
+            for segment_id in removed_segment_ids:
+                self.assigned_segments.pop(segment_id, None)
+        for segment in segments_to_assign:
+            if segment.id not in deferred_segment_ids:
+                self.assigned_segments[segment.id] = (segment.size, segment.remote_path)
+        if missing_segment_ids:
+            logging.warning(
+                    '%s assigned segments missing from hdfs listing, will '
+                    'unassign them if they are still missing next pass',
+                    len(missing_segment_ids))
+        self.missing_segment_ids = missing_segment_ids
+        self.placement_key = placement_key
+        sync_state.placement_key = placement_key
+        sync_state.last_full_pass = self.last_full_assignment_pass
+        sync_state.committed = True
+        sync_state.save()
 
     def sync(self):
         '''
@@ -702,10 +1553,7 @@ class MasterSyncController(SyncController):
 
         assignment = self.rethinker.table('lock')\
             .get('write:lock:%s' % segment_id)\
-            .default(r.table('services')\
-                .get_all(segment_id, index='segment')\
-                .filter({'role':'trough-read'})\
-                .filter(lambda svc: r.now().sub(svc["last_heartbeat"]).lt(svc["ttl"]))\
+            .default(read_services_query(None, [segment_id])\
                 .order_by('load')[0].default(
                     r.table('services')\
                         .get_all('trough-nodes', index='role')\
@@ -767,7 +1615,30 @@ class LocalSyncController(SyncController):
         self.read_id_tmpl = 'trough-read:%s:%%s' % self.hostname
         self.write_id_tmpl = 'trough-write:%s:%%s' % self.hostname
         self.healthy_service_ids = set()
+        # publishes our read services under SERVICE_REGISTRY_MODEL 'node'
+        self.membership_publisher = None
+        # whether we've cleared out what we advertised under the other model
+        self._other_model_cleared = False
         self.heartbeat_thread = threading.Thread(target=self.heartbeat_periodically_forever, daemon=True)
+        # segments copied down from hdfs, carrying on across sync loops
+        self.download_scheduler = DownloadScheduler(
+                threads=settings['COPY_THREAD_POOL_SIZE'],
+                max_bytes_per_sec=settings['DOWNLOAD_MAX_BYTES_PER_SEC'],
+                max_bytes_per_sec_per_datanode=settings['DOWNLOAD_MAX_BYTES_PER_SEC_PER_DATANODE'],
+                locate=self.segment_datanodes,
+                retry_delay=settings['DOWNLOAD_RETRY_DELAY'],
+                max_retry_delay=settings['DOWNLOAD_MAX_RETRY_DELAY'])
+        self.local_index = None
+        if settings['LOCAL_SEGMENT_INDEX']:
+            if LocalSegmentIndex.available():
+                self.local_index = LocalSegmentIndex(
+                        self.local_data, settings['LOCAL_DATA_LAYOUT_DEPTH'])
+            else:
+                logging.warning(
+                        "'LOCAL_SEGMENT_INDEX' setting is enabled but "
+                        "'inotify_simple' module not available, listing %s "
+                        "every sync loop instead. Install to use the local "
+                        "segment index.", self.local_data)
 
     def start(self):
         init_worker()
@@ -789,45 +1660,344 @@ class LocalSyncController(SyncController):
         self.heartbeat()
         # make a copy for thread safety
         healthy_service_ids = list(self.healthy_service_ids)
-        self.registry.bulk_heartbeat(healthy_service_ids)
+        if settings['SERVICE_REGISTRY_MODEL'] == 'node':
+            read_prefix = self.read_id_tmpl % ''
+            self.publish_membership([
+                id[len(read_prefix):] for id in healthy_service_ids
+                if id.startswith(read_prefix)])
+            self.registry.bulk_heartbeat([
+                id for id in healthy_service_ids
+                if not id.startswith(read_prefix)])
+        else:
+            if not self._other_model_cleared:
+                # in case we ran under the 'node' model before
+                SegmentMembership.clear(
+                        self.rethinker, self.hostname,
+                        settings['SERVICE_REGISTRY_BUCKETS'])
+                self._other_model_cleared = True
+            self.registry.bulk_heartbeat(healthy_service_ids)
         return healthy_service_ids
 
+    def publish_membership(self, segment_ids):
+        '''
+        Lists `segment_ids` in our membership records, which stand in for
+        per-segment trough-read services under SERVICE_REGISTRY_MODEL
+        'node'.
+        '''
+        if self.membership_publisher is None:
+            self.membership_publisher = MembershipPublisher(
+                    self.rethinker, self.hostname, self.read_port,
+                    settings['SERVICE_REGISTRY_BUCKETS'])
+        rewritten, updated = self.membership_publisher.publish(segment_ids)
+        logging.info(
+                'published %s segments, rewrote %s membership records and '
+                'updated %s', len(segment_ids), rewritten, updated)
+        if not self._other_model_cleared:
+            # retire our per-segment read services from the 'segment' model
+            # now that the membership records are up, so that copies aren't
+            # counted twice until they expire
+            read_prefix = self.read_id_tmpl % ''
+            result = self.rethinker.table('services').between(
+                    read_prefix, read_prefix[:-1] + ';').delete().run()
+            if result.get('deleted'):
+                logging.info(
+                        'deleted %s per-segment read services',
+                        result['deleted'])
+            self._other_model_cleared = True
+
     def check_config(self):
         try:
             assert settings['HOSTNAME'], "HOSTNAME must be set, or I can't figure out my own hostname."
             assert settings['EXTERNAL_IP'], "EXTERNAL_IP must be set. We need to know which IP to use."
             assert settings['READ_PORT'], "READ_PORT must be set. We need to know the output port."
             assert settings['RETHINKDB_HOSTS'], "RETHINKDB_HOSTS must be set. Where can I contact RethinkDB on port 29015?"
+            assert zstandard or not settings['COMPRESS_SEGMENTS'], "COMPRESS_SEGMENTS is set but the 'zstandard' module is not available. Install it to compress segments."
         except AssertionError as e:
             sys.exit("{} Exiting...".format(str(e)))
 
     def check_health(self):
         assert self.heartbeat_thread.is_alive()
 
-    def copy_segment_from_hdfs(self, segment):
+    def copy_segment_from_hdfs(self, segment, checksum=None):
+        '''
+        Copies `segment` from hdfs to a temp file, which replaces the local
+        copy once it is complete and, if `checksum` is given, matches it. The
+        checksum is worked out as the data is written, so the copy isn't
+        read back from local disk.
+
+        Raises:
+            ChecksumMismatch: if the copy doesn't match `checksum` (the local
+                copy is left alone)
+        '''
         logging.debug('copying segment %r from HDFS path %r...', segment.id, segment.remote_path)
         assert segment.remote_path
-        source = [segment.remote_path]
+        if segment.remote_path.endswith(COMPRESSED_SEGMENT_SUFFIX):
+            return self.copy_compressed_segment_from_hdfs(segment, checksum)
+        hdfs = HDFileSystem(host=self.hdfs_host, port=self.hdfs_port)
         with tempfile.TemporaryDirectory() as tmpdir:
             tmp_dest = os.path.join(tmpdir, "%s.sqlite" % segment.id)
-            logging.debug('running snakebite.Client.copyToLocal(%r, %r)', source, tmp_dest)
-            snakebite_client = client.Client(settings['HDFS_HOST'], settings['HDFS_PORT'])
-            for f in snakebite_client.copyToLocal(source, tmp_dest):
-                if f.get('error'):
-                    raise Exception('Copying HDFS file %r to %r produced an error: %r' % (source, tmp_dest, f['error']))
-                logging.debug('copying from hdfs succeeded, moving %s to %s', tmp_dest, segment.local_path())
-                # clobbers segment.local_path if it already exists, which is what we want
-                os.rename(tmp_dest, segment.local_path())
+            with hdfs.open(segment.remote_path, 'rb') as src, open(tmp_dest, 'wb') as dest:
+                dest = HashingFile(dest)
+                shutil.copyfileobj(src, dest, 1024 * 1024)
+            verify_checksum(segment, dest.digest.hexdigest(), checksum)
+            logging.debug('copying from hdfs succeeded, moving %s to %s', tmp_dest, segment.local_path())
+            os.makedirs(os.path.dirname(segment.local_path()), exist_ok=True)
+            # clobbers segment.local_path if it already exists, which is what we want
+            os.rename(tmp_dest, segment.local_path())
+            self.local_segment_changed(segment.id)
+            return True
+
+    def copy_compressed_segment_from_hdfs(self, segment, checksum=None):
+        '''
+        Copies a zstd compressed segment from hdfs, decompressing it on the
+        fly, so the compressed copy never touches local disk. The checksum
+        is worked out as the decompressed data is written.
+        '''
+        if not zstandard:
+            raise Exception(
+                    "segment %r is compressed in hdfs (%r) but the "
+                    "'zstandard' module is not available" % (
+                        segment.id, segment.remote_path))
+        hdfs = HDFileSystem(host=self.hdfs_host, port=self.hdfs_port)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_dest = os.path.join(tmpdir, "%s.sqlite" % segment.id)
+            with hdfs.open(segment.remote_path, 'rb') as src, open(tmp_dest, 'wb') as dest:
+                dest = HashingFile(dest)
+                read, written = zstandard.ZstdDecompressor().copy_stream(src, dest)
+            verify_checksum(segment, dest.digest.hexdigest(), checksum)
+            logging.debug(
+                    'decompressed %s bytes from hdfs %s to %s bytes, moving '
+                    '%s to %s', read, segment.remote_path, written, tmp_dest,
+                    segment.local_path())
+            os.makedirs(os.path.dirname(segment.local_path()), exist_ok=True)
+            # clobbers segment.local_path if it already exists, which is what we want
+            os.rename(tmp_dest, segment.local_path())
+            self.local_segment_changed(segment.id)
+            return True
+
+    def peer_transfer_source(self, segment_id):
+        '''
+        Returns (path, checksum) of our copy of `segment_id`, for a peer to
+        copy, if it's up to date with the segment catalog, i.e. at least as
+        new as the copy in hdfs. `checksum` is the one recorded in the
+        catalog, which the copy should have.
+
+        Raises:
+            KeyError: if we have no up to date copy to give, or it's being
+                written to on this node
+        '''
+        entry = self.rethinker.table(SegmentCatalog.table).get(segment_id).run()
+        if not entry or not entry.get('checksum'):
+            raise KeyError('segment %r has no checksum in the catalog' % segment_id)
+        segment = Segment(
+                segment_id=segment_id, size=0, rethinker=self.rethinker,
+                services=self.services, registry=self.registry)
+        if segment.local_host_can_write():
+            raise KeyError('segment %r is being written on this node' % segment_id)
+        path = segment.local_path()
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            raise KeyError('segment %r not found on local disk' % segment_id)
+        if mtime < entry['last_mod']:
+            raise KeyError('local copy of segment %r is older than hdfs' % segment_id)
+        return path, entry['checksum']
+
+    def copy_segment_from_peer(self, segment, checksum):
+        '''
+        Copies `segment` from the least loaded of the other nodes serving it,
+        if PEER_TRANSFER is on, trying up to PEER_TRANSFER_MAX_PEERS of them.
+        Peers only give out copies that are up to date with the segment
+        catalog (see `peer_transfer_source()`), and the copy has to match
+        `checksum`, so without one there's nothing to go by and we don't try.
+
+        Returns:
+            True if the segment was copied from a peer, False if it should be
+            copied from hdfs instead
+        '''
+        if not settings['PEER_TRANSFER'] or not checksum:
+            return False
+        peers = read_services_query(self.rethinker, [segment.id])\
+                .filter(lambda svc: svc['node'].ne(self.hostname))\
+                .order_by('load')['node']\
+                .limit(settings['PEER_TRANSFER_MAX_PEERS']).run()
+        for peer in peers:
+            url = 'http://%s:%s/segment/%s/data' % (peer, self.sync_local_port, segment.id)
+            try:
+                start = time.time()
+                size = self.download_from_peer(url, segment, checksum)
+                logging.info(
+                        'copied segment %r (%s bytes) from peer %s in %0.1f sec',
+                        segment.id, size, peer, time.time() - start)
                 return True
+            except Exception as e:
+                logging.warning('could not copy segment %r from peer %s: %s', segment.id, peer, e)
+        return False
+
+    def download_from_peer(self, url, segment, checksum):
+        '''
+        Streams `segment` from a peer's `url` to a temp file, which replaces
+        the local copy once it is complete and matches `checksum`. If the
+        connection drops, the download picks up where it left off with a
+        range request, up to PEER_TRANSFER_RETRIES times, as long as the
+        peer's copy hasn't changed meanwhile (going by its etag).
+
+        Returns:
+            size of the copy in bytes
+
+        Raises:
+            ChecksumMismatch: if the copy doesn't match `checksum`
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_dest = os.path.join(tmpdir, "%s.sqlite" % segment.id)
+            received = 0
+            etag = None
+            with open(tmp_dest, 'wb') as dest:
+                dest = HashingFile(dest)
+                for attempt in range(settings['PEER_TRANSFER_RETRIES'] + 1):
+                    headers = {}
+                    if received:
+                        headers = {'Range': 'bytes=%s-' % received, 'If-Range': etag}
+                    try:
+                        with requests.get(
+                                url, headers=headers, stream=True,
+                                timeout=settings['PEER_TRANSFER_TIMEOUT']) as response:
+                            response.raise_for_status()
+                            if response.headers.get('X-Trough-Checksum') != checksum:
+                                raise ChecksumMismatch(
+                                        'peer %s has a different version of segment %r' % (
+                                            url, segment.id))
+                            if received and response.status_code != 206:
+                                raise Exception('copy at %s changed while we were downloading it' % url)
+                            etag = response.headers.get('ETag')
+                            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                                dest.write(chunk)
+                                received += len(chunk)
+                        break
+                    except (requests.exceptions.ConnectionError,
+                            requests.exceptions.ChunkedEncodingError,
+                            requests.exceptions.Timeout) as e:
+                        if not etag or attempt >= settings['PEER_TRANSFER_RETRIES']:
+                            raise
+                        logging.info(
+                                'resuming download of segment %r from %s at byte %s after: %s',
+                                segment.id, url, received, e)
+            if dest.digest.hexdigest() != checksum:
+                raise ChecksumMismatch(
+                        'copy of segment %r from %s has checksum %s, expected %s' % (
+                            segment.id, url, dest.digest.hexdigest(), checksum))
+            logging.debug('copying from peer succeeded, moving %s to %s', tmp_dest, segment.local_path())
+            os.makedirs(os.path.dirname(segment.local_path()), exist_ok=True)
+            # clobbers segment.local_path if it already exists, which is what we want
+            os.rename(tmp_dest, segment.local_path())
+            self.local_segment_changed(segment.id)
+            return received
+
+    def segment_datanodes(self, remote_path):
+        '''
+        Returns { datanode: bytes } of how much of the hdfs file at
+        `remote_path` we can expect to read from each datanode, splitting
+        each block evenly among the datanodes that have a replica of it.
+        '''
+        hdfs = HDFileSystem(host=self.hdfs_host, port=self.hdfs_port)
+        datanodes = collections.Counter()
+        for block in hdfs.get_block_locations(remote_path):
+            hosts = [h.decode('utf-8') if isinstance(h, bytes) else h for h in block['hosts']]
+            for host in hosts:
+                datanodes[host] += block['length'] / len(hosts)
+        return datanodes
+
+    def segment_checksum(self, segment_id):
+        '''
+        Returns the checksum recorded in the segment catalog when the
+        segment was last promoted, or None if there isn't one.
+        '''
+        entry = self.rethinker.table(SegmentCatalog.table).get(segment_id).run()
+        return entry.get('checksum') if entry else None
+
+    def readable_copy_counts(self, segment_ids, batch_size=1000):
+        '''
+        Returns { segment_id: number of healthy trough-read services on other
+        nodes } for `segment_ids`.
+        '''
+        segment_ids = list(segment_ids)
+        counts = {}
+        for i in range(0, len(segment_ids), batch_size):
+            counts.update(read_services_query(
+                        self.rethinker, segment_ids[i:i+batch_size])\
+                    .filter(lambda svc: svc['node'].ne(self.hostname))\
+                    .group('segment').count().run())
+        return counts
+
+    def patch_segment_from_hdfs(self, segment):
+        '''
+        Brings the local copy of `segment` up to date by fetching only the
+        blocks that differ from the copy in hdfs, going by the block checksums
+        published alongside it at promotion. The blocks are patched into a
+        copy of the local file, which is swapped into place once its checksum
+        matches.
+
+        Returns:
+            True if the segment was patched, False if it needs to be copied
+            in full instead (compressed in hdfs, no block checksums, too much
+            has changed, or the patched copy doesn't check out)
+        '''
+        if segment.remote_path.endswith(COMPRESSED_SEGMENT_SUFFIX):
+            # no seeking to a block in a compressed stream
+            return False
+        hdfs = HDFileSystem(host=self.hdfs_host, port=self.hdfs_port)
+        blocksums_path = segment.remote_path + BLOCKSUMS_SUFFIX
+        if not hdfs.exists(blocksums_path):
+            logging.info('no block checksums for segment %r, copying in full', segment.id)
+            return False
+        with hdfs.open(blocksums_path, 'rb') as f:
+            remote = ujson.loads(f.read())
+        block_size = remote['block_size']
+        local = file_block_checksums(segment.local_path(), block_size)
+        changed = [
+                i for i, checksum in enumerate(remote['blocks'])
+                if i >= len(local['blocks']) or local['blocks'][i] != checksum]
+        if len(changed) > settings['DELTA_SYNC_MAX_CHANGED_FRACTION'] * len(remote['blocks']):
+            logging.info(
+                    '%s of %s blocks of segment %r changed, copying in full',
+                    len(changed), len(remote['blocks']), segment.id)
+            return False
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_dest = os.path.join(tmpdir, "%s.sqlite" % segment.id)
+            shutil.copyfile(segment.local_path(), tmp_dest)
+            with open(tmp_dest, 'r+b') as out, hdfs.open(segment.remote_path, 'rb') as src:
+                for i in changed:
+                    src.seek(i * block_size)
+                    out.seek(i * block_size)
+                    out.write(src.read(block_size))
+                out.truncate(remote['size'])
+            if file_checksum(tmp_dest) != remote['checksum']:
+                logging.warning(
+                        'patched copy of segment %r does not match checksum '
+                        'in %s (segment promoted again meanwhile?), copying '
+                        'in full', segment.id, blocksums_path)
+                return False
+            logging.info(
+                    'patched %s of %s blocks (%s bytes) of segment %r from hdfs',
+                    len(changed), len(remote['blocks']),
+                    len(changed) * block_size, segment.id)
+            # readers that already have the old file open carry on with it
+            os.rename(tmp_dest, segment.local_path())
+            self.local_segment_changed(segment.id)
+        return True
 
     def heartbeat(self):
         logging.warning('Updating health check for "%s".' % self.hostname)
+        downloads = self.download_scheduler.status()
         # reset the countdown
         self.registry.heartbeat(pool='trough-nodes',
             node=self.hostname,
             ttl=round(self.sync_loop_timing * 4),
             available_bytes=self.storage_in_bytes,
             cold_storage=settings['RUN_AS_COLD_STORAGE_NODE'],
+            download_queue=downloads['queued'] + downloads['running'],
+            download_bytes_remaining=downloads['bytes_remaining'],
+            download_eta=downloads['eta'],
         )
 
     def decommission_writable_segment(self, segment, write_lock):
@@ -864,22 +2034,71 @@ class LocalSyncController(SyncController):
                 '%s.delete() %s', self.rethinker.table('services').get(svc_id),
                 result)
         deleted_service = bool(result.get('deleted'))
+        if settings['SERVICE_REGISTRY_MODEL'] == 'node':
+            deleted_service = SegmentMembership.remove(
+                    self.rethinker, self.hostname, segment_id,
+                    settings['SERVICE_REGISTRY_BUCKETS']) or deleted_service
 
         deleted_file = False
         if not settings['RUN_AS_COLD_STORAGE_NODE']:
             try:
-                path = os.path.join(
-                        settings['LOCAL_DATA'], '%s.sqlite' % segment_id)
+                path = local_segment_path(segment_id)
                 os.unlink(path)
                 deleted_file = True
             except FileNotFoundError:
                 deleted_file = False
+            self.local_segment_changed(segment_id)
 
         if not deleted_file and not deleted_service:
             raise KeyError
 
     def segment_id_from_path(self, path):
-        return path.split("/")[-1].replace('.sqlite', '')
+        return segment_id_from_path(path)
+
+    def local_segment_changed(self, segment_id):
+        '''
+        Updates the local segment index, if we have one, after writing or
+        deleting the local copy of a segment.
+        '''
+        if self.local_index:
+            self.local_index.update(segment_id)
+
+    def local_segment_mtimes(self):
+        '''Returns { segment_id: mtime } of the segments on local disk.'''
+        if self.local_index:
+            return {
+                segment_id: segment.mtime
+                for segment_id, segment in self.local_index.segments().items()}
+        local_mtimes = {}
+        for segment_id, entry in local_index.scan(self.local_data):
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                logging.warning('%r gone since listing directory', entry.path)
+                continue
+            # a segment in both the old and new layout mid-migration
+            local_mtimes[segment_id] = max(mtime, local_mtimes.get(segment_id, 0))
+        return local_mtimes
+
+    def local_segment_sizes(self):
+        '''Returns { segment_id: size in bytes } of the segments on local disk.'''
+        if self.local_index:
+            return {
+                segment_id: segment.size
+                for segment_id, segment in self.local_index.segments().items()}
+        local_sizes = {}
+        for segment_id, entry in local_index.scan(self.local_data):
+            try:
+                local_sizes[segment_id] = local_sizes.get(segment_id, 0) + entry.stat().st_size
+            except FileNotFoundError:
+                logging.warning('%r gone since listing directory', entry.path)
+        return local_sizes
+
+    def local_segment_ids(self):
+        '''Returns ids of the segments on local disk.'''
+        if self.local_index:
+            return list(self.local_index.segments())
+        return list({segment_id for segment_id, entry in local_index.scan(self.local_data)})
 
     def discard_warm_stuff(self):
         '''
@@ -915,7 +2134,12 @@ class LocalSyncController(SyncController):
                 'deleted %s from ring assignments: %s returned %s',
                 self.hostname, query, result)
 
-    def process_stale_segment(self, segment, local_mtime=None, remote_mtime=None):
+    def process_stale_segment(self, segment, local_mtime=None, remote_mtime=None, checksum=None):
+        '''
+        Copies `segment` down, if it's assigned to us. `checksum` is the one
+        in the segment catalog listing the sync loop went by, if any; if
+        there isn't one, or a copy doesn't match it, it's looked up afresh.
+        '''
         logging.info('processing stale segment id: %s', segment.id)
         if not segment or not segment.remote_path:
             # There is a newer copy in hdfs but we are not assigned to
@@ -924,23 +2148,43 @@ class LocalSyncController(SyncController):
             # write lock after copying it down, ensuring there is no period
             # of time when no one is serving the segment.
             logging.info('segment %s appears to be assigned to another machine', segment.id)
-            return
+            return True
         if local_mtime:
             logging.info('replacing segment %r local copy (mtime=%s) from hdfs (mtime=%s)',
                          segment.id, datetime.datetime.fromtimestamp(local_mtime),
                          datetime.datetime.fromtimestamp(remote_mtime))
         else:
             logging.info('copying new segment %r from hdfs', segment.id)
-        try:
-            self.copy_segment_from_hdfs(segment)
-        except Exception as e:
-            logging.error('Error during HDFS copy of segment %r', segment.id, exc_info=True)
-            return
+        retries = settings['SEGMENT_CHECKSUM_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                if not (local_mtime and settings['DELTA_SYNC'] and self.patch_segment_from_hdfs(segment)):
+                    # looked up afresh after a mismatch, in case it was down
+                    # to the segment being promoted again meanwhile
+                    if (attempt or not checksum) and (
+                            settings['VERIFY_SEGMENT_CHECKSUMS'] or settings['PEER_TRANSFER']):
+                        checksum = self.segment_checksum(segment.id)
+                    if not self.copy_segment_from_peer(segment, checksum):
+                        if not settings['VERIFY_SEGMENT_CHECKSUMS']:
+                            checksum = None
+                        self.copy_segment_from_hdfs(segment, checksum=checksum)
+                break
+            except ChecksumMismatch as e:
+                logging.warning('%s (attempt %s of %s)', e, attempt + 1, retries + 1)
+            except Exception as e:
+                logging.error('Error during HDFS copy of segment %r', segment.id, exc_info=True)
+                return False
+        else:
+            logging.error(
+                    'giving up on copying segment %r from hdfs for now, '
+                    'every copy failed checksum verification', segment.id)
+            return False
         self.healthy_service_ids.add(self.read_id_tmpl % segment.id)
         write_lock = segment.retrieve_write_lock()
         if write_lock:
             logging.info("Segment %s has a writable copy. It will be decommissioned in favor of the newer read-only copy from HDFS.", segment.id)
             self.decommission_writable_segment(segment, write_lock)
+        return True
 
     def sync(self):
         '''
@@ -984,6 +2228,7 @@ class LocalSyncController(SyncController):
             return
 
         remote_mtimes = {}  # { segment_id: mtime (long) }
+        remote_checksums = {}  # { segment_id: checksum }, if listed by the segment catalog
         try:
             # iterator of dicts that look like this
             # {'last_mod': 1509406266, 'replication': 0, 'block_size': 0, 'name': '//tmp', 'group': 'supergroup', 'last_access': 0, 'owner': 'hdfs', 'kind': 'directory', 'permissions': 1023, 'encryption_info': None, 'size': 0}
@@ -991,21 +2236,16 @@ class LocalSyncController(SyncController):
             for file in remote_listing:
                 segment_id = self.segment_id_from_path(file['name'])
                 remote_mtimes[segment_id] = file['last_mod']
+                if file.get('checksum'):
+                    remote_checksums[segment_id] = file['checksum']
             hdfs_up = True
         except Exception as e:
             logging.error('Error while listing files from HDFS', exc_info=True)
             logging.warning('PROCEEDING WITHOUT DATA FROM HDFS')
             hdfs_up = False
         logging.info('found %r segments in hdfs', len(remote_mtimes))
-        # list of filenames
-        local_listing = os.listdir(self.local_data)
         # { segment_id: mtime }
-        local_mtimes = {}
-        for path in local_listing:
-            try:
-                local_mtimes[self.segment_id_from_path(path)] = os.stat(os.path.join(self.local_data, path)).st_mtime
-            except:
-                logging.warning('%r gone since listing directory', path)
+        local_mtimes = self.local_segment_mtimes()
         logging.info('found %r segments on local disk', len(local_mtimes))
         # { segment_id: Lock }
         write_locks = { lock.segment: lock for lock in Lock.host_locks(self.rethinker, self.hostname) }
@@ -1044,11 +2284,178 @@ class LocalSyncController(SyncController):
         if not hdfs_up:
             return
 
-        with futures.ThreadPoolExecutor(max_workers=settings['COPY_THREAD_POOL_SIZE']) as pool:
-            for segment_id in sorted(stale_queue, reverse=True):
-                # essentially does this call with a thread pool:
-                # process_stale_segment(my_segments.get(segment_id), local_mtimes.get(segment_id))
-                pool.submit(self.process_stale_segment, my_segments.get(segment_id), local_mtimes.get(segment_id), remote_mtimes.get(segment_id))
+        self.schedule_downloads(stale_queue, my_segments, local_mtimes, remote_mtimes, remote_checksums)
+        if settings['SYNC_WAIT_FOR_DOWNLOADS']:
+            self.download_scheduler.join()
+        status = self.download_scheduler.status()
+        logging.info(
+                'downloads: %s queued (%s waiting to be retried), %s running, '
+                '%s bytes to go, %s bytes/sec, eta %s sec', status['queued'],
+                status['retrying'], status['running'], status['bytes_remaining'],
+                status['bytes_per_sec'] and round(status['bytes_per_sec']),
+                status['eta'] and round(status['eta']))
+
+    def schedule_downloads(self, stale_queue, my_segments, local_mtimes, remote_mtimes, remote_checksums=None):
+        '''
+        Hands the segments in `stale_queue` to the download scheduler. Segments
+        that nobody else is serving go first, then the ones with the most
+        reads lately, then the ones with the fewest copies, then the highest
+        segment ids.
+        '''
+        downloads = []
+        for segment_id in stale_queue:
+            segment = my_segments.get(segment_id)
+            if not segment or not segment.remote_path:
+                # not assigned to us, see process_stale_segment()
+                logging.info('segment %s appears to be assigned to another machine', segment_id)
+                continue
+            downloads.append(segment)
+        if not downloads:
+            self.download_scheduler.schedule([])
+            return
+        demand = ReadStats.demand(self.rethinker, [segment.id for segment in downloads])
+        copies = self.readable_copy_counts([segment.id for segment in downloads])
+        remote_checksums = remote_checksums or {}
+        order = {segment_id: i for i, segment_id in enumerate(
+            sorted((segment.id for segment in downloads), reverse=True))}
+        def download(segment):
+            return Download(
+                    segment.id, segment.size,
+                    priority=(
+                        copies.get(segment.id, 0) > 0,
+                        -demand.get(segment.id, 0),
+                        copies.get(segment.id, 0) - segment.minimum_assignments(),
+                        order[segment.id]),
+                    fn=lambda: self.process_stale_segment(
+                        segment, local_mtimes.get(segment.id),
+                        remote_mtimes.get(segment.id),
+                        remote_checksums.get(segment.id)),
+                    source=segment.remote_path)
+        self.download_scheduler.schedule([download(segment) for segment in downloads])
+
+    def advertise_read_segment(self, segment_id):
+        '''
+        Registers our read service for `segment_id` straight away, rather
+        than waiting for the next sync loop to notice the segment.
+        '''
+        if settings['SERVICE_REGISTRY_MODEL'] == 'node':
+            logging.info('listing segment %r in membership of %s', segment_id, self.hostname)
+            SegmentMembership.add(
+                    self.rethinker, self.hostname, segment_id,
+                    self.read_port, settings['SERVICE_REGISTRY_BUCKETS'])
+        else:
+            logging.info('heartbeating read service for segment %r', segment_id)
+            self.registry.heartbeat(pool='trough-read',
+                segment=segment_id,
+                node=self.hostname,
+                port=self.read_port,
+                url='http://%s:%s/?segment=%s' % (self.hostname, self.read_port, segment_id),
+                ttl=round(self.sync_loop_timing * 4))
+
+    def fetch_segment(self, segment):
+        '''
+        Copies `segment`, which isn't assigned to this node, from a peer or
+        hdfs to serve a read, if there's room for it under
+        LOCAL_CACHE_HIGH_WATERMARK (see `reserve_room()`), and registers our
+        read service for it. Local sync keeps serving it from then on like
+        any other unassigned segment on local disk, and garbage collects it
+        like one (see `collect_garbage()`).
+
+        Raises:
+            KeyError: if the segment isn't in hdfs
+            FetchInProgress: if somebody else is fetching it already
+            Exception: if there isn't room for it
+        '''
+        entry = self.rethinker.table(SegmentCatalog.table).get(segment.id).run()
+        if entry:
+            remote_path = entry['remote_path']
+            size = entry.get('uncompressed_size') or entry['size']
+        else:
+            # not cataloged (yet), going by its assignments instead
+            assignments = [
+                    assignment for assignment in
+                    Assignment.segment_assignments(self.rethinker, segment.id)
+                    if assignment.get('remote_path')]
+            if not assignments:
+                raise KeyError('segment %r not found in hdfs' % segment.id)
+            remote_path = assignments[0]['remote_path']
+            size = assignments[0].get('bytes') or 0
+        with self.reserve_room(segment.id, size):
+            segment.remote_path = remote_path
+            checksum = entry.get('checksum') if entry else None
+            start = time.time()
+            if self.copy_segment_from_peer(segment, checksum):
+                source = 'a peer'
+            else:
+                if not settings['VERIFY_SEGMENT_CHECKSUMS']:
+                    checksum = None
+                self.copy_segment_from_hdfs(segment, checksum=checksum)
+                source = 'hdfs'
+            logging.info(
+                    'fetched segment %r (%s bytes) from %s to serve a read in '
+                    '%0.1f sec', segment.id, size, source, time.time() - start)
+            self.advertise_read_segment(segment.id)
+
+    @contextlib.contextmanager
+    def reserve_room(self, segment_id, size):
+        '''
+        Reserves `size` bytes of local disk for fetching `segment_id` while
+        the context lasts, if that keeps disk use under
+        LOCAL_CACHE_HIGH_WATERMARK of STORAGE_IN_BYTES, going by
+        `shutil.disk_usage()` of LOCAL_DATA plus the other fetches'
+        reservations. Reservations are files in READ_THROUGH_RESERVATIONS,
+        taken under an exclusive `flock()`, so that they hold across the
+        processes fetching segments. A reservation left by a process that
+        died is ignored.
+
+        Raises:
+            FetchInProgress: if `segment_id` is reserved already
+            Exception: if there isn't room
+        '''
+        directory = os.path.join(self.local_data, READ_THROUGH_RESERVATIONS)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '%s.reservation' % segment_id)
+        with open(os.path.join(directory, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            reserved = 0
+            for entry in os.scandir(directory):
+                if not entry.name.endswith('.reservation'):
+                    continue
+                try:
+                    with open(entry.path) as f:
+                        pid, reservation = (int(field) for field in f.read().split())
+                except (FileNotFoundError, ValueError):
+                    continue
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    logging.info('removing reservation %s left by dead process %s', entry.path, pid)
+                    os.remove(entry.path)
+                    continue
+                except PermissionError:
+                    pass # alive, just not ours
+                if entry.path == path:
+                    raise FetchInProgress(
+                            'segment %r is already being fetched by process %s' % (
+                                segment_id, pid))
+                reserved += reservation
+            usage = shutil.disk_usage(self.local_data)
+            quota = min(self.storage_in_bytes, usage.total) * settings['LOCAL_CACHE_HIGH_WATERMARK']
+            if usage.used + reserved + size > quota:
+                raise Exception(
+                        'no room to fetch segment %r (%s bytes), %s bytes used '
+                        'and %s reserved, of %s bytes' % (
+                            segment_id, size, usage.used, reserved,
+                            self.storage_in_bytes))
+            with open(path, 'w') as f:
+                f.write('%s %s' % (os.getpid(), size))
+        try:
+            yield
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
     def provision_writable_segment(self, segment_id, schema_id='default'):
         if settings['RUN_AS_COLD_STORAGE_NODE']:
@@ -1087,13 +2494,7 @@ class LocalSyncController(SyncController):
             url='http://%s:%s/?segment=%s' % (self.hostname, self.write_port, segment_id),
             ttl=round(self.sync_loop_timing * 4))
 
-        logging.info('heartbeating read service for segment %r', segment_id)
-        self.registry.heartbeat(pool='trough-read',
-            segment=segment_id,
-            node=self.hostname,
-            port=self.read_port,
-            url='http://%s:%s/?segment=%s' % (self.hostname, self.read_port, segment_id),
-            ttl=round(self.sync_loop_timing * 4))
+        self.advertise_read_segment(segment_id)
 
         # ensure that the file exists on the filesystem
         if not segment.local_segment_exists():
@@ -1103,6 +2504,7 @@ class LocalSyncController(SyncController):
                 raise Exception('no such schema id=%r' % schema_id)
             logging.info('provisioning local segment %r', segment_id)
             segment.provision_local_segment(schema.sql)
+            self.local_segment_changed(segment_id)
 
         result_dict = {
             'write_url': trough_write_status['url'],
@@ -1126,19 +2528,45 @@ class LocalSyncController(SyncController):
             sqlitebck.copy(source, dest)
             source.close()
             dest.close()
+            compress = settings['COMPRESS_SEGMENTS']
+            # the segment may have been promoted before with
+            # COMPRESS_SEGMENTS set the other way
+            stale_path = segment_path_variant(segment.remote_path, not compress)
+            segment.remote_path = segment_path_variant(segment.remote_path, compress)
+            block_size = settings['DELTA_SYNC_BLOCK_SIZE']
+            blocksums = None
+            if compress:
+                # worked out while compressing, below
+                checksum = None
+            elif block_size:
+                blocksums = file_block_checksums(temp_file.name, block_size)
+                checksum = blocksums['checksum']
+            else:
+                checksum = file_checksum(temp_file.name)
             logging.info(
                     'uploading %s to hdfs %s', temp_file.name,
                     segment.remote_path)
             hdfs.mkdir(os.path.dirname(segment.remote_path))
             # java hdfs convention, upload to foo._COPYING_
             tmp_name = '%s._COPYING_' % segment.remote_path
-            hdfs.put(temp_file.name, tmp_name)
+            uncompressed_size = os.path.getsize(temp_file.name)
+            if compress:
+                compressor = zstandard.ZstdCompressor(
+                        level=settings['SEGMENT_COMPRESSION_LEVEL'])
+                with open(temp_file.name, 'rb') as src, hdfs.open(tmp_name, 'wb') as dest:
+                    src = HashingFile(src)
+                    # passing the size records it in the zstd frame header
+                    compressor.copy_stream(src, dest, size=uncompressed_size)
+                checksum = src.digest.hexdigest()
+            else:
+                hdfs.put(temp_file.name, tmp_name)
 
             # update mtime of local segment so that sync local doesn't think the
             # segment we just pushed to hdfs is newer (if it did, it would pull it
             # down and decommission its writable copy)
             # see https://webarchive.jira.com/browse/ARI-5713?focusedCommentId=110920#comment-110920
             os.utime(segment.local_path(), times=(time.time(), time.time()))
+            self.local_segment_changed(segment.id)
 
             # move existing out of the way if necessary (else mv fails)
             if hdfs.exists(segment.remote_path):
@@ -1149,6 +2577,29 @@ class LocalSyncController(SyncController):
             result = hdfs.mv(tmp_name, segment.remote_path)
             assert result is True
 
+            if hdfs.exists(stale_path):
+                logging.info('removing %s, superseded by %s', stale_path, segment.remote_path)
+                hdfs.rm(stale_path)
+                if hdfs.exists(stale_path + BLOCKSUMS_SUFFIX):
+                    hdfs.rm(stale_path + BLOCKSUMS_SUFFIX)
+
+            if blocksums:
+                # workers check the whole-file checksum after patching, so it
+                # doesn't matter if a worker sees these out of step with the
+                # segment
+                blocksums_path = segment.remote_path + BLOCKSUMS_SUFFIX
+                with hdfs.open('%s._COPYING_' % blocksums_path, 'wb') as f:
+                    f.write(ujson.dumps(blocksums).encode('utf-8'))
+                if hdfs.exists(blocksums_path):
+                    hdfs.rm(blocksums_path)
+                hdfs.mv('%s._COPYING_' % blocksums_path, blocksums_path)
+
+            info = hdfs.info(segment.remote_path)
+            SegmentCatalog.record(
+                    self.rethinker, segment.id, segment.remote_path,
+                    size=info['size'], last_mod=info['last_mod'],
+                    checksum=checksum, uncompressed_size=uncompressed_size)
+
             logging.info('Promoted writable segment %s upstream to %s', segment.id, segment.remote_path)
 
     def promote_writable_segment_upstream(self, segment_id):
@@ -1189,7 +2640,8 @@ class LocalSyncController(SyncController):
             self.rethinker.table('lock')\
                     .get('write:lock:%s' % segment_id)\
                     .update({'under_promotion': False}).run()
-        return {'remote_path': remote_path}
+        # might have gained or lost .zst
+        return {'remote_path': segment.remote_path}
 
     def collect_garbage(self):
         # for each segment file on local disk
@@ -1204,40 +2656,148 @@ class LocalSyncController(SyncController):
             return
 
         assignments = set(item.id for item in self.registry.segments_for_host(self.hostname))
-        for filename in os.listdir(self.local_data):
-            if not filename.endswith('.sqlite'):
+        local_sizes = self.local_segment_sizes()
+        candidates = [
+                segment_id for segment_id in local_sizes
+                if segment_id not in assignments]
+        batch_size = settings['GARBAGE_COLLECTION_BATCH_SIZE']
+        if not settings['LOCAL_CACHE_EXTRA_REPLICAS']:
+            for i in range(0, len(candidates), batch_size):
+                self.collect_garbage_batch(candidates[i:i+batch_size])
+            return
+
+        # segments we're not serving (e.g. older than the copy in hdfs) are
+        # no use as extra replicas, collect them whatever the disk space;
+        # going by the service registry, since we may not be the process
+        # that heartbeats our read services (see scripts/garbage_collector.py)
+        served = self.served_segment_ids(candidates)
+        unserved = {
+                segment_id for segment_id in candidates
+                if segment_id not in served
+                and self.read_id_tmpl % segment_id not in self.healthy_service_ids}
+        unserved_ids = sorted(unserved)
+        for i in range(0, len(unserved_ids), batch_size):
+            for segment_id in self.collect_garbage_batch(unserved_ids[i:i+batch_size]):
+                del local_sizes[segment_id]
+        extras = [
+                segment_id for segment_id in candidates
+                if segment_id in local_sizes and segment_id not in unserved]
+
+        # the rest we keep around as extra replicas, while there's room
+        # (pending downloads are only known to the local sync process, so
+        # anywhere else we go by what's on disk)
+        quota = self.storage_in_bytes
+        used = sum(local_sizes.values()) + self.download_scheduler.status()['bytes_remaining']
+        if used <= quota * settings['LOCAL_CACHE_HIGH_WATERMARK']:
+            logging.info(
+                    'keeping %s unassigned segments as extra replicas, %s of '
+                    '%s bytes used or about to be', len(extras), used, quota)
+            return
+        # ... least recently read first, until we're under the low watermark
+        to_free = used - quota * settings['LOCAL_CACHE_LOW_WATERMARK']
+        last_reads = ReadStats.last_reads(self.rethinker, extras)
+        never = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        extras.sort(key=lambda segment_id: (last_reads.get(segment_id) or never, segment_id))
+        logging.info(
+                '%s of %s bytes used or about to be, evicting up to %s bytes '
+                'of %s unassigned segments, least recently read first',
+                used, quota, round(to_free), len(extras))
+        freed = 0
+        for i in range(0, len(extras), batch_size):
+            evicted = self.collect_garbage_batch(
+                    extras[i:i+batch_size], sizes=local_sizes,
+                    max_bytes=to_free - freed)
+            freed += sum(local_sizes[segment_id] for segment_id in evicted)
+            if freed >= to_free:
+                break
+        logging.info('evicted %s bytes of extra replicas', freed)
+
+    def served_segment_ids(self, segment_ids, batch_size=1000):
+        '''
+        Returns the set of `segment_ids` that have a healthy read service on
+        this node in the service registry, advertised either way.
+        '''
+        segment_ids = list(segment_ids)
+        served = set()
+        for i in range(0, len(segment_ids), batch_size):
+            served.update(read_services_query(
+                        self.rethinker, segment_ids[i:i+batch_size])\
+                    .filter({'node': self.hostname})['segment'].run())
+        return served
+
+    def collect_garbage_batch(self, segment_ids, sizes=None, max_bytes=None):
+        '''
+        Garbage collects local segments `segment_ids`, none of which are
+        assigned to this node, looking up their readable copies and write
+        locks in one query. If `max_bytes` is given, stops once that many
+        bytes worth of segments, going by `sizes`, are to be deleted, taking
+        them in the order given.
+
+        Returns:
+            list of ids of the segments deleted
+        '''
+        result = self.rethinker.expr({
+            'copies': read_services_query(None, segment_ids)\
+                    .pluck('id', 'segment').coerce_to('array'),
+            # re-check that the lock is not held by this machine before
+            # removing the service or the segment file
+            'locks': r.table('lock')\
+                    .get_all(*['write:lock:%s' % segment_id for segment_id in segment_ids])\
+                    .pluck('segment', 'node').coerce_to('array'),
+        }).run()
+        healthy_service_ids = collections.defaultdict(set)
+        for service in result['copies']:
+            healthy_service_ids[service['segment']].add(service['id'])
+        lock_nodes = {lock['segment']: lock['node'] for lock in result['locks']}
+
+        doomed = []
+        services = []
+        for segment_id in segment_ids:
+            segment = Segment(segment_id, 0, self.rethinker, self.services, self.registry)
+            local_service_id = self.read_id_tmpl % segment_id
+            copies = healthy_service_ids[segment_id]
+            serving = local_service_id in copies
+            copies.discard(local_service_id)
+            if len(copies) < segment.minimum_assignments() \
+                    or lock_nodes.get(segment_id) == self.hostname:
                 continue
-            segment_id = filename[:-7]
-            local_service_id = 'trough-read:%s:%s' % (self.hostname, segment_id)
-            if segment_id not in assignments:
-                segment = Segment(segment_id, 0, self.rethinker, self.services, self.registry)
-                healthy_service_ids = {service['id'] for service in segment.readable_copies()}
-                if local_service_id in healthy_service_ids:
-                    healthy_service_ids.remove(local_service_id)
-                    # re-check that the lock is not held by this machine before removing service
-                    rechecked_lock = self.rethinker.table('lock').get(segment.id).run()
-                    if len(healthy_service_ids) >= segment.minimum_assignments() \
-                        and (rechecked_lock is None or rechecked_lock['node'] != self.hostname):
-                        logging.info(
-                                'segment %s has %s readable copies (minimum is %s) '
-                                'and is not assigned to %s, removing %s from the '
-                                'service registry',
-                                segment_id, len(healthy_service_ids),
-                                segment.minimum_assignments(), self.hostname,
-                                local_service_id)
-                        self.rethinker.table('services').get(local_service_id).delete().run()
-                # re-check that the lock is not held by this machine before removing segment file
-                rechecked_lock = self.rethinker.table('lock').get(segment.id)
-                if len(healthy_service_ids) >= segment.minimum_assignments() \
-                    and (rechecked_lock is None or rechecked_lock['node'] != self.hostname):
-                    path = os.path.join(self.local_data, filename)
-                    logging.info(
-                            'segment %s now has %s readable copies (minimum '
-                            'is %s) and is not assigned to %s, deleting %s',
-                            segment_id, len(healthy_service_ids),
-                            segment.minimum_assignments(), self.hostname,
-                            path)
-                    os.remove(path)
+            if max_bytes is not None:
+                if max_bytes <= 0:
+                    break
+                max_bytes -= sizes[segment_id]
+            if serving:
+                logging.info(
+                        'segment %s has %s readable copies (minimum is %s) '
+                        'and is not assigned to %s, removing %s from the '
+                        'service registry',
+                        segment_id, len(copies),
+                        segment.minimum_assignments(), self.hostname,
+                        local_service_id)
+                services.append(segment_id)
+            doomed.append((segment, len(copies)))
+            # or the heartbeat would bring the service back
+            self.healthy_service_ids.discard(local_service_id)
+
+        if services:
+            self.rethinker.table('services').get_all(
+                    *[self.read_id_tmpl % segment_id for segment_id in services]).delete().run()
+            if settings['SERVICE_REGISTRY_MODEL'] == 'node':
+                SegmentMembership.remove_many(
+                        self.rethinker, self.hostname, services,
+                        settings['SERVICE_REGISTRY_BUCKETS'])
+        for segment, copies in doomed:
+            path = local_segment_path(segment.id, self.local_data)
+            logging.info(
+                    'segment %s now has %s readable copies (minimum '
+                    'is %s) and is not assigned to %s, deleting %s',
+                    segment.id, copies, segment.minimum_assignments(),
+                    self.hostname, path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.local_segment_changed(segment.id)
+        return [segment.id for segment, copies in doomed]
 
 def get_controller(server_mode):
     logging.info('Connecting to Rethinkdb on: %s' % settings['RETHINKDB_HOSTS'])
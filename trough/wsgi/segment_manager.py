@@ -127,6 +127,42 @@ def make_app(controller):
             logging.warning('DELETE /segment/%s', id, exc_info=True)
             flask.abort(400)
 
+    # fetches the segment to serve reads on this node, for read servers (see
+    # READ_THROUGH); 204 once it's here, 404 if it isn't in hdfs, 409 if it's
+    # already being fetched
+    @app.route('/segment/<id>/fetch', methods=['POST'])
+    def fetch_segment(id):
+        if not trough.settings.settings['READ_THROUGH']:
+            flask.abort(404)
+        segment = trough.sync.Segment(
+                segment_id=id, size=0, rethinker=controller.rethinker,
+                services=controller.services, registry=controller.registry)
+        try:
+            controller.fetch_segment(segment)
+            return flask.Response(status=204)
+        except KeyError as e:
+            logging.warning('POST /segment/%s/fetch: %s', id, e)
+            flask.abort(404)
+        except trough.sync.FetchInProgress as e:
+            logging.info('POST /segment/%s/fetch: %s', id, e)
+            flask.abort(409)
+
+    # streams our copy of the segment to a peer, with range support, if it's
+    # up to date with hdfs; 404 if PEER_TRANSFER is off or we have no such copy
+    @app.route('/segment/<id>/data', methods=['GET'])
+    def get_segment_data(id):
+        if not trough.settings.settings['PEER_TRANSFER']:
+            flask.abort(404)
+        try:
+            path, checksum = controller.peer_transfer_source(id)
+        except KeyError as e:
+            logging.info('not serving GET /segment/%s/data: %s', id, e)
+            flask.abort(404)
+        response = flask.send_file(
+                path, mimetype='application/octet-stream', conditional=True)
+        response.headers['X-Trough-Checksum'] = checksum
+        return response
+
     return app
 
 trough.settings.configure_logging()